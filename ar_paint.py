@@ -1,26 +1,34 @@
 from random import randint
 import cv2
-# import numpy as np
+import numpy as np
 
 import argparse
 import json
-# from functools import partial
 
-from os import path
+from os import path, makedirs
 import sys
 from datetime import datetime
+import time
 
 from classes import *
 from aux_functions import \
-    get_centroid_position, \
     get_mouse_position, \
     new_draw_move, \
-    redraw_on_frame, \
-    apply_mask, \
     getgrid, \
-    findcontours, \
+    grid_overlay, \
     colorswindow, \
     calc_accuracy
+from pipeline import Pipeline
+from detection import BlobDetector, BandBlobDetector, PencilTracker, MultiScaleDetector, MultiPenDetector
+from segmentation import read_pens
+from headless import open_source, KeyTimeline, Display, HeadlessDisplay
+from camera import config_path, load_config, frame_shape
+from profiling import StageTimer
+from filters import FILTERS, make_filter
+from session_log import SessionLog, SessionReplay, has_session
+from infinite_canvas import Viewport, InfiniteCanvas
+from stream_server import StreamServer
+from saver import ImageSaver, FORMATS
 
 
 
@@ -36,8 +44,33 @@ def main():
     # processing command line arguments
     parser = argparse.ArgumentParser(description='PSR AR Paint')
     parser.add_argument('-j', '--json', type=str, required=False, help='provide the path to the .json file with the color data')
+    parser.add_argument('-cc', '--capture_config', type=str, required=False, help='provide the path to the camera capture configuration written by camera.py (capture.json alongside the .json file with the color data by default)')
     parser.add_argument('-usp', '--use_shake_prevention', action='store_true', help='use shake prevention while drawing')
     parser.add_argument('-m', '--mouse', action='store_true', help='test the program with the mouse pointer instead of the color centroid')
+    parser.add_argument('-f', '--filter', choices=['none'] + list(FILTERS), default='none', help='filter for smoothing the pencil position and rejecting outliers')
+    parser.add_argument('-pr', '--predict', type=float, default=0.0, help='how far ahead (in milliseconds) the filter predicts the pencil position, to hide the latency')
+    parser.add_argument('-smp', '--simplify', type=float, default=1.0, help='tolerance (in pixels, at the starting zoom on the virtual canvas) for simplifying the strokes kept in the drawing history; 0 keeps every point')
+    parser.add_argument('-hm', '--history_mb', type=float, default=64, help='memory (in MB) for the undo history; older strokes are baked into the canvas beyond it (on the virtual canvas, they are erased)')
+    parser.add_argument('-lg', '--log', type=str, required=False, help='provide the path to a session log where every drawing event is written; if it already exists, the session is resumed from it')
+    parser.add_argument('-inf', '--infinite', action='store_true', help='draw on a virtual canvas bigger than the frame, which can be panned and zoomed')
+    parser.add_argument('-sf', '--save_format', choices=list(FORMATS), default='png', help='format of the images saved with the \'w\' key (raw is an uncompressed .npz file)')
+    parser.add_argument('-sq', '--save_quality', type=int, required=False, help='PNG compression level (0-9, default 3) or JPEG/WebP quality (0-100, default 95) of the saved images')
+    parser.add_argument('-sc', '--save_canvas', action='store_true', help='save only the drawing (with transparency, where the format allows it) instead of the whole camera frame')
+    parser.add_argument('-p', '--pipeline', action='store_true', help='run capture and pencil detection on background threads, dropping stale frames')
+    detector_group = parser.add_mutually_exclusive_group()
+    detector_group.add_argument('-t', '--track', action='store_true', help='search for the pencil only around its last position, falling back to the whole frame when it is lost')
+    detector_group.add_argument('-ds', '--downscale', type=float, required=False, help='search for the pencil on a frame this many times smaller, refining its position at full resolution')
+    detector_group.add_argument('-bd', '--bands', type=int, required=False, help='segment each frame in this many horizontal bands in parallel, one per worker thread (0 for one per CPU core)')
+    parser.add_argument('-pyr', '--pyramid', action='store_true', help='downscale with an image pyramid instead of sampling pixels (used with --downscale)')
+    parser.add_argument('-ma', '--min_area', type=int, default=0, help='minimum area (in pixels) of a blob to be taken for the pencil; smaller ones are ignored as noise')
+    parser.add_argument('-mo', '--morphology', type=int, default=0, help='size (in pixels) of the morphological opening and closing that clean up the mask before the pencil is searched for; 0 for none')
+    parser.add_argument('-hud', '--hud', action='store_true', help='start with the performance HUD on (it can be toggled with the \'h\' key)')
+    parser.add_argument('-tr', '--trace', type=str, required=False, help='provide the path to a .csv or .json file where the timings of every frame are written at exit')
+    parser.add_argument('-src', '--source', type=str, required=False, help='provide a video file or a directory with an image sequence to use instead of the camera')
+    parser.add_argument('-hl', '--headless', action='store_true', help='run without any windows, reading the key presses from the --keys file')
+    parser.add_argument('-k', '--keys', type=str, required=False, help='provide the key timeline file for headless runs (lines with a frame number and a key)')
+    parser.add_argument('-o', '--output', type=str, required=False, help='provide a directory where the final canvas (and, in headless runs, every frame shown) is written')
+    parser.add_argument('-st', '--stream', type=int, required=False, help='provide a port on which the frames are streamed as MJPEG over HTTP to any number of local viewers (e.g. 8080)')
     args = vars(parser.parse_args())
 
     # if a path to a .json file is not provided, we assume it's the
@@ -48,22 +81,88 @@ def main():
     usp = args['use_shake_prevention']
     # boolean that determines if the mouse pointer is to be used or not
     use_mouse = args['mouse']
-
-    # reading color information from .json file
+    # boolean that determines if the threaded capture/processing pipeline is to be used or not
+    use_pipeline = args['pipeline']
+    # directory for the outputs of the run (None if they're not to be saved)
+    output_dir = args['output']
+
+    # the downscaled search has no noise filtering of its own, and a factor of 1 or less wouldn't make the frame smaller
+    if args['downscale'] is not None:
+        if args['downscale'] <= 1:
+            sys.exit('The --downscale factor has to be bigger than 1.')
+        if args['min_area'] or args['morphology']:
+            sys.exit('--min_area and --morphology can\'t be used together with --downscale.')
+
+    # in headless mode, windows are replaced by files and key presses are read from the timeline
+    if args['headless']:
+        if use_mouse:
+            sys.exit('The mouse can\'t be used in headless mode.')
+        try:
+            display = HeadlessDisplay(KeyTimeline(args['keys']), output_dir)
+        except (FileNotFoundError, ValueError) as error:
+            sys.exit('Couldn\'t read the key timeline: ' + str(error))
+    else:
+        display = Display()
+
+    # reading the pens (their color ranges and the colors they draw with) from the .json file
     try:
-        with open(json_path, 'r') as openfile:
-            json_object = json.load(openfile)
-            ranges = json_object['limits']
+        pen_data = read_pens(json_path)
     # if the file doesn't exist, send out an error message and quit
     except FileNotFoundError:
         sys.exit('The .json file with the color data doesn\'t exist.')
+    except (KeyError, ValueError) as error:
+        sys.exit('Couldn\'t read the color data: ' + str(error))
 
-    # list of all the draw moves done so far
-    draw_moves = []
-
-    # setting up the video capture
-    capture = cv2.VideoCapture(0)
-    _, frame = capture.read() # initial frame just to figure out proper window dimensions
+    # the mouse is a single pen
+    if use_mouse:
+        pen_data = pen_data[:1]
+    # several pens, or pens segmented in HSV, are all found at once by a MultiPenDetector
+    multi_pen = len(pen_data) > 1 or pen_data[0]['space'] != 'bgr'
+    if multi_pen and not use_mouse and (args['track'] or args['downscale'] is not None or args['bands'] is not None):
+        sys.exit('--track, --downscale and --bands only work with a single pen segmented in RGB.')
+    if args['log'] and len(pen_data) > 1:
+        sys.exit('Sessions with several pens can\'t be logged.')
+    if args['log'] and args['infinite']:
+        sys.exit('Sessions on the virtual canvas can\'t be logged.')
+
+    # setting up the video capture, with the camera settings saved alongside the color data
+    try:
+        capture_config = load_config(args['capture_config'] or config_path(json_path))
+    except (ValueError, json.JSONDecodeError) as error:
+        sys.exit('Couldn\'t read the capture configuration: ' + str(error))
+    capture = open_source(args['source'], capture_config)
+
+    # the frame size is needed to set everything up; if the source tells it, the frame buffer is allocated right
+    # away (the first frame is read into it), otherwise a frame is read just to figure it out
+    shape = frame_shape(capture)
+    if shape is not None:
+        frame = np.empty(shape, dtype=np.uint8)
+    else:
+        ret, frame = capture.read()
+        if not ret:
+            sys.exit('Couldn\'t read any frame from the video source.')
+
+    # drawing state of each pen: its persistent layer where every committed draw move is painted once, the
+    # history of all its draw moves and the undo/redo of its committed strokes (every committed move goes through
+    # it, to the history and the canvas), its position filter, color and thickness; the undo memory is shared
+    # out between the pens, and the keys act on the selected pen
+    memory_cap = int(args['history_mb']*1024*1024) // len(pen_data)
+    pens = [PenState(data['name'], frame.shape, data['color'], 5, args['simplify'], memory_cap,
+                     make_filter(args['filter'], args['predict'] / 1000)) for data in pen_data]
+    pen = pens[0]
+
+    # on the virtual canvas, the canvas of each pen only shows what the viewport (shared by all the pens) shows,
+    # and it's the virtual canvas that keeps the strokes (with the same simplification and memory cap) and their
+    # undo/redo
+    if args['infinite']:
+        viewport = Viewport(frame.shape)
+        for state in pens:
+            state.history = InfiniteCanvas(state.canvas, viewport, args['simplify'], memory_cap)
+            state.draw_moves = state.history.store
+
+    # the drawing: the layer of the pen, or the layers of all the pens stacked (the last pen on top)
+    drawing = pen.canvas if len(pens) == 1 else LayerStack(frame.shape, [state.canvas for state in pens])
+    layers = drawing # what is laid over each frame (see LayerStack for coloring mode)
 
     # dimensions for all windows
     scale = 0.6
@@ -72,23 +171,23 @@ def main():
 
     # continuing video capture setup
     camera_window = 'Camera capture'
-    cv2.namedWindow(camera_window, cv2.WINDOW_NORMAL)
-    cv2.resizeWindow(camera_window, (window_width, window_height))
+    display.namedWindow(camera_window, cv2.WINDOW_NORMAL)
+    display.resizeWindow(camera_window, (window_width, window_height))
 
     # setting up the window that shows the mask being applied
     mask_window = 'Masked capture'
-    cv2.namedWindow(mask_window, cv2.WINDOW_NORMAL)
-    cv2.resizeWindow(mask_window, (window_width, window_height))
+    display.namedWindow(mask_window, cv2.WINDOW_NORMAL)
+    display.resizeWindow(mask_window, (window_width, window_height))
 
     # define positions of each window on screen (this way, they don't overlap)
-    cv2.moveWindow(camera_window, 200, 100)
-    cv2.moveWindow(mask_window, 1000, 100)
+    display.moveWindow(camera_window, 200, 100)
+    display.moveWindow(mask_window, 1000, 100)
 
     # if we're going to use mouse coordinates in place of the centroid, we need to
     # keep track of the mouse
     if use_mouse:
         mouse = Mouse()
-        cv2.setMouseCallback(mask_window, mouse.update_mouse)
+        display.setMouseCallback(mask_window, mouse.update_mouse)
 
     # according to the pressing of the 's', 'e' or 'o' keys, this variable keeps up
     # with which mode we're in (which figure the user wants to draw);
@@ -99,96 +198,233 @@ def main():
     # this variable keeps track of the current square or ellipse preview, should
     # the user be in the middle of drawing one;
     # otherwise, it's None
+    # note: the figure in cache is not part of the canvas yet, it's drawn on top of
+    # each frame and only committed to the canvas once the user confirms it
     figure_cache = None
 
     # this variable tells if we're currently in the mode where we color zones according
     # to their number or not; let's call this 'coloring mode'
     color_zones = False
 
+    # detector that finds the pencil on each frame (if we're not using the mouse)
+    ranges = pen_data[0]['limits']
+    if use_mouse:
+        detector = None
+    elif multi_pen:
+        detector = MultiPenDetector(pen_data, args['min_area'], args['morphology'])
+    elif args['track']:
+        detector = PencilTracker(ranges, args['min_area'], args['morphology'])
+    elif args['downscale'] is not None:
+        detector = MultiScaleDetector(ranges, args['downscale'], args['pyramid'])
+    elif args['bands'] is not None:
+        detector = BandBlobDetector(ranges, args['min_area'], args['morphology'], args['bands'] or None)
+    else:
+        detector = BlobDetector(ranges, args['min_area'], args['morphology'])
+    detect = detector.detect if detector else None
+
+    # the detectors that reuse their detection output images get each of them back once it's been displayed (or
+    # dropped by the pipeline), so that they never write into an image that is still being displayed
+    release_view = detector.release_view if isinstance(detector, (BlobDetector, MultiPenDetector)) else None
+
+    # images are saved on a background thread
+    saver = ImageSaver(args['save_format'], args['save_quality'])
+
+    # timings of each stage of the main loop; in the pipeline, the pencil detection is timed on its own thread
+    timer = StageTimer(['capture', 'detect', 'draw', 'render', 'imshow', 'waitKey'], trace=bool(args['trace']))
+    show_hud = args['hud']
+
+    # the frames are streamed to local viewers from a server of its own (with its own threads)
+    stream_server = None
+    if args['stream'] is not None:
+        try:
+            stream_server = StreamServer(args['stream']).start()
+        except OSError as error:
+            sys.exit('Couldn\'t start the stream server: ' + str(error))
+        print('Streaming on http://localhost:' + str(args['stream']) + '/ (statistics at /stats)')
+
+    # if we're using the pipeline, capture and pencil detection run on background threads from now on
+    if use_pipeline:
+        pipeline = Pipeline(capture, timer.wrap('detect', detect) if detect else None,
+                            (lambda detection: release_view(detection[1])) if release_view else None).start()
+
     # ------------ Continuous Operation ------------
 
-    # default pencil setup
-    draw_color = (0,0,255) # starts off red
-    draw_thickness = 5
-    old_pencil_coords = (None,None)
+    # if we're logging the session, we first resume it from the log (if there's one), and then every drawing event
+    # is appended to it
+    session_log = None
+    if args['log']:
+        try:
+            if has_session(args['log']):
+                replay = SessionReplay(args['log'])
+                if replay.shape != frame.shape:
+                    raise ValueError('The session log is for ' + str(replay.shape[1]) + 'x' + str(replay.shape[0]) + ' frames.')
+                _, replayed_state = replay.rebuild(history=pen.history)
+                pen.color, pen.thickness = replayed_state['color'], replayed_state['thickness']
+                print('Resumed ' + str(len(replay)) + ' events from ' + args['log'])
+            session_log = SessionLog(args['log'], frame.shape)
+        except ValueError as error:
+            sys.exit('Couldn\'t use the session log: ' + str(error))
+        pen.history.log = session_log
+        logged_state = {'color': None, 'thickness': None, 'figure': None, 'coloring': False}
 
     while True:
 
-        # capture an image with the camera
-        _, frame = capture.read()
-        mask = apply_mask(frame, ranges)
+        # capture an image with the camera and detect the pencil in it (unless we're using the mouse)
+        if use_pipeline:
+            item = pipeline.get()
+            if item is None: # capture stopped
+                break
+            frame, detection, captured_at = item
+            timer.lap('capture')
+        else:
+            # the new frame is read into the previous one, which is no longer needed
+            ret, frame = capture.read(frame)
+            if not ret: # the video source ran out of frames
+                break
+            timer.lap('capture')
+            detection = detect(frame) if not use_mouse else None
+            timer.lap('detect')
 
         # if we're in coloring mode
         if color_zones:
-
-            # display the grid and numbers
-            frame = findcontours(frame, zones, color_numbers)
-
-            # setting up the window the coloring accuracy
-            color_window = 'Color map'
-            cv2.namedWindow(color_window, cv2.WINDOW_NORMAL)
-            cv2.resizeWindow(color_window, (300,350))
-            cv2.moveWindow(color_window, 800, 600)
-
-            # show the colors to be used
-            stats = colorswindow(numbers_to_colors)
-            cv2.imshow(color_window, stats)
-
-        # calculate centroid of the largest color blob and show the mask being applied
-        pencil_coords, detected_pencil = get_centroid_position(mask) if not use_mouse else get_mouse_position(mouse)
-        cv2.imshow(mask_window, detected_pencil)
+            timer.mark()
+
+            # if the frame size changed, the grid (and its overlay) has to be computed again
+            if frame.shape[:2] != zone_map.shape:
+                zones, zone_map, _ = getgrid(frame)
+                if len(zones) != len(color_numbers):
+                    color_numbers = [randint(1,3) for _ in range(len(zones))]
+                num_zones = len(zones)
+                overlay = grid_overlay(frame.shape, zones, color_numbers)
+                layers = LayerStack(frame.shape, [overlay, drawing])
+            timer.lap('render')
+
+        # calculate centroid of the largest color blob (of each pen) and show the mask being applied
+        pencil_coords, detected_pencil = detection if not use_mouse else get_mouse_position(mouse)
+        pen_coords = pencil_coords if isinstance(detector, MultiPenDetector) else [pencil_coords]
+
+        # with the mouse, every event received since the last frame is taken (smoothed and predicted with the time
+        # it was received at), so that fast strokes keep all the points they went through, however long frames
+        # take; the last one is the position of the frame
+        if use_mouse:
+            mouse_events = []
+            for (x, y), event_time, pressed, released in zip(*mouse.drain()):
+                coords = (int(x), int(y))
+                if pen.filter:
+                    coords = pen.filter.update(coords, event_time)
+                mouse_events.append((coords, pressed, released))
+            if mouse_events:
+                pen_coords = [mouse_events[-1][0]]
+
+        # smooth and predict the pencil positions; the filter needs the time the frame was taken, which, when
+        # replaying a recording without a display, is worked out from the frame number (assuming 30 FPS)
+        elif pen.filter:
+            if use_pipeline:
+                frame_time = captured_at
+            elif args['headless']:
+                frame_time = timer.frame_index / 30
+            else:
+                frame_time = time.perf_counter()
+            pen_coords = [state.filter.update(coords, frame_time) for state, coords in zip(pens, pen_coords)]
+        timer.mark()
+        display.imshow(mask_window, detected_pencil)
+        if release_view:
+            release_view(detected_pencil)
+        timer.lap('imshow')
 
         # update the history of draw moves
-        # we only add the most recent move if:
-        #   (1) we're on mouse mode AND the mouse is pressed
+        # when free drawing with the mouse, the moves go through the positions of all its events, as one stroke
+        # while the button is down (or several, if it was released in between); the stroke goes up to the point
+        # where the button was released, and the next one starts anew
+        if use_mouse:
+            for coords, pressed, released in mouse_events:
+                if pressed and not figure_mode:
+                    move = new_draw_move(pen.old_coords, coords, pen.color, pen.thickness, usp)
+                    pen.history.draw(move)
+                    pen.old_coords = coords
+                if released or not pressed or figure_mode:
+                    pen.old_coords = (None,None)
+
+        # otherwise, we only add the most recent move if:
+        #   (1) we're on mouse mode AND figure mode AND the mouse is pressed
         #       OR
         #   (2) we're not on mouse mode
-        if (use_mouse and mouse.pressed) or (not use_mouse):
-
-            # free drawing mode
-            if not figure_mode:
-                draw_moves.append(new_draw_move(old_pencil_coords, pencil_coords, draw_color, draw_thickness, usp))
-
-            # figure mode and we're detecting the pencil
-            elif pencil_coords!=(None,None):
-
-                # if we already have a figure in cache, its origin remains the same;
-                # if not, its origin is set as the current pencil coordinates
-                # note: the origin of a figure is it's top-left corner for a rectangle/square or
-                # an ellipse, and its center for a circle
-                origin = figure_cache.origin if figure_cache else pencil_coords
-
-                # update the figure cache with the figure's new positioning
-                if figure_mode=='square':
-                    figure_cache = Square(origin, pencil_coords, draw_color, draw_thickness)
-                elif figure_mode=='ellipse':
-                    figure_cache = Ellipse(origin, pencil_coords, draw_color, draw_thickness)
-                elif figure_mode=='circle':
-                    figure_cache = Circle(origin, pencil_coords, draw_color, draw_thickness)
-
-                # update draw_moves with the new figure in cache
-                draw_moves[-1] = figure_cache
-
-            # figure mode but we can't detect the pencil
-            elif pencil_coords==(None,None):
-                # if there's any figure in the cache, we make it grey;
-                # this signals to the user that the current figure is impossible to edit at the moment, but that
-                # it will continue the positioning process once the pencil coordinates are detected once more;
-                # if the user purposefully chooses to hide the pencil pointer and deactivate figure mode while
-                # in this state, that allows them to give up on drawing this figure
-                if figure_cache:
-                    figure_cache.color = (190,190,190)
-                    draw_moves[-1] = figure_cache
-
-        # redraw history of moves on new frame
-        frame = redraw_on_frame(frame,draw_moves)
-        old_pencil_coords = pencil_coords
-
-        # show frame
-        cv2.imshow(camera_window, frame)
+        if (use_mouse and figure_mode and mouse.pressed) or (not use_mouse):
+            for state, pencil_coords in zip(pens, pen_coords):
+
+                # free drawing mode (the pens that aren't selected always draw freely)
+                if not figure_mode or state is not pen:
+                    move = new_draw_move(state.old_coords, pencil_coords, state.color, state.thickness, usp)
+                    state.history.draw(move)
+
+                # figure mode and we're detecting the pencil
+                elif pencil_coords!=(None,None):
+
+                    # if we already have a figure in cache, its origin remains the same;
+                    # if not, its origin is set as the current pencil coordinates
+                    # note: the origin of a figure is it's top-left corner for a rectangle/square or
+                    # an ellipse, and its center for a circle
+                    origin = figure_cache.origin if figure_cache else pencil_coords
+
+                    # update the figure cache with the figure's new positioning
+                    if figure_mode=='square':
+                        figure_cache = Square(origin, pencil_coords, pen.color, pen.thickness)
+                    elif figure_mode=='ellipse':
+                        figure_cache = Ellipse(origin, pencil_coords, pen.color, pen.thickness)
+                    elif figure_mode=='circle':
+                        figure_cache = Circle(origin, pencil_coords, pen.color, pen.thickness)
+
+                # figure mode but we can't detect the pencil
+                elif pencil_coords==(None,None):
+                    # if there's any figure in the cache, we make it grey;
+                    # this signals to the user that the current figure is impossible to edit at the moment, but that
+                    # it will continue the positioning process once the pencil coordinates are detected once more;
+                    # if the user purposefully chooses to hide the pencil pointer and deactivate figure mode while
+                    # in this state, that allows them to give up on drawing this figure
+                    if figure_cache:
+                        figure_cache.color = (190,190,190)
+
+        timer.lap('draw')
+
+        # lay the canvas (and, when coloring, the grid and numbers, rendered once when the session started) over
+        # the new frame; only the parts of the layers that were drawn on are copied, and only the parts that
+        # changed since the last frame are composited again
+        frame = layers.composite(frame)
+
+        # the figure being positioned (if any) is previewed on top; since every frame starts from a new camera
+        # image, the preview of the last frame is already gone, so this is all it costs, however much is drawn
+        if figure_cache:
+            figure_cache.draw(frame)
+
+        # stream the frame (it's only copied here, it's encoded once for all the viewers on another thread)
+        if stream_server:
+            stream_server.publish(frame)
+        if not use_mouse:
+            for state, pencil_coords in zip(pens, pen_coords):
+                state.old_coords = pencil_coords
+        timer.lap('render')
+
+        # show frame (with the performance HUD, which is then erased so that it isn't saved with the drawing)
+        if show_hud:
+            hud_lines = timer.hud_lines()
+            hx0, hy0, hx1, hy1 = timer.hud_bounds(hud_lines)
+            under_hud = frame[hy0:hy1, hx0:hx1].copy()
+            timer.draw_hud(frame, hud_lines)
+        display.imshow(camera_window, frame)
+        if show_hud:
+            frame[hy0:hy1, hx0:hx1] = under_hud
+        if use_pipeline:
+            pipeline.mark_displayed(captured_at)
+        timer.lap('imshow')
 
         # wait for a command
-        pressedKey = cv2.waitKey(1) & 0xFF
+        pressedKey = display.waitKey(1)
+        timer.lap('waitKey')
+        timer.end_frame()
+
+        # report the saves that finished since the last frame
+        for saved_path, success, error in saver.poll():
+            print(('Saved ' + saved_path) if success else ('Couldn\'t save ' + saved_path + ': ' + error))
 
         # 'q' key to quit the program
         if pressedKey == ord('q'):
@@ -196,31 +432,71 @@ def main():
 
         # change pencil color
         elif pressedKey==ord('r'):
-            draw_color = (0,0,255)
+            pen.color = (0,0,255)
         elif pressedKey==ord('g'):
-            draw_color = (0,255,0)
+            pen.color = (0,255,0)
         elif pressedKey==ord('b'):
-            draw_color = (255,0,0)
+            pen.color = (255,0,0)
 
         # change pencil thickness
         elif pressedKey==ord('-'):
-            if draw_thickness > 1:
-                draw_thickness -= 4
+            if pen.thickness > 1:
+                pen.thickness -= 4
         elif pressedKey==ord('+'):
-            if draw_thickness < 40:
-                draw_thickness += 4
+            if pen.thickness < 40:
+                pen.thickness += 4
+
+        # select the next pen (the one the keys act on); the figure being positioned, if any, is dropped
+        elif pressedKey==ord('p') and len(pens) > 1:
+            pen = pens[(pens.index(pen) + 1) % len(pens)]
+            figure_mode = None
+            figure_cache = None
+            print('Selected ' + pen.name)
         
-        # clear canvas
+        # clear canvas (of every pen)
         elif pressedKey==ord('c'):
-            draw_moves = []
-            old_pencil_coords = (None,None)
+            for state in pens:
+                state.history.clear()
+                state.old_coords = (None,None)
+
+        # toggle the performance HUD
+        elif pressedKey==ord('h'):
+            show_hud = not show_hud
+
+        # undo/redo the last stroke
+        elif pressedKey==ord('z'):
+            pen.history.undo()
+            pen.old_coords = (None,None)
+        elif pressedKey==ord('y'):
+            pen.history.redo()
+            pen.old_coords = (None,None)
+
+        # pan and zoom the virtual canvas (by a quarter of the frame, or by a factor of the square root of 2)
+        elif args['infinite'] and pressedKey in [ord(k) for k in 'ijkl[]0']:
+            if pressedKey==ord('0'):
+                viewport.reset()
+            elif pressedKey in [ord('['), ord(']')]:
+                viewport.zoom_by(1 if pressedKey==ord(']') else -1)
+            else:
+                dx = {ord('j'): -1, ord('l'): 1}.get(pressedKey, 0) * (viewport.width // 4)
+                dy = {ord('i'): -1, ord('k'): 1}.get(pressedKey, 0) * (viewport.height // 4)
+                viewport.move(dx, dy)
+            # the strokes being drawn can't go on from where they were on the screen
+            for state in pens:
+                state.history.refresh()
+                state.history.draw(None)
+                state.old_coords = (None,None)
 
         # save image
         elif pressedKey==ord('w'):
             today = datetime.now()
             formatted_date = today.strftime("%a_%b_%d_%H:%M:%S")
-            image_name = 'drawing_' + formatted_date + '.png'
-            cv2.imwrite(image_name, frame)
+            image_name = 'drawing_' + formatted_date
+            if args['save_canvas']:
+                drawing.update()
+                saver.save(image_name, drawing.image, drawing.alpha)
+            else:
+                saver.save(image_name, frame)
 
         # draw figure
         elif pressedKey==ord('s') or pressedKey==ord('e') or pressedKey==ord('o'):
@@ -228,12 +504,11 @@ def main():
             # determine which figure it is
             figure = 'square' if pressedKey==ord('s') else ('ellipse' if pressedKey==ord('e') else 'circle')
 
-            # if we were previously drawing another type of figure, we clean the figure cache and remove
-            # the previous figure from draw_moves; this code will also execute if we were previously
-            # free drawing, but it doesn't make a difference
+            # if we were previously drawing another type of figure, we clean the figure cache, which
+            # discards the previous figure; this code will also execute if we were previously free
+            # drawing, but it doesn't make a difference
             if figure_mode!=figure:
                 figure_cache = None
-                draw_moves = draw_moves[:-1]
 
             # if we were already in the correct figure's drawing mode for the pressed key, we set figure_mode
             # to None because it means we're pressing the figure's key for a second time (a.k.a. the user is
@@ -241,13 +516,13 @@ def main():
             # press
             figure_mode = figure if (figure_mode!=figure) else None
 
-            # if we just finished positioning a figure, we clean the cache
+            # if we just finished positioning a figure, we commit it to the canvas and clean the cache
             if figure_mode != figure:
 
                 # if we have a grey figure and the figure mode is deactivated, it means the user gave up on
-                # drawing that figure, and thus we also remove it from the draw_moves list
-                if figure_cache and figure_cache.color == (190,190,190):
-                    draw_moves = draw_moves[:-1]
+                # drawing that figure, and thus it is simply dropped instead of being committed
+                if figure_cache and figure_cache.color != (190,190,190):
+                    pen.history.draw(figure_cache)
 
                 figure_cache = None
 
@@ -258,12 +533,13 @@ def main():
             if not color_zones:
 
                 # clear canvas
-                draw_moves = []
-                old_pencil_coords = (None,None)
+                for state in pens:
+                    state.history.clear()
+                    state.old_coords = (None,None)
 
                 # compute the grid (division into zones) and correlation between the numbers are the 
                 # colors they represent
-                zones, numbers_to_colors = getgrid(frame)
+                zones, zone_map, numbers_to_colors = getgrid(frame)
                 num_zones = len(zones) # number of coloring zones
 
                 # create array of random numbers between 1 and 3, with as many numbers as there are
@@ -273,15 +549,115 @@ def main():
                 for _ in range(num_zones):
                     color_numbers.append(randint(1,3)) # we have three colors
 
+                # render the grid and numbers that will be laid over every frame of the session
+                overlay = grid_overlay(frame.shape, zones, color_numbers)
+                layers = LayerStack(frame.shape, [overlay, drawing])
+
+                # setting up the window the coloring accuracy
+                color_window = 'Color map'
+                display.namedWindow(color_window, cv2.WINDOW_NORMAL)
+                display.resizeWindow(color_window, (300,350))
+                display.moveWindow(color_window, 800, 600)
+
+                # show the colors to be used (this doesn't change during the session, so the window keeps
+                # showing it until the accuracy is calculated)
+                stats = colorswindow(numbers_to_colors)
+                display.imshow(color_window, stats)
+
             else:
-                accuracy = calc_accuracy(frame, zones, color_numbers, numbers_to_colors)
-                stats = colorswindow(numbers_to_colors, accuracy)
-                cv2.imshow(color_window, stats)
+                layers = drawing
+                accuracy, zone_accuracies, color_accuracies = calc_accuracy(frame, zone_map, color_numbers, numbers_to_colors)
+                stats = colorswindow(numbers_to_colors, accuracy, color_accuracies)
+                print('Coloring accuracy: ' + str(accuracy) + '%')
+                for i in range(num_zones):
+                    print('  zone ' + str(i+1) + ' (number ' + str(color_numbers[i]) + '): ' + str(zone_accuracies[i]) + '%')
+                display.imshow(color_window, stats)
 
             # update the mode indicator
             color_zones = not color_zones
 
+        # log the changes of pencil and mode made on this frame
+        if session_log:
+            if pen.color != logged_state['color']:
+                session_log.color(pen.color)
+            if pen.thickness != logged_state['thickness']:
+                session_log.thickness(pen.thickness)
+            if figure_mode != logged_state['figure']:
+                if logged_state['figure']:
+                    session_log.mode(logged_state['figure'], False)
+                if figure_mode:
+                    session_log.mode(figure_mode, True)
+            if color_zones != logged_state['coloring']:
+                session_log.mode('coloring', color_zones)
+            logged_state = {'color': pen.color, 'thickness': pen.thickness, 'figure': figure_mode, 'coloring': color_zones}
+            session_log.end_frame()
+
+    if session_log:
+        session_log.close()
+
+    # wait for the pending saves
+    saver.close()
+    for saved_path, success, error in saver.poll():
+        print(('Saved ' + saved_path) if success else ('Couldn\'t save ' + saved_path + ': ' + error))
+
+    # save the final canvas (with its alpha mask as the transparency channel)
+    if output_dir:
+        makedirs(output_dir, exist_ok=True)
+        drawing.update()
+        cv2.imwrite(path.join(output_dir, 'canvas.png'), cv2.merge((*cv2.split(drawing.image), drawing.alpha*255)))
+
+    # export the timings of the session
+    if args['trace']:
+        timer.export(args['trace'])
+        print('Frame timings written to ' + args['trace'])
+
+    # report how much the drawing history was compressed (and, on the virtual canvas, how big the drawing is)
+    for state in pens:
+        if args['infinite']:
+            print('Virtual canvas' + (' of ' + state.name if len(pens) > 1 else '') + ': ' + \
+                str(state.history.strokes()) + ' strokes (' + str(state.history.rendered_tiles) + ' tiles rendered, ' + \
+                str(state.history.erased_strokes) + ' erased to keep under the memory cap)')
+        state.draw_moves.simplify()
+        print('Drawing history' + (' of ' + state.name if len(pens) > 1 else '') + ': ' + \
+            str(state.draw_moves.raw_points) + ' points drawn, ' + str(len(state.draw_moves)) + \
+            ' stored (' + str(round(state.draw_moves.compression_ratio(), 1)) + 'x compression)')
+
+    # report the mouse events that came faster than they were drained
+    if use_mouse and mouse.dropped:
+        print('Mouse events lost: ' + str(mouse.dropped))
+
+    # report how the pipeline did
+    if use_pipeline:
+        pipeline.stop()
+        pipeline_stats = pipeline.stats()
+        print('Frames captured: ' + str(pipeline_stats['captured']) + ', displayed: ' + str(pipeline_stats['displayed']))
+        print('Frames dropped before processing: ' + str(pipeline_stats['dropped_before_processing']) + \
+            ', before display: ' + str(pipeline_stats['dropped_before_display']))
+        print('Mean capture-to-display latency: ' + str(round(pipeline_stats['mean_latency_ms'], 1)) + ' ms')
+
+    # report how often the pencil tracker found the pencil without searching the whole frame
+    if isinstance(detector, PencilTracker):
+        tracker_stats = detector.stats()
+        print('Pencil found in the search window on ' + str(tracker_stats['roi_hits']) + ' of ' + \
+            str(tracker_stats['frames']) + ' frames (' + str(round(tracker_stats['roi_hit_rate'] * 100, 1)) + \
+            '% hit rate), with ' + str(tracker_stats['roi_searches']) + ' window searches and ' + \
+            str(tracker_stats['full_searches']) + ' full-frame searches')
+
+    # report how the viewers of the stream kept up
+    if stream_server:
+        stream_server.close()
+        stream_stats = stream_server.stats()
+        print('Frames streamed: ' + str(stream_stats['encoded']) + ' of ' + str(stream_stats['published']) + ' published')
+        for client in stream_stats['clients']:
+            print('  ' + client['address'] + ': ' + str(client['sent']) + ' frames sent, ' + str(client['skipped']) + \
+                ' skipped, mean lag ' + str(round(client['lag_ms_mean'], 1)) + ' ms (max ' + \
+                str(round(client['lag_ms_max'], 1)) + ' ms)')
+
+    # stop the detection workers (if any)
+    if isinstance(detector, (BlobDetector, MultiPenDetector)):
+        detector.close()
+
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
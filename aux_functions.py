@@ -1,6 +1,6 @@
 import cv2
 import numpy as np
-from classes import Circle, Dot, Ellipse, Line, Square
+from classes import Canvas, Dot, Line
 from random import randint, shuffle
 
 # This file contains auxiliary functions used in the color_segmenter.py and ar_paint.py scripts.
@@ -19,7 +19,7 @@ def update_range_dict(val,ranges,color,bound):
             - val: new trackbar value, resulting from end-user's manipulation of the
                 interface's trackbars
             - ranges: the dictionary holding the valid RBG ranges
-            - color: the color channel that needs to be altered (so, either 'R', 'G' or 'B')
+            - color: the color channel that needs to be altered (so, either 'R', 'G' or 'B', or 'H', 'S' or 'V')
             - bound: the bound that needs to be altered (so, either 'min' or 'max')
     """
     ranges[color][bound] = val
@@ -29,6 +29,72 @@ def update_range_dict(val,ranges,color,bound):
 #                       AR PAINT
 # -----------------------------------------------------
 
+def find_biggest_blob(mask):
+    """
+    function 'find_biggest_blob': finds the largest color segment of a mask, as well as its centroid
+        INPUT:
+            - mask: a binary image where a color segmentation mask has been applied (see get_centroid_position)
+        OUTPUT:
+            - cnt: the contour of the biggest object (white blob) in the 'mask' input, or None if there are no
+                objects
+            - (cX, cY): the X and Y coordinates (respectively) of its centroid, or (None, None) if there are no
+                        objects or the biggest one has no area
+    """
+
+    # find all contours (objects)
+    cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+    if not cnts:
+        return None, (None, None)
+
+    # find the biggest object
+    cnt = max(cnts, key=cv2.contourArea)
+
+    # calculate centroid coordinates
+    M = cv2.moments(cnt)
+    cX = int(M["m10"] / M["m00"]) if (M["m00"]!=0) else None
+    cY = int(M["m01"] / M["m00"]) if (M["m00"]!=0) else None
+
+    return cnt, (cX, cY)
+
+
+def draw_detection(mask, cnt, centroid):
+    """
+    function 'draw_detection': builds the image that shows the detected objects of a mask
+        INPUT:
+            - mask: a binary image where a color segmentation mask has been applied
+            - cnt: the contour of the biggest object in the mask, or None if there are no objects
+            - centroid: the centroid of that object
+        OUTPUT:
+            - final_image: an RGB image with all the detected objects in the 'mask' input; the biggest object is
+                        colored green, whereas all the other ones remain white; a red cross is placed in the
+                        position of the centroid
+    """
+
+    # the mask as it is, with all objects in white
+    final_image = cv2.merge((mask, mask, mask))
+
+    # if we don't detect any objects, that's all
+    if cnt is None:
+        return final_image
+
+    # make the biggest object green (but still show other objects in white), which only changes the blue and red
+    # channels inside its bounding box
+    x, y, w, h = cv2.boundingRect(cnt)
+    biggest_obj = np.zeros((h, w), np.uint8)
+    cv2.drawContours(biggest_obj, [cnt], -1, 255, cv2.FILLED, offset=(-x, -y))
+    all_other_objs = cv2.bitwise_and(mask[y:y+h, x:x+w], cv2.bitwise_not(biggest_obj)) # all other objects except the biggest one
+    final_image[y:y+h, x:x+w, 0] = all_other_objs
+    final_image[y:y+h, x:x+w, 2] = all_other_objs
+
+    # draw small red cross to indicate the centroid point
+    cX, cY = centroid
+    if cX is not None: # it's enough to check either cX or cY, if one is None then both are None
+        cv2.line(final_image, (cX-8, cY-8), (cX+8, cY+8), (0, 0, 255), 5)
+        cv2.line(final_image, (cX+8, cY-8), (cX-8, cY+8), (0, 0, 255), 5)
+
+    return final_image
+
+
 def get_centroid_position(mask):
     """
     function 'get_centroid_position': analyses the result of a mask being applied to an image (the result being
@@ -47,44 +113,23 @@ def get_centroid_position(mask):
                         remain white; a red cross is placed in the position of the centroid
     """
 
-    # find all contours (objects)
-    cnts, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
-    
-    # if we detect objects, let's find the biggest one, make it green and calculate the centroid
-    if cnts:
-
-        # find the biggest object
-        cnt = max(cnts, key=cv2.contourArea)
-
-        # make it green (but still show other objects in white)
-        biggest_obj = np.zeros(mask.shape, np.uint8)
-        cv2.drawContours(biggest_obj, [cnt], -1, 255, cv2.FILLED)
-        biggest_obj = cv2.bitwise_and(mask, biggest_obj) # mask-like image with only the biggest object
-        all_other_objs = cv2.bitwise_xor(mask, biggest_obj) # all other objects except the biggest one
-        
-        b = all_other_objs
-        g = mask
-        r = all_other_objs
-
-        final_image = cv2.merge((b, g, r))
-
-        # calculate centroid coordinates
-        M = cv2.moments(cnt)
-        cX = int(M["m10"] / M["m00"]) if (M["m00"]!=0) else None
-        cY = int(M["m01"] / M["m00"]) if (M["m00"]!=0) else None
-
-        # draw small red cross to indicate the centroid point
-        if cX: # it's enough to check either cX or cY, if one is None then both are None
-            cv2.line(final_image, (cX-8, cY-8), (cX+8, cY+8), (0, 0, 255), 5)
-            cv2.line(final_image, (cX+8, cY-8), (cX-8, cY+8), (0, 0, 255), 5)
-
-    # if we don't detect any objects, we just show the mask as it is
-    else:
-        final_image = cv2.merge((mask, mask, mask))
-        cX = None
-        cY = None
-        
-    return (cX,cY), final_image
+    cnt, centroid = find_biggest_blob(mask)
+    return centroid, draw_detection(mask, cnt, centroid)
+
+
+def detect_pencil(image, ranges):
+    """
+    function 'detect_pencil': applies the color segmentation mask to a camera frame and finds the pencil in it;
+                        this is all the per-frame work that doesn't depend on the drawing state, which is
+                        why the pipeline runs it on its own thread
+        INPUT:
+            - image: camera frame
+            - ranges: the dictionary holding the valid RBG ranges (see apply_mask)
+        OUTPUT:
+            - the same as get_centroid_position
+    """
+
+    return get_centroid_position(apply_mask(image, ranges))
 
 
 def get_mouse_position(mouse):
@@ -100,13 +145,21 @@ def get_mouse_position(mouse):
                         coordinates
     """
 
-    final_image = np.zeros([720,1280,3],dtype=np.uint8) # black screen
+    # black screen, allocated once and then reused (only the last cross is erased)
+    if mouse.view is None:
+        mouse.view = np.zeros([720,1280,3],dtype=np.uint8)
+    elif mouse.view_cross is not None:
+        x, y = mouse.view_cross
+        mouse.view[max(0, y-12):y+13, max(0, x-12):x+13] = 0
+    final_image = mouse.view
+
     cX = mouse.coords[0]
     cY = mouse.coords[1]
     # drawing the red cross
     if cX:
         cv2.line(final_image, (cX-8, cY-8), (cX+8, cY+8), (0, 0, 255), 5)
         cv2.line(final_image, (cX+8, cY-8), (cX-8, cY+8), (0, 0, 255), 5)
+    mouse.view_cross = (cX, cY) if cX else None
     return (cX,cY), final_image
 
 
@@ -153,26 +206,21 @@ def new_draw_move(old_coords, coords, color, thickness, usp):
 
 def redraw_on_frame(image, draw_moves):
     """
-    function redraw_on_frame: re-draws all the user's move history on the newly capture camera frame
+    function redraw_on_frame: re-draws a list of moves on the newly captured camera frame; this is the legacy
+                        full-replay path, kept for benchmarking (see benchmark.py): committed moves live in a
+                        Canvas (see classes.py) and are never replayed, and the figure being positioned is
+                        drawn on its own by ar_paint.py
         INPUT:
             - image:      canvas on which to draw (that being the new camera frame)
-            - draw_moves: history of drawing moves performed by the user
+            - draw_moves: list of drawing moves to draw on the image
         OUTPUT:
             - image: altered canvas, already with the drawings on it
     """
 
     for move in draw_moves:
-        # draw on image
-        if type(move) is Dot:
-            cv2.circle(image, move.coords, move.thickness, move.color, -1)
-        elif type(move) is Line:
-            cv2.line(image, (move.old_coords[0], move.old_coords[1]), (move.coords[0], move.coords[1]), move.color, move.thickness)
-        elif type(move) is Square:
-            cv2.rectangle(image, move.origin, move.end_point, move.color, move.thickness)
-        elif type(move) is Ellipse:
-            cv2.ellipse(image, move.center, move.axes, move.angle, move.startAngle, move.endAngle, move.color, move.thickness)
-        elif type(move) is Circle:
-            cv2.circle(image, move.origin, move.radius, move.color, move.thickness)
+        # draw on image (None moves are gaps between strokes)
+        if move is not None:
+            move.draw(image)
     return image
 
 
@@ -185,6 +233,10 @@ def getgrid(image):
             - image: original image, we will use its dimensions to figure out the coloring grid
         OUTPUT:
             - contours: the coloring zones the image is divided into
+            - zone_map: the zone label map, an integer image with the same size as 'image' where each pixel
+                        holds i+1 if it belongs to the zone contours[i], or 0 if it belongs to no zone (the
+                        grid lines); it is built once here so that the accuracy can be computed with a few
+                        vectorized operations, whatever the shape of the zones
             - numbers_to_colors: a list of colors; the index i of a color in this list means that, in the zone
                                 coloring mode, that color corresponds to zones with the number i+1
     """
@@ -207,10 +259,17 @@ def getgrid(image):
     # contours of each zone
     contours, _ = cv2.findContours(grid, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
 
+    # label map: fill each zone with its label, then clear the grid lines (the filled contours include
+    # their own border pixels, which lie on the white zone pixels, so only the lines themselves are zeroed)
+    zone_map = np.zeros([h,w],dtype=np.int32)
+    for i in range(len(contours)):
+        cv2.drawContours(zone_map, contours, i, i+1, cv2.FILLED)
+    zone_map[grid==0] = 0
+
     numbers_to_colors = [(0,0,255), (0,255,0), (255,0,0)]
     shuffle(numbers_to_colors)
 
-    return contours, numbers_to_colors
+    return contours, zone_map, numbers_to_colors
 
 
 def findcontours(original, contours, numbers):
@@ -242,7 +301,29 @@ def findcontours(original, contours, numbers):
     return cv2.drawContours(original, contours, -1, color, 3)
 
 
-def colorswindow(numbers_to_colors, accuracy=None):
+def grid_overlay(shape, contours, numbers):
+    """
+    function grid_overlay: renders the coloring grid and zone numbers once into a drawing layer, so that they can
+                        be laid over each frame of a coloring session with a single masked copy instead of being
+                        drawn again every frame
+        INPUT:
+            - shape: shape of the frames the overlay is for
+            - contours: grid to be applied
+            - numbers: array of random numbers distributed among the zones
+        OUTPUT:
+            - overlay: a Canvas with the grid and numbers (see findcontours) drawn on it
+    """
+
+    overlay = Canvas(shape)
+    findcontours(overlay.image, contours, numbers)
+    # the grid and numbers are white, so any channel tells where they were drawn
+    overlay.alpha[:] = overlay.image[:,:,0] > 0
+    x, y, w, h = cv2.boundingRect(overlay.alpha)
+    overlay.mark_dirty((x, y, x + w, y + h))
+    return overlay
+
+
+def colorswindow(numbers_to_colors, accuracy=None, color_accuracies=None):
     """
     function colorswindow: works out what to display on the small colors window for the zone coloring mode,
                         where it informs the user which number corresponds to which color, and eventually the
@@ -251,6 +332,8 @@ def colorswindow(numbers_to_colors, accuracy=None):
             - numbers_to_colors: a list of colors; the index i of a color in this list means that, in the zone
                                 coloring mode, that color corresponds to zones with the number i+1
             - accuracy: the accuracy of the last coloring, to be displayed on the small colors window
+            - color_accuracies: the accuracy of the last coloring for each color number (as returned by
+                                calc_accuracy), displayed next to each color
         OUTPUT:
             - bg: final image to be displayed on the colors window
     """
@@ -259,7 +342,10 @@ def colorswindow(numbers_to_colors, accuracy=None):
 
     for i in range(3):
         color = 'red' if numbers_to_colors[i]==(0,0,255) else ('green' if numbers_to_colors[i]==(0,255,0) else 'blue')
-        cv2.putText(bg, str(i+1) + ' - ' + color, (50, 50+50*i), cv2.FONT_HERSHEY_SIMPLEX, 0.9, numbers_to_colors[i], 2)
+        text = str(i+1) + ' - ' + color
+        if color_accuracies is not None and color_accuracies[i] is not None:
+            text += ': ' + str(color_accuracies[i]) + '%'
+        cv2.putText(bg, text, (50, 50+50*i), cv2.FONT_HERSHEY_SIMPLEX, 0.9, numbers_to_colors[i], 2)
 
     if accuracy!=None:
         cv2.putText(bg, 'Accuracy: ' + str(accuracy) + '%', (50, 250), cv2.FONT_HERSHEY_SIMPLEX, 0.9, (255,255,255), 2)
@@ -267,53 +353,64 @@ def colorswindow(numbers_to_colors, accuracy=None):
     return bg
 
 
-def calc_accuracy(image, contours, zone_numbers, numbers_to_colors):
+def calc_accuracy(image, zone_map, zone_numbers, numbers_to_colors):
     """
     function calc_accuracy: calculates the accuracy of a given coloring in the zones coloring mode
         INPUT:
             - image: the painted frame which we want to examine for the accuracy of its painting
-            - contours: the zones into which the initial frame was divided for coloring
+            - zone_map: the zone label map computed by getgrid (pixel value i+1 means zone i, 0 means no zone)
             - zone_numbers: the numbers randomly attributed to each zone
             - numbers_to_colors: a list of colors; the index i of a color in this list means that, in the zone
                                 coloring mode, that color corresponds to zones with the number i+1
         OUTPUT:
-            - [return value]: final accuracy value, rounded to be an int
+            - accuracy: final accuracy value (correctly colored pixels over all the pixels in the image),
+                        rounded to be an int
+            - zone_accuracies: list with the accuracy of each zone (correctly colored pixels of the zone over
+                            the pixels of the zone), rounded to be ints
+            - color_accuracies: list with the accuracy of each color number (correctly colored pixels over the
+                            pixels of all the zones with that number), rounded to be ints, or None for the
+                            numbers that were not given to any zone
     """
 
     h,w,_ = image.shape
     total_pixels = h*w
+    num_zones = len(zone_numbers)
 
-    right_pixels = 0 # this will hold the number of pixels with the correct color
-    # for each zone...
-    for i in range(len(contours)):
+    # painted color number of each pixel (0 if the pixel isn't painted with any of the coloring colors)
+    painted = np.zeros([h,w],dtype=np.int32)
+    for i, color in enumerate(numbers_to_colors):
+        painted[cv2.inRange(image, color, color) > 0] = i+1
 
-        c = contours[i]                             # the zone
-        zone_number = zone_numbers[i]               # the zone number
-        color = numbers_to_colors[zone_number-1]    # the zone color
+    # expected color number of each pixel, looked up from its zone label (0 outside the zones)
+    expected = np.zeros(num_zones+1, dtype=np.int32)
+    expected[1:] = zone_numbers
+    expected = expected[zone_map]
 
-        # corners of this zone (zones are always rectangles)
-        minX = c[0][0][0]
-        maxX = c[2][0][0]
-        minY = c[0][0][1]
-        maxY = c[1][0][1]
+    # a pixel is right if it's inside a zone and painted with that zone's color
+    right = (painted == expected) & (zone_map > 0)
 
-        _,_,depth = image.shape
+    # per zone counts of pixels (index 0 is the grid lines and is ignored)
+    zone_pixels = np.bincount(zone_map.ravel(), minlength=num_zones+1)[1:]
+    zone_right = np.bincount(zone_map[right], minlength=num_zones+1)[1:]
+    zone_accuracies = [int((r/p)*100) if p else 0 for r, p in zip(zone_right, zone_pixels)]
 
-        # evaluate each pixel
-        for pixel_row in image[minY:maxY, minX:maxX, 0:depth]:
-            for pixel in pixel_row:
-                pixel = (pixel[0], pixel[1], pixel[2])
-                right_pixels += 1 if pixel==color else 0
+    # per color counts, grouping the zones by the number they were given
+    numbers = np.asarray(zone_numbers)
+    color_accuracies = []
+    for n in range(1, len(numbers_to_colors)+1):
+        pixels = zone_pixels[numbers == n].sum()
+        color_accuracies.append(int((zone_right[numbers == n].sum()/pixels)*100) if pixels else None)
 
     # compute accuracy
-    return int((right_pixels/total_pixels)*100)
+    accuracy = int((int(zone_right.sum())/total_pixels)*100)
+    return accuracy, zone_accuracies, color_accuracies
 
 
 # -----------------------------------------------------
 #                         BOTH
 # -----------------------------------------------------
 
-def apply_mask(image, ranges):
+def apply_mask(image, ranges, mask=None):
     """
     function apply_mask: applies a color segmentation mask to an image
         INPUT:
@@ -321,6 +418,8 @@ def apply_mask(image, ranges):
             - ranges: this is basically the mask itself, except instead of being a binary image with which
                     we would perform a logical operation to the original image, it is a dictionary
                     indicating the valid ranges of values for each of the color channels - R, G and B
+            - mask: image of the same size as 'image' (single channel, uint8) to write the result into, so that
+                    no new image is allocated; if None, a new one is created
         OUTPUT:
             - [return value]: a binary image where the white pixels represent pixels in the original image
                             that stood within the valid ranges for all three color channels, whereas black
@@ -331,4 +430,4 @@ def apply_mask(image, ranges):
 
     lows = (ranges['B']['min'], ranges['G']['min'], ranges['R']['min'])
     highs = (ranges['B']['max'], ranges['G']['max'], ranges['R']['max'])
-    return cv2.inRange(image, lows, highs)
+    return cv2.inRange(image, lows, highs, mask)
@@ -0,0 +1,261 @@
+import cv2
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from math import ceil
+from os import path, makedirs
+
+from classes import Canvas
+from aux_functions import apply_mask, find_biggest_blob, new_draw_move
+from camera import fourcc_name
+from headless import open_source
+from segmentation import read_pens
+
+# This file contains the batch renderer, which paints recorded sessions (video files or image sequence
+# directories) offline, with no one at the keyboard: the pencil is found on every frame as in ar_paint.py, and
+# each video gets a painted copy, with the drawing laid over its frames, and its final drawing as a PNG. The
+# videos are processed in parallel on a pool of worker processes; the pencil search of each video is split into
+# chunks of frames, which are also processed in parallel, and the strokes are then put together in order.
+# Only videos whose frames are each compressed on their own (e.g. Motion JPEG) and image sequences are split into
+# chunks: OpenCV can only seek exactly to a frame of those, so the others (e.g. H.264) are searched in one go.
+
+
+# frames per pencil search chunk
+DEFAULT_CHUNK = 300
+
+# codec of the painted videos (Motion JPEG, which every OpenCV build can write)
+VIDEO_FOURCC = 'MJPG'
+
+# codecs (as FourCC codes, in upper case) without inter-frame compression, which can be seeked exactly
+INTRA_FOURCCS = {'MJPG', 'JPEG', 'AVRN', 'PNG ', 'MPNG', 'I420', 'IYUV', 'YUY2', 'YUYV', 'UYVY', 'RGBA', 'BGR ',
+                 'RGB ', 'DIB ', 'RAW ', 'Y800', 'GREY'}
+
+
+def init_worker():
+    # each worker process takes a core: OpenCV's own threads would only compete with the other workers
+    cv2.setNumThreads(1)
+
+
+def source_info(source):
+    """
+    function source_info: returns the number of frames (0 if the source doesn't tell) and the frame rate (30 if
+                        the source doesn't tell) of a video source, and whether it can be seeked exactly (it's an
+                        image sequence or a video with a codec in INTRA_FOURCCS), or None if it can't be opened
+    """
+
+    capture = open_source(source)
+    if not capture.isOpened():
+        return None
+    count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30
+    fourcc = fourcc_name(capture.get(cv2.CAP_PROP_FOURCC))
+    capture.release()
+    seekable = path.isdir(source) or (fourcc is not None and fourcc.upper() in INTRA_FOURCCS)
+    return max(0, count), fps, seekable
+
+
+def find_pencil(source, ranges, start, count):
+    """
+    function find_pencil: finds the pencil on a chunk of the frames of a video source (in a worker process)
+        INPUT:
+            - source: path of the video file or image sequence directory
+            - ranges: the dictionary holding the valid RBG ranges (see apply_mask)
+            - start: index of the first frame of the chunk
+            - count: number of frames of the chunk, or None to go on until the source runs out of frames
+        OUTPUT:
+            - coords: list with the position of the pencil on each frame read ((None, None) where it wasn't found)
+            - [return value]: CPU time taken, in seconds
+    """
+
+    cpu_start = time.process_time()
+    capture = open_source(source)
+
+    # if the source doesn't land exactly on the first frame of the chunk, it's read again from the start, and
+    # every frame up to the chunk is decoded and thrown away
+    if start:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        if int(capture.get(cv2.CAP_PROP_POS_FRAMES)) != start:
+            capture.release()
+            capture = open_source(source)
+            for _ in range(start):
+                if not capture.grab():
+                    break
+
+    coords = []
+    frame = None
+    mask = None
+    while count is None or len(coords) < count:
+        ret, frame = capture.read(frame)
+        if not ret:
+            break
+        mask = apply_mask(frame, ranges, mask)
+        _, centroid = find_biggest_blob(mask)
+        coords.append(centroid)
+    capture.release()
+    return coords, time.process_time() - cpu_start
+
+
+def assemble_moves(coords, color, thickness, usp):
+    """
+    function assemble_moves: turns the pencil positions of a whole video, in order, into the draw move of each
+                        frame, as the main loop of ar_paint.py does
+        OUTPUT:
+            - [return value]: list with the draw move of each frame (None where nothing is drawn)
+    """
+
+    moves = []
+    old_coords = (None, None)
+    for pencil_coords in coords:
+        moves.append(new_draw_move(old_coords, pencil_coords, color, thickness, usp))
+        old_coords = pencil_coords
+    return moves
+
+
+def paint_video(source, moves, video_path, image_path, fps):
+    """
+    function paint_video: draws the moves of a video on a canvas, one per frame, and writes every frame with the
+                        drawing laid over it, along with the final drawing (with transparency) (in a worker
+                        process)
+        INPUT:
+            - source: path of the video file or image sequence directory
+            - moves: the draw move of each frame (see assemble_moves)
+            - video_path: path of the painted video
+            - image_path: path of the final drawing
+            - fps: frame rate of the painted video
+        OUTPUT:
+            - frames: number of frames written
+            - [return value]: CPU time taken, in seconds
+    """
+
+    cpu_start = time.process_time()
+    capture = open_source(source)
+    canvas = None
+    writer = None
+    frames = 0
+    frame = None
+    for move in moves:
+        ret, frame = capture.read(frame)
+        if not ret:
+            break
+        if canvas is None:
+            canvas = Canvas(frame.shape)
+            writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*VIDEO_FOURCC), fps,
+                                     (frame.shape[1], frame.shape[0]))
+        canvas.draw(move)
+        writer.write(canvas.composite(frame))
+        frames += 1
+    capture.release()
+
+    if canvas is not None:
+        writer.release()
+        cv2.imwrite(image_path, cv2.merge((*cv2.split(canvas.image), canvas.alpha*255)))
+    return frames, time.process_time() - cpu_start
+
+
+def main():
+    """
+    function main: paints every video given, reporting how long each took and the overall throughput
+    """
+
+    parser = argparse.ArgumentParser(description='PSR Augmented Reality Paint - Batch Renderer')
+    parser.add_argument('-i', '--inputs', nargs='+', required=True, help='video files or image sequence directories to paint')
+    parser.add_argument('-j', '--json', type=str, default='limits.json', help='provide the path to the .json file with the color data (its first pen is used)')
+    parser.add_argument('-o', '--output', type=str, default='batch_output', help='directory where the painted videos and final drawings are written')
+    parser.add_argument('-w', '--workers', type=int, default=0, help='number of worker processes (0 for one per CPU core)')
+    parser.add_argument('-ch', '--chunk', type=int, default=DEFAULT_CHUNK, help='number of frames in each chunk of the pencil search')
+    parser.add_argument('-usp', '--use_shake_prevention', action='store_true', help='use shake prevention while drawing')
+    parser.add_argument('-th', '--thickness', type=int, default=5, help='pencil thickness')
+    args = vars(parser.parse_args())
+
+    if args['chunk'] < 1:
+        sys.exit('The chunks must have at least one frame.')
+    try:
+        pen = read_pens(args['json'])[0]
+    except FileNotFoundError:
+        sys.exit('The .json file with the color data doesn\'t exist.')
+    except (KeyError, ValueError) as error:
+        sys.exit('Couldn\'t read the color data: ' + str(error))
+    if pen['space'] != 'bgr':
+        sys.exit('The batch renderer only works with a pen segmented in RGB.')
+
+    # the videos, with their frame count and rate and whether they can be split into chunks (those that can't be
+    # opened are left out); videos with the same name (from different directories) get a number after it, so
+    # that their outputs don't overwrite each other
+    videos = []
+    names = set()
+    for source in args['inputs']:
+        info = source_info(source)
+        if info is None:
+            print('Couldn\'t open ' + source + ', skipping it')
+            continue
+        base_name = name = path.splitext(path.basename(path.normpath(source)))[0]
+        copy = 1
+        while name in names:
+            copy += 1
+            name = base_name + '_' + str(copy)
+        names.add(name)
+        if name != base_name:
+            print('The outputs of ' + source + ' are named ' + name)
+        videos.append({'source': source, 'name': name, 'frames': info[0], 'fps': info[1], 'seekable': info[2]})
+    if not videos:
+        sys.exit('There are no videos to paint.')
+    makedirs(args['output'], exist_ok=True)
+
+    workers = args['workers'] or os.cpu_count() or 1
+    start = time.perf_counter()
+    search_cpu = paint_cpu = 0
+    total_frames = 0
+    with ProcessPoolExecutor(workers, initializer=init_worker) as pool:
+
+        # the pencil search of every video is split into chunks (the last one goes on until the video ends, in
+        # case it has more frames than it says), all of them queued at once; the videos that can't be seeked
+        # exactly are searched in a single chunk
+        tasks = {}
+        for video in videos:
+            chunks = max(1, ceil(video['frames'] / args['chunk'])) if video['seekable'] else 1
+            video['chunks'] = [None] * chunks
+            for k in range(chunks):
+                count = args['chunk'] if k < chunks - 1 else None
+                future = pool.submit(find_pencil, video['source'], pen['limits'], k * args['chunk'], count)
+                tasks[future] = (video, k)
+
+        # once all the chunks of a video are in, its strokes are put together in order and it's painted
+        pending = set(tasks)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                video, k = tasks.pop(future)
+                if k is not None:
+                    video['chunks'][k], cpu = future.result()
+                    search_cpu += cpu
+                    if all(chunk is not None for chunk in video['chunks']):
+                        coords = [c for chunk in video['chunks'] for c in chunk]
+                        moves = assemble_moves(coords, pen['color'], args['thickness'], args['use_shake_prevention'])
+                        future = pool.submit(paint_video, video['source'], moves,
+                                             path.join(args['output'], video['name'] + '.avi'),
+                                             path.join(args['output'], video['name'] + '.png'), video['fps'])
+                        tasks[future] = (video, None)
+                        pending.add(future)
+                else:
+                    frames, cpu = future.result()
+                    paint_cpu += cpu
+                    total_frames += frames
+                    print('Painted ' + video['name'] + ': ' + str(frames) + ' frames, done after ' + \
+                        str(round(time.perf_counter() - start, 1)) + ' s')
+    elapsed = time.perf_counter() - start
+
+    # throughput overall, and per core (for the whole run, and for each stage from the CPU time it took)
+    print('Painted ' + str(total_frames) + ' frames of ' + str(len(videos)) + ' videos in ' + str(round(elapsed, 1)) + \
+        ' s with ' + str(workers) + ' workers: ' + str(round(total_frames / elapsed, 1)) + ' FPS, ' + \
+        str(round(total_frames / elapsed / workers, 1)) + ' FPS per core')
+    if search_cpu and paint_cpu:
+        print('Per core: pencil search ' + str(round(total_frames / search_cpu, 1)) + ' FPS, painting ' + \
+            str(round(total_frames / paint_cpu, 1)) + ' FPS')
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,679 @@
+import cv2
+import numpy as np
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from math import cos, sin, pi
+
+from classes import Canvas, LayerStack, StrokeStore, Ellipse
+from detection import BlobDetector, BandBlobDetector, PencilTracker, MultiScaleDetector, MultiPenDetector
+from segmentation import new_pen, pen_mask
+from infinite_canvas import Viewport, InfiniteCanvas
+from filters import FILTERS, make_filter
+from aux_functions import \
+    get_centroid_position, \
+    new_draw_move, \
+    redraw_on_frame, \
+    apply_mask, \
+    getgrid, \
+    findcontours, \
+    colorswindow, \
+    calc_accuracy, \
+    grid_overlay, \
+    detect_pencil
+
+# This file contains the benchmark suite for the functions that run on every frame of the ar_paint.py script
+# (and for the end-of-session accuracy calculation); it runs them on synthetic frames with moving colored blobs.
+
+
+# resolutions benchmarked, by name
+RESOLUTIONS = {
+    '480p': (480, 640),
+    '720p': (720, 1280),
+    '1080p': (1080, 1920),
+    '4k': (2160, 3840),
+}
+
+# numbers of draw moves in the history benchmarked for the functions that depend on it
+HISTORY_LENGTHS = [0, 1000, 10000, 100000]
+
+# frame rate used to compute the headroom (how many times a function fits into one frame)
+TARGET_FPS = 30
+
+# color ranges matching the pencil blob drawn on the synthetic frames
+PENCIL_RANGES = {'B': {'min': 0, 'max': 80}, 'G': {'min': 160, 'max': 255}, 'R': {'min': 0, 'max': 80}}
+PENCIL_COLOR = (40, 220, 40)
+# other blobs on the synthetic frames, which the mask must reject
+DISTRACTOR_COLORS = [(200, 60, 60), (60, 60, 200), (200, 200, 200)]
+
+# pens matching the pencil and each of the other blobs, for the multi-pen detection (the red one in HSV, with a
+# hue range that wraps around)
+PENS = [dict(new_pen(i, space), limits=limits) for i, (space, limits) in enumerate([
+    ('bgr', PENCIL_RANGES),
+    ('bgr', {'B': {'min': 160, 'max': 255}, 'G': {'min': 0, 'max': 100}, 'R': {'min': 0, 'max': 100}}),
+    ('hsv', {'H': {'min': 170, 'max': 10}, 'S': {'min': 100, 'max': 255}, 'V': {'min': 120, 'max': 255}}),
+    ('bgr', {'B': {'min': 160, 'max': 255}, 'G': {'min': 160, 'max': 255}, 'R': {'min': 160, 'max': 255}}),
+])]
+
+
+def synthetic_frame(shape, t, seed=0):
+    """
+    function synthetic_frame: draws a synthetic camera frame with a pencil blob and a few distractor blobs, all
+                            moving along circular paths
+        INPUT:
+            - shape: (height, width) of the frame
+            - t: time step, which sets the position of the blobs
+            - seed: seed for the background noise
+        OUTPUT:
+            - frame: the synthetic BGR frame
+    """
+
+    h, w = shape
+    rng = np.random.default_rng(seed + t)
+    frame = rng.integers(0, 60, (h, w, 3), dtype=np.uint8) # dim noisy background
+    radius = max(4, h // 40)
+
+    for i, color in enumerate([PENCIL_COLOR] + DISTRACTOR_COLORS):
+        angle = 2*pi*(t/120 + i/4)
+        center = (int(w/2 + w/3*cos(angle)), int(h/2 + h/3*sin(angle)))
+        cv2.circle(frame, center, radius if i else 2*radius, color, -1)
+
+    return frame
+
+
+def synthetic_path(shape, length):
+    """
+    function synthetic_path: generates the pencil positions of a long drawing session, as a slow wandering path
+        INPUT:
+            - shape: (height, width) of the frame
+            - length: number of positions
+        OUTPUT:
+            - [return value]: list of (x, y) positions, with a (None, None) gap every 200 positions
+    """
+
+    h, w = shape
+    coords = []
+    for i in range(length):
+        if i % 200 == 199:
+            coords.append((None, None))
+            continue
+        angle = i/50
+        coords.append((int(w/2 + (w/3)*cos(angle)*sin(i/977)), int(h/2 + (h/3)*sin(angle*1.3))))
+    return coords
+
+
+def synthetic_history(shape, length):
+    """
+    function synthetic_history: builds a draw move history of the given length with new_draw_move, as the main
+                            loop of ar_paint.py would
+    """
+
+    moves = []
+    old_coords = (None, None)
+    colors = [(0,0,255), (0,255,0), (255,0,0)]
+    for i, coords in enumerate(synthetic_path(shape, length)):
+        moves.append(new_draw_move(old_coords, coords, colors[(i // 500) % 3], 5, False))
+        old_coords = coords
+    return moves
+
+
+def detect_and_release(detector, frame):
+    """
+    function detect_and_release: detects the pencil with a detector and gives its detection output image back
+                            right away, as the main loop of ar_paint.py does once it's been displayed, so that the
+                            same images are reused on every call
+    """
+
+    centroid, view = detector.detect(frame)
+    detector.release_view(view)
+    return centroid
+
+
+# -----------------------------------------------------
+#                     BENCHMARKS
+# -----------------------------------------------------
+#
+# each benchmark is a function that receives the frame shape and the history length and returns the function to
+# be timed (with no arguments), so that all of the setup stays out of the measurements; benchmarks that don't
+# depend on the history length are only run for the first history length; functions that draw on the frame
+# draw on the same work frame over and over, so that copying it doesn't count towards their time and allocations;
+# the functions of benchmarks that hold on to resources (such as worker threads) have a close method, which frees
+# them once they've been measured
+
+def bench_apply_mask(shape, history):
+    frame = synthetic_frame(shape, 0)
+    return lambda: apply_mask(frame, PENCIL_RANGES)
+
+def bench_get_centroid_position(shape, history):
+    mask = apply_mask(synthetic_frame(shape, 0), PENCIL_RANGES)
+    return lambda: get_centroid_position(mask)
+
+def bench_detect_pencil(shape, history):
+    frame = synthetic_frame(shape, 0)
+    return lambda: detect_pencil(frame, PENCIL_RANGES)
+
+def bench_blob_detector(shape, history):
+    frame = synthetic_frame(shape, 0)
+    detector = BlobDetector(PENCIL_RANGES)
+    return lambda: detect_and_release(detector, frame)
+
+def bench_band_detector(shape, history):
+    frame = synthetic_frame(shape, 0)
+    detector = BandBlobDetector(PENCIL_RANGES)
+    def detect():
+        return detect_and_release(detector, frame)
+    detect.close = detector.close
+    return detect
+
+def bench_multi_pen_detector(shape, history):
+    frame = synthetic_frame(shape, 0)
+    detector = MultiPenDetector(PENS)
+    return lambda: detect_and_release(detector, frame)
+
+def bench_separate_pen_detectors(shape, history):
+    # what the multi-pen detection replaces: a full segmentation (in the color space of the pen) and search per pen
+    frame = synthetic_frame(shape, 0)
+    detectors = [BlobDetector(pen['limits']) for pen in PENS]
+    for detector in detectors:
+        detector.allocate(shape)
+    def detect_separately():
+        for pen, detector in zip(PENS, detectors):
+            pen_mask(frame, pen, detector.mask)
+            detector.find_in_mask()
+    return detect_separately
+
+def bench_pencil_tracker(shape, history):
+    # the pencil goes back and forth along a short stretch of its path, as it would between consecutive frames
+    frames = [synthetic_frame(shape, t) for t in list(range(5)) + list(range(5, 0, -1))]
+    tracker = PencilTracker(PENCIL_RANGES)
+    state = {'i': 0}
+    def detect():
+        state['i'] = (state['i'] + 1) % len(frames)
+        return detect_and_release(tracker, frames[state['i']])
+    return detect
+
+def bench_multiscale_detector(shape, history):
+    frame = synthetic_frame(shape, 0)
+    detector = MultiScaleDetector(PENCIL_RANGES, 4)
+    return lambda: detector.detect(frame)
+
+def bench_pyramid_detector(shape, history):
+    frame = synthetic_frame(shape, 0)
+    detector = MultiScaleDetector(PENCIL_RANGES, 4, pyramid=True)
+    return lambda: detector.detect(frame)
+
+def bench_kalman_filter(shape, history):
+    return filter_updates(shape, 'kalman')
+
+def bench_oneeuro_filter(shape, history):
+    return filter_updates(shape, 'oneeuro')
+
+def filter_updates(shape, name):
+    # the filter follows a long path, one position per call
+    pencil_filter = make_filter(name, 0.05)
+    coords = [c for c in synthetic_path(shape, 1000) if c[0] is not None]
+    state = {'i': 0}
+    def update():
+        state['i'] += 1
+        return pencil_filter.update(coords[state['i'] % len(coords)], state['i'] / TARGET_FPS)
+    return update
+
+def bench_new_draw_move(shape, history):
+    coords = synthetic_path(shape, 2)
+    return lambda: new_draw_move(coords[0], coords[1], (0,0,255), 5, True)
+
+def bench_redraw_on_frame(shape, history):
+    frame = synthetic_frame(shape, 0)
+    moves = synthetic_history(shape, history)
+    return lambda: redraw_on_frame(frame, moves)
+
+def bench_stroke_store_render(shape, history):
+    frame = synthetic_frame(shape, 0)
+    store = StrokeStore()
+    for move in synthetic_history(shape, history):
+        store.append(move)
+    return lambda: store.render(frame)
+
+def bench_canvas_composite(shape, history):
+    frame = synthetic_frame(shape, 0)
+    canvas = Canvas(shape)
+    for move in synthetic_history(shape, history):
+        canvas.draw(move)
+    return lambda: canvas.composite(frame)
+
+def bench_figure_preview(shape, history):
+    # rendering a frame while an ellipse bigger than the frame is being positioned over a drawing
+    frame = synthetic_frame(shape, 0)
+    h, w = shape
+    canvas = Canvas(shape)
+    for move in synthetic_history(shape, history):
+        canvas.draw(move)
+    figure = Ellipse((-w // 4, -h // 4), (w + w // 4, h + h // 4), (255,0,0), 5)
+    def preview():
+        canvas.composite(frame)
+        figure.draw(frame)
+        return frame
+    return preview
+
+def bench_infinite_canvas_pan(shape, history):
+    # panning over a virtual canvas 4 frames wide and 4 frames high, with the history drawn all over it, by a
+    # quarter of the frame at a time, back and forth across it (so that most of the tiles come from the cache)
+    h, w = shape
+    viewport = Viewport(shape)
+    canvas = InfiniteCanvas(Canvas(shape), viewport)
+    moves = synthetic_history(shape, history)
+    for i in range(16):
+        viewport.pan = ((i % 4) * w, (i // 4) * h)
+        for move in moves[i * len(moves) // 16:(i + 1) * len(moves) // 16]:
+            canvas.draw(move)
+        canvas.draw(None)
+    steps = [(x * w // 4, y * h // 4) for y in range(13) for x in (range(13) if y % 2 == 0 else range(12, -1, -1))]
+    state = {'i': 0}
+    def pan():
+        state['i'] += 1
+        viewport.pan = steps[state['i'] % len(steps)]
+        canvas.refresh()
+        return canvas.layer
+    return pan
+
+def bench_findcontours(shape, history):
+    frame = synthetic_frame(shape, 0)
+    zones, _, _ = getgrid(frame)
+    numbers = [(i % 3) + 1 for i in range(len(zones))]
+    return lambda: findcontours(frame, zones, numbers)
+
+def bench_grid_overlay_composite(shape, history):
+    frame = synthetic_frame(shape, 0)
+    zones, _, _ = getgrid(frame)
+    overlay = grid_overlay(frame.shape, zones, [(i % 3) + 1 for i in range(len(zones))])
+    return lambda: overlay.composite(frame)
+
+def bench_layer_stack_composite(shape, history):
+    # a coloring session: the grid and the drawing laid over the frame together, with a new segment drawn on
+    # every frame (so that its rectangle has to be composited again)
+    frame = synthetic_frame(shape, 0)
+    zones, _, _ = getgrid(frame)
+    overlay = grid_overlay(frame.shape, zones, [(i % 3) + 1 for i in range(len(zones))])
+    canvas = Canvas(shape)
+    moves = synthetic_history(shape, history + 1000)
+    for move in moves[:history]:
+        canvas.draw(move)
+    layers = LayerStack(shape, [overlay, canvas])
+    new_moves = iter(moves[history:] * 1000)
+    def composite():
+        canvas.draw(next(new_moves))
+        return layers.composite(frame)
+    return composite
+
+def bench_colorswindow(shape, history):
+    return lambda: colorswindow([(0,0,255), (0,255,0), (255,0,0)], 42, [40, 50, None])
+
+def bench_calc_accuracy(shape, history):
+    frame = synthetic_frame(shape, 0)
+    zones, zone_map, numbers_to_colors = getgrid(frame)
+    numbers = [(i % 3) + 1 for i in range(len(zones))]
+    canvas = Canvas(shape)
+    for move in synthetic_history(shape, 2000):
+        canvas.draw(move)
+    frame = canvas.composite(frame)
+    return lambda: calc_accuracy(frame, zone_map, numbers, numbers_to_colors)
+
+
+# benchmarks by name, along with whether they depend on the history length
+BENCHMARKS = {
+    'apply_mask': (bench_apply_mask, False),
+    'get_centroid_position': (bench_get_centroid_position, False),
+    'detect_pencil': (bench_detect_pencil, False),
+    'blob_detector': (bench_blob_detector, False),
+    'band_detector': (bench_band_detector, False),
+    'multi_pen_detector': (bench_multi_pen_detector, False),
+    'separate_pen_detectors': (bench_separate_pen_detectors, False),
+    'pencil_tracker': (bench_pencil_tracker, False),
+    'multiscale_detector': (bench_multiscale_detector, False),
+    'pyramid_detector': (bench_pyramid_detector, False),
+    'kalman_filter': (bench_kalman_filter, False),
+    'oneeuro_filter': (bench_oneeuro_filter, False),
+    'new_draw_move': (bench_new_draw_move, False),
+    'redraw_on_frame': (bench_redraw_on_frame, True),
+    'stroke_store_render': (bench_stroke_store_render, True),
+    'canvas_composite': (bench_canvas_composite, True),
+    'figure_preview': (bench_figure_preview, True),
+    'infinite_canvas_pan': (bench_infinite_canvas_pan, True),
+    'findcontours': (bench_findcontours, False),
+    'grid_overlay_composite': (bench_grid_overlay_composite, False),
+    'layer_stack_composite': (bench_layer_stack_composite, True),
+    'colorswindow': (bench_colorswindow, False),
+    'calc_accuracy': (bench_calc_accuracy, False),
+}
+
+
+def measure(function, repeats, min_time=0.2):
+    """
+    function measure: times a function and measures its memory allocations
+        INPUT:
+            - function: function to measure, with no arguments
+            - repeats: minimum number of timed calls
+            - min_time: minimum total time (in seconds) spent on the timed calls
+        OUTPUT:
+            - [return value]: dictionary with the median and minimum time per call (in milliseconds), the number of
+                            calls, the peak of memory allocated during one call (in bytes) and the frames per second
+                            headroom (how many calls fit in one frame at TARGET_FPS)
+    """
+
+    function() # warm-up
+
+    times = []
+    start = time.perf_counter()
+    while len(times) < repeats or (time.perf_counter() - start) < min_time:
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+        if len(times) >= 100*repeats:
+            break
+
+    # allocations are measured on a separate call, since tracing them slows everything down
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base, _ = tracemalloc.get_traced_memory()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    median = float(np.median(times))
+    return {
+        'median_ms': median*1000,
+        'min_ms': min(times)*1000,
+        'calls': len(times),
+        'alloc_bytes': peak - base,
+        'fps_headroom': (1/TARGET_FPS)/median if median > 0 else float('inf'),
+    }
+
+
+def run(benchmarks, resolutions, histories, repeats):
+    """
+    function run: runs the chosen benchmarks for every resolution (and every history length, when relevant),
+                printing each result as it goes
+        OUTPUT:
+            - [return value]: list of result dictionaries
+    """
+
+    results = []
+    print('%-24s %-6s %8s %10s %10s %12s %10s' % ('benchmark', 'res', 'history', 'median ms', 'min ms', 'alloc KiB', 'headroom'))
+    for name in benchmarks:
+        setup, uses_history = BENCHMARKS[name]
+        for resolution in resolutions:
+            for history in (histories if uses_history else histories[:1]):
+                function = setup(RESOLUTIONS[resolution], history)
+                try:
+                    result = measure(function, repeats)
+                finally:
+                    if hasattr(function, 'close'):
+                        function.close()
+                result.update({'benchmark': name, 'resolution': resolution, 'history': history})
+                results.append(result)
+                print('%-24s %-6s %8d %10.3f %10.3f %12.1f %9.1fx' % (name, resolution, history, result['median_ms'],
+                    result['min_ms'], result['alloc_bytes']/1024, result['fps_headroom']))
+    return results
+
+
+def simplification_report(shape, length, tolerances):
+    """
+    function simplification_report: measures how much the stroke simplification of StrokeStore compresses a
+                                synthetic drawing session, and how much it changes the drawing
+        INPUT:
+            - shape: (height, width) of the frame
+            - length: number of draw moves in the session
+            - tolerances: simplification tolerances to try, in pixels
+        OUTPUT:
+            - [return value]: list of dictionaries with, for each tolerance, the numbers of points drawn and
+                            stored, the compression ratio, and the percentage of drawn pixels that changed
+    """
+
+    moves = synthetic_history(shape, length)
+    reference = np.zeros(shape, dtype=np.uint8)
+    for move in moves:
+        if move is not None:
+            move.draw(reference, 255)
+    drawn_pixels = max(1, cv2.countNonZero(reference))
+
+    report = []
+    print('%-10s %10s %10s %12s %14s' % ('tolerance', 'drawn', 'stored', 'compression', 'pixels changed'))
+    for tolerance in tolerances:
+        store = StrokeStore(tolerance=tolerance)
+        for move in moves:
+            store.append(move)
+        store.simplify()
+        changed = cv2.countNonZero(cv2.absdiff(reference, store.render(np.zeros(shape, dtype=np.uint8), 255)))
+        entry = {
+            'tolerance': tolerance,
+            'drawn_points': store.raw_points,
+            'stored_points': store.size,
+            'compression_ratio': store.compression_ratio(),
+            'pixels_changed_pct': 100 * changed / drawn_pixels,
+        }
+        report.append(entry)
+        print('%-10g %10d %10d %11.1fx %13.2f%%' % (tolerance, entry['drawn_points'], entry['stored_points'],
+            entry['compression_ratio'], entry['pixels_changed_pct']))
+    return report
+
+
+def filter_report(latency, noise=2.0, outlier_rate=0.02, frames=900, seed=1):
+    """
+    function filter_report: measures how well each pencil filter tracks a pencil moving along a known path, when the
+                        detections are late, jittery and sometimes wrong
+        INPUT:
+            - latency: how late (in seconds) the detections are; the filters predict this far ahead
+            - noise: standard deviation of the detection jitter, in pixels
+            - outlier_rate: fraction of the detections that are thrown somewhere else in the frame
+            - frames: number of frames (at TARGET_FPS)
+            - seed: seed for the jitter and the outliers
+        OUTPUT:
+            - [return value]: list of dictionaries with, for each filter (and for no filter), the RMS, median and
+                            95th percentile of the distance (in pixels) to the true pencil position, and the number
+                            of outliers rejected
+    """
+
+    truth = lambda t: np.array([640 + 300*cos(1.5*t) + 100*sin(4.1*t), 360 + 200*sin(1.5*t)])
+    rng = np.random.default_rng(seed)
+    detections = []
+    for i in range(frames):
+        z = truth(i/TARGET_FPS - latency) + rng.normal(0, noise, 2)
+        if rng.random() < outlier_rate:
+            z += rng.uniform(-300, 300, 2)
+        detections.append((int(z[0]), int(z[1])))
+
+    report = []
+    print('%-10s %10s %10s %10s %10s' % ('filter', 'rms px', 'median px', 'p95 px', 'outliers'))
+    for name in ['none'] + list(FILTERS):
+        pencil_filter = make_filter(name, latency)
+        errors = []
+        for i, coords in enumerate(detections):
+            if pencil_filter:
+                coords = pencil_filter.update(coords, i/TARGET_FPS)
+            errors.append(np.linalg.norm(np.array(coords) - truth(i/TARGET_FPS)))
+        entry = {
+            'filter': name,
+            'rms_px': float(np.sqrt(np.mean(np.square(errors)))),
+            'median_px': float(np.median(errors)),
+            'p95_px': float(np.percentile(errors, 95)),
+            'outliers_rejected': pencil_filter.outliers if pencil_filter else 0,
+        }
+        report.append(entry)
+        print('%-10s %10.1f %10.1f %10.1f %10d' % (name, entry['rms_px'], entry['median_px'], entry['p95_px'], entry['outliers_rejected']))
+    return report
+
+
+def band_detector_check(shape, workers, frames=40, seed=0):
+    """
+    function band_detector_check: checks that the band-parallel pencil detection finds exactly what the
+                            single-threaded one does: on frames with random pencil colored rectangles and ellipses,
+                            with and without morphology, and on rectangles with an arm on one side swept across the
+                            edge between two bands (whose centroids often fall right on a pixel, where any rounding
+                            error in merging the blobs of both bands shows)
+        INPUT:
+            - shape: (height, width) of the frame
+            - workers: number of worker threads (and bands)
+            - frames: number of random frames checked (for each morphology size)
+            - seed: seed of the random frames
+        OUTPUT:
+            - [return value]: number of frames checked
+    """
+
+    h, w = shape
+    rng = np.random.default_rng(seed)
+    checked = 0
+
+    def check(single, bands, frame):
+        expected, found = single.find(frame), bands.find(frame)
+        assert found == expected, 'band detection found ' + str(found) + ' instead of ' + str(expected)
+
+    for morphology in (0, 5):
+        single = BlobDetector(PENCIL_RANGES, morphology=morphology)
+        bands = BandBlobDetector(PENCIL_RANGES, morphology=morphology, workers=workers)
+        for _ in range(frames):
+            frame = rng.integers(0, 60, (h, w, 3), dtype=np.uint8)
+            for _ in range(int(rng.integers(1, 12))):
+                x, y = int(rng.integers(0, w)), int(rng.integers(0, h))
+                a, b = int(rng.integers(1, h // 4)), int(rng.integers(1, h // 4))
+                if rng.random() < 0.5:
+                    cv2.rectangle(frame, (x, y), (x + a, y + b), PENCIL_COLOR, -1)
+                else:
+                    cv2.ellipse(frame, (x, y), (a, b), float(rng.integers(0, 180)), 0, 360, PENCIL_COLOR, -1)
+            check(single, bands, frame)
+            checked += 1
+        bands.close()
+
+    single = BlobDetector(PENCIL_RANGES)
+    bands = BandBlobDetector(PENCIL_RANGES, workers=workers)
+    bands.allocate((h, w))
+    edge = bands.bands[0][1]
+    frame = np.zeros((h, w, 3), dtype=np.uint8)
+    for width in (7, 21, 33):
+        for height in range(3, 60, 2):
+            for y in range(max(0, edge - height + 1), edge):
+                frame[:] = 0
+                frame[y:y+height, 10:10+width] = PENCIL_COLOR
+                frame[y + height // 2, 10+width:15+width] = PENCIL_COLOR
+                check(single, bands, frame)
+                checked += 1
+    bands.close()
+    return checked
+
+
+def scaling_report(shape, max_workers, repeats):
+    """
+    function scaling_report: measures how the band-parallel pencil detection scales with the number of worker
+                        threads (and bands)
+        INPUT:
+            - shape: (height, width) of the frame
+            - max_workers: the detection is measured with 1 to this many workers
+            - repeats: minimum number of timed calls for each number of workers
+        OUTPUT:
+            - [return value]: list of dictionaries with, for each number of workers, the median time per frame, the
+                            speedup over the single-threaded BlobDetector and the parallel efficiency (speedup per
+                            worker)
+    """
+
+    checked = band_detector_check(RESOLUTIONS['480p'], max_workers)
+    print('Band detection matches the single-threaded one on ' + str(checked) + ' random frames')
+
+    frame = synthetic_frame(shape, 0)
+    single = BlobDetector(PENCIL_RANGES)
+    baseline = measure(lambda: detect_and_release(single, frame), repeats)['median_ms']
+
+    report = []
+    print('%-10s %10s %10s %12s' % ('workers', 'median ms', 'speedup', 'efficiency'))
+    print('%-10s %10.3f %9.2fx %12s' % ('single', baseline, 1.0, '-'))
+    for workers in range(1, max_workers + 1):
+        detector = BandBlobDetector(PENCIL_RANGES, workers=workers)
+        median = measure(lambda: detect_and_release(detector, frame), repeats)['median_ms']
+        detector.close()
+        entry = {
+            'workers': workers,
+            'median_ms': median,
+            'speedup': baseline / median,
+            'efficiency': baseline / median / workers,
+        }
+        report.append(entry)
+        print('%-10d %10.3f %9.2fx %11.0f%%' % (workers, median, entry['speedup'], 100 * entry['efficiency']))
+    return {'single_ms': baseline, 'workers': report}
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    function compare: compares results against the results saved by a previous run
+        INPUT:
+            - results: list of result dictionaries of this run
+            - baseline_path: path to the .json file with the previous results
+            - tolerance: relative slowdown of the median time above which a result counts as a regression
+        OUTPUT:
+            - [return value]: list of (key, old median, new median) for every regression found
+    """
+
+    with open(baseline_path, 'r') as openfile:
+        baseline = json.load(openfile)['results']
+    key = lambda r: (r['benchmark'], r['resolution'], r['history'])
+    old = {key(r): r for r in baseline}
+
+    regressions = []
+    for result in results:
+        if key(result) in old and result['median_ms'] > old[key(result)]['median_ms']*(1 + tolerance):
+            regressions.append((key(result), old[key(result)]['median_ms'], result['median_ms']))
+    return regressions
+
+
+def main():
+    """
+    function main: parses the command line arguments, runs the benchmarks and saves the results
+    """
+
+    parser = argparse.ArgumentParser(description='PSR AR Paint benchmarks')
+    parser.add_argument('-b', '--benchmarks', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS), help='benchmarks to run')
+    parser.add_argument('-r', '--resolutions', nargs='+', choices=list(RESOLUTIONS), default=list(RESOLUTIONS), help='resolutions to run them at')
+    parser.add_argument('-l', '--histories', nargs='+', type=int, default=HISTORY_LENGTHS, help='draw move history lengths')
+    parser.add_argument('-n', '--repeats', type=int, default=10, help='minimum number of timed calls per benchmark')
+    parser.add_argument('-o', '--output', type=str, default='benchmark_results.json', help='path of the .json file for the results')
+    parser.add_argument('-c', '--compare', type=str, required=False, help='provide the path to a previous results file to check for regressions')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2, help='relative slowdown that counts as a regression when comparing')
+    parser.add_argument('-f', '--filters', type=float, required=False, help='provide a latency (in milliseconds) to report how well each pencil filter tracks a late, jittery pencil')
+    parser.add_argument('-s', '--simplify', nargs='+', type=float, required=False, help='stroke simplification tolerances to report the compression of (on a 720p session of 10k moves)')
+    parser.add_argument('-w', '--workers', type=int, required=False, help='provide a number of worker threads to report how the band-parallel detection scales from 1 to that many (on 4K frames)')
+    args = vars(parser.parse_args())
+
+    results = run(args['benchmarks'], args['resolutions'], args['histories'], args['repeats'])
+    filtering = filter_report(args['filters'] / 1000) if args['filters'] is not None else None
+    simplification = simplification_report(RESOLUTIONS['720p'], 10000, args['simplify']) if args['simplify'] else None
+    scaling = scaling_report(RESOLUTIONS['4k'], args['workers'], args['repeats']) if args['workers'] else None
+
+    data = {
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'target_fps': TARGET_FPS,
+        'results': results,
+        'simplification': simplification,
+        'filtering': filtering,
+        'scaling': scaling,
+    }
+    with open(args['output'], 'w') as outfile:
+        json.dump(data, outfile, indent=4)
+    print('Results saved to ' + args['output'])
+
+    if args['compare']:
+        regressions = compare(results, args['compare'], args['tolerance'])
+        for (name, resolution, history), old_ms, new_ms in regressions:
+            print('REGRESSION: %s at %s (history %d): %.3f ms -> %.3f ms' % (name, resolution, history, old_ms, new_ms))
+        if regressions:
+            sys.exit(1)
+
+
+
+if __name__ == '__main__':
+    main()
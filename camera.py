@@ -0,0 +1,265 @@
+import cv2
+import numpy as np
+
+import argparse
+import json
+import sys
+import time
+from os import path
+
+# This file contains the capture configuration of the camera used by the ar_paint.py and color_segmenter.py
+# scripts (device, backend, resolution, frame rate, pixel format and buffer size), which is kept in a capture.json
+# file alongside limits.json, and the probe that measures the camera modes to pick the fastest one that works.
+# Run it as a script to probe the camera or to change the configuration by hand.
+
+
+# capture backends by name (any lets OpenCV choose)
+BACKENDS = {
+    'any': cv2.CAP_ANY,
+    'v4l2': cv2.CAP_V4L2,
+    'dshow': cv2.CAP_DSHOW,
+    'msmf': cv2.CAP_MSMF,
+    'avfoundation': cv2.CAP_AVFOUNDATION,
+    'gstreamer': cv2.CAP_GSTREAMER,
+}
+
+# settings that are None are left as the camera driver sets them
+DEFAULT_CONFIG = {
+    'device': 0,
+    'backend': 'any',
+    'width': None,
+    'height': None,
+    'fps': None,
+    'fourcc': None,     # pixel format, e.g. 'MJPG' (compressed) or 'YUYV' (uncompressed)
+    'buffer_size': None, # frames queued by the driver; 1 keeps the latency down
+}
+
+# modes tried by the probe
+PROBE_RESOLUTIONS = [(3840, 2160), (1920, 1080), (1280, 720), (640, 480)]
+PROBE_FOURCCS = ['MJPG', 'YUYV']
+PROBE_FPS = [60, 30]
+
+
+def config_path(limits_path):
+    """
+    function config_path: returns the path of the capture configuration that goes with a color limits file
+    """
+
+    return path.join(path.dirname(limits_path), 'capture.json')
+
+
+def load_config(file_path):
+    """
+    function load_config: reads a capture configuration file; the settings it doesn't have (or all of them, if
+                        the file doesn't exist) take their default values
+        OUTPUT:
+            - [return value]: the configuration dictionary (see DEFAULT_CONFIG)
+    """
+
+    config = dict(DEFAULT_CONFIG)
+    if file_path and path.exists(file_path):
+        with open(file_path, 'r') as openfile:
+            config.update(json.load(openfile))
+    if config['backend'] not in BACKENDS:
+        raise ValueError('Unknown capture backend: ' + str(config['backend']))
+    return config
+
+
+def save_config(file_path, config):
+    with open(file_path, 'w') as outfile:
+        json.dump(config, outfile, indent=4)
+
+
+def fourcc_name(code):
+    code = int(code)
+    return ''.join(chr((code >> 8*i) & 0xFF) for i in range(4)) if code > 0 else None
+
+
+def open_camera(config):
+    """
+    function open_camera: opens the camera with the settings of a capture configuration
+        OUTPUT:
+            - [return value]: the cv2.VideoCapture
+    """
+
+    capture = cv2.VideoCapture(config['device'], BACKENDS[config['backend']])
+
+    # the pixel format is set first: on some backends (e.g. V4L2), setting the resolution first negotiates it for
+    # the default format, usually uncompressed YUYV, which may not offer the frame rate asked for
+    if config['fourcc']:
+        capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*config['fourcc']))
+    if config['width'] and config['height']:
+        capture.set(cv2.CAP_PROP_FRAME_WIDTH, config['width'])
+        capture.set(cv2.CAP_PROP_FRAME_HEIGHT, config['height'])
+    if config['fps']:
+        capture.set(cv2.CAP_PROP_FPS, config['fps'])
+    if config['buffer_size']:
+        capture.set(cv2.CAP_PROP_BUFFERSIZE, config['buffer_size'])
+    return capture
+
+
+def actual_mode(capture):
+    """
+    function actual_mode: returns the mode the camera (or video) actually delivers, as a dictionary with its
+                        width, height, FPS and pixel format, which may differ from the one asked for
+    """
+
+    return {
+        'width': int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        'height': int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        'fps': capture.get(cv2.CAP_PROP_FPS),
+        'fourcc': fourcc_name(capture.get(cv2.CAP_PROP_FOURCC)),
+    }
+
+
+def frame_shape(capture):
+    """
+    function frame_shape: returns the shape of the frames of a video source without reading one, or None if the
+                        source doesn't tell
+    """
+
+    w, h = capture.get(cv2.CAP_PROP_FRAME_WIDTH), capture.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    return (int(h), int(w), 3) if w > 0 and h > 0 else None
+
+
+def measure_mode(config, frames=90, warmup=15):
+    """
+    function measure_mode: opens the camera with a configuration and measures what it delivers
+        INPUT:
+            - config: capture configuration
+            - frames: number of frames measured
+            - warmup: number of frames read (and ignored) first, while the camera settles (exposure, etc.)
+        OUTPUT:
+            - [return value]: the actual mode (see actual_mode) along with the delivered frames per second and the
+                            median and 95th percentile of the time spent waiting for each frame (in milliseconds),
+                            or None if the camera couldn't be opened or stopped delivering frames
+    """
+
+    capture = open_camera(config)
+    try:
+        if not capture.isOpened():
+            return None
+        mode = actual_mode(capture)
+        frame = None
+        for _ in range(warmup):
+            ret, frame = capture.read(frame)
+            if not ret:
+                return None
+
+        waits = []
+        start = time.perf_counter()
+        for _ in range(frames):
+            t0 = time.perf_counter()
+            ret, frame = capture.read(frame)
+            waits.append(time.perf_counter() - t0)
+            if not ret:
+                return None
+        elapsed = time.perf_counter() - start
+    finally:
+        capture.release()
+
+    # the frames themselves tell the real resolution
+    mode['height'], mode['width'] = frame.shape[:2]
+    mode.update({
+        'delivered_fps': frames / elapsed,
+        'wait_p50_ms': float(np.percentile(waits, 50)) * 1000,
+        'wait_p95_ms': float(np.percentile(waits, 95)) * 1000,
+    })
+    return mode
+
+
+def probe(config, frames=90):
+    """
+    function probe: measures every mode in PROBE_RESOLUTIONS x PROBE_FOURCCS x PROBE_FPS that the camera accepts
+                (a mode it silently replaces with another one only counts once, as the mode it gave) and picks
+                the fastest one: the one with the most frames per second, then the biggest, then the one with the
+                shortest waits
+        INPUT:
+            - config: capture configuration with the device and backend to probe (its other settings are
+                    replaced by each mode's)
+            - frames: number of frames measured for each mode
+        OUTPUT:
+            - best: the configuration of the fastest mode, or None if none worked
+            - results: list of the measurements of the modes that worked (see measure_mode)
+    """
+
+    # no point in trying every mode if the camera can't be opened at all
+    capture = open_camera(dict(config, width=None, height=None, fps=None, fourcc=None))
+    opened = capture.isOpened()
+    capture.release()
+    if not opened:
+        return None, []
+
+    results = []
+    seen = set()
+    print('%-11s %-6s %8s %10s %10s %10s' % ('resolution', 'format', 'set fps', 'real fps', 'wait p50', 'wait p95'))
+    for width, height in PROBE_RESOLUTIONS:
+        for fourcc in PROBE_FOURCCS:
+            for fps in PROBE_FPS:
+                candidate = dict(config, width=width, height=height, fourcc=fourcc, fps=fps,
+                                 buffer_size=config['buffer_size'] or 1)
+                mode = measure_mode(candidate, frames)
+                if mode is None:
+                    continue
+                key = (mode['width'], mode['height'], mode['fourcc'], round(mode['fps'] or 0))
+                if key in seen:
+                    continue
+                seen.add(key)
+                mode['config'] = dict(candidate, width=mode['width'], height=mode['height'],
+                                      fps=mode['fps'] or fps, fourcc=mode['fourcc'] or fourcc)
+                results.append(mode)
+                print('%-11s %-6s %8.1f %10.1f %8.1f ms %8.1f ms' % ('%dx%d' % (mode['width'], mode['height']),
+                    mode['fourcc'] or '?', mode['fps'] or 0, mode['delivered_fps'], mode['wait_p50_ms'], mode['wait_p95_ms']))
+
+    if not results:
+        return None, results
+    best = max(results, key=lambda m: (round(m['delivered_fps']), m['width']*m['height'], -m['wait_p50_ms']))
+    return best['config'], results
+
+
+def main():
+    """
+    function main: probes the camera, or changes the capture configuration by hand, and saves the configuration
+    """
+
+    parser = argparse.ArgumentParser(description='PSR Capture Configuration')
+    parser.add_argument('-c', '--config', type=str, default='capture.json', help='path of the capture configuration file (it goes alongside limits.json)')
+    parser.add_argument('-p', '--probe', action='store_true', help='measure the frame rate and waiting time of every camera mode and save the fastest one')
+    parser.add_argument('-n', '--frames', type=int, default=90, help='number of frames measured for each mode when probing')
+    parser.add_argument('-d', '--device', type=int, required=False, help='index of the camera')
+    parser.add_argument('-be', '--backend', choices=list(BACKENDS), required=False, help='capture backend')
+    parser.add_argument('-r', '--resolution', type=str, required=False, help='resolution, as WIDTHxHEIGHT (e.g. 1280x720)')
+    parser.add_argument('-fps', '--fps', type=float, required=False, help='frame rate to ask the camera for')
+    parser.add_argument('-fc', '--fourcc', type=str, required=False, help='pixel format to ask the camera for (e.g. MJPG or YUYV)')
+    parser.add_argument('-bs', '--buffer_size', type=int, required=False, help='number of frames the driver may queue')
+    args = vars(parser.parse_args())
+
+    try:
+        config = load_config(args['config'])
+    except (ValueError, json.JSONDecodeError) as error:
+        sys.exit('Couldn\'t read the capture configuration: ' + str(error))
+
+    # settings given on the command line
+    for key in ['device', 'backend', 'fps', 'fourcc', 'buffer_size']:
+        if args[key] is not None:
+            config[key] = args[key]
+    if args['resolution']:
+        try:
+            config['width'], config['height'] = (int(v) for v in args['resolution'].lower().split('x'))
+        except ValueError:
+            sys.exit('The resolution must be given as WIDTHxHEIGHT.')
+
+    if args['probe']:
+        best, _ = probe(config, args['frames'])
+        if best is None:
+            sys.exit('No camera mode worked.')
+        config = best
+        print('Fastest mode: %dx%d %s at %g FPS' % (config['width'], config['height'], config['fourcc'], config['fps']))
+
+    save_config(args['config'], config)
+    print('Capture configuration saved to ' + args['config'])
+
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,7 @@
 import cv2
+import numpy as np
+import time
+import zlib
 from math import sqrt
 
 # This file contains all classes used in the ar_paint.py script.
@@ -8,21 +11,69 @@ class Mouse:
     class 'Mouse': this class is only ever instantiated if we run the program with the -m flag, meaning
                 we wish to use the mouse pointer instead of the color centroid as a pencil; in that case,
                 the instantiation of Mouse keeps track of the coordinates of the mouse pointer, as well as
-                if we're pressing the left mouse button or not, thus avoiding the use of global variables
+                if we're pressing the left mouse button or not, thus avoiding the use of global variables;
+                every mouse event is also queued, with the time it came at, in a ring buffer that the main
+                loop drains on each frame, so that none of the positions the mouse went through between two
+                frames are lost
+                - capacity: number of events the ring buffer holds; if more than that come between two
+                            drains, the oldest ones are lost
     """
 
-    def __init__(self):
+    def __init__(self, capacity=1024):
         self.coords = (None,None)
         self.pressed = False
 
+        # ring buffer of events (position, time, whether the button was down and whether the event released it);
+        # the callback is its only writer
+        # and drain its only reader, and each of them only moves its own counter forward (the total number of
+        # events written and read), so they don't need a lock
+        self.capacity = capacity
+        self.event_points = np.zeros((capacity, 2), dtype=np.int32)
+        self.event_times = np.zeros(capacity, dtype=np.float64)
+        self.event_pressed = np.zeros(capacity, dtype=bool)
+        self.event_released = np.zeros(capacity, dtype=bool)
+        self.written = 0
+        self.read = 0
+        self.dropped = 0 # events lost because the buffer was full
+
+        # black screen shown instead of the mask (see get_mouse_position), and where the cross was drawn on it
+        self.view = None
+        self.view_cross = None
+
     def update_mouse(self,event,x,y,flags,param):
         self.coords = (x,y)
 
+        # the button is still down during the event that releases it, so that the stroke goes on up to where it
+        # was released
+        was_pressed = self.pressed
         if event == cv2.EVENT_LBUTTONDOWN:
             self.pressed = True
         elif event == cv2.EVENT_LBUTTONUP:
             self.pressed = False
 
+        # the event is written before the counter is moved forward, so drain never reads it half-written
+        i = self.written % self.capacity
+        self.event_points[i] = (x, y)
+        self.event_times[i] = time.perf_counter()
+        self.event_released[i] = event == cv2.EVENT_LBUTTONUP and was_pressed
+        self.event_pressed[i] = self.pressed or self.event_released[i]
+        self.written += 1
+
+    def drain(self):
+        """
+        returns the events queued since the last call, from the oldest to the newest, as an array of positions, an
+        array of times (from time.perf_counter), an array telling if the button was down at each of them and one
+        telling which of them released it (the button counts as down for those, which end a stroke)
+        """
+
+        written = self.written
+        start = max(self.read, written - self.capacity)
+        self.dropped += start - self.read
+        self.read = written
+        indices = np.arange(start, written) % self.capacity
+        return self.event_points[indices], self.event_times[indices], self.event_pressed[indices], \
+            self.event_released[indices]
+
 
 # Free drawing moves
 
@@ -37,6 +88,14 @@ class Dot:
         self.thickness = thickness
         self.color = color
 
+    def draw(self, image, color=None):
+        cv2.circle(image, self.coords, self.thickness, color if color is not None else self.color, -1)
+
+    def bounds(self):
+        # (x0, y0, x1, y1) rectangle (end excluded) that contains everything the move draws
+        r = self.thickness + 1
+        return (self.coords[0] - r, self.coords[1] - r, self.coords[0] + r + 1, self.coords[1] + r + 1)
+
 class Line:
     """
     class 'Line': represents a drawn line on the canvas; this class allows us to instantiate lines drawn on
@@ -49,6 +108,14 @@ class Line:
         self.thickness = thickness
         self.color = color
 
+    def draw(self, image, color=None):
+        cv2.line(image, self.old_coords, self.coords, color if color is not None else self.color, self.thickness)
+
+    def bounds(self):
+        r = self.thickness + 1
+        return (min(self.old_coords[0], self.coords[0]) - r, min(self.old_coords[1], self.coords[1]) - r,
+                max(self.old_coords[0], self.coords[0]) + r + 1, max(self.old_coords[1], self.coords[1]) + r + 1)
+
 
 # Geometrical figures
 
@@ -72,8 +139,17 @@ class Square(Figure):
 
     def __init__(self, origin, pencil, color, thickness):
         Figure.__init__(self, origin, color, thickness)
+        self.pencil = pencil
         self.end_point = pencil
 
+    def draw(self, image, color=None):
+        cv2.rectangle(image, self.origin, self.end_point, color if color is not None else self.color, self.thickness)
+
+    def bounds(self):
+        r = self.thickness + 1
+        return (min(self.origin[0], self.end_point[0]) - r, min(self.origin[1], self.end_point[1]) - r,
+                max(self.origin[0], self.end_point[0]) + r + 1, max(self.origin[1], self.end_point[1]) + r + 1)
+
 class Ellipse(Figure):
     """
     class 'Ellipse': an ellipse; it inherits from Figure
@@ -90,12 +166,21 @@ class Ellipse(Figure):
         meanY = (pencil[1]-origin[1])/2
 
         Figure.__init__(self, origin, color, thickness)
+        self.pencil = pencil
         self.center = (round(meanX + origin[0]), round(meanY + origin[1]))
         self.axes = (round(abs(meanX)), round(abs(meanY)))
         self.angle = 0
         self.startAngle = 0
         self.endAngle = 360
 
+    def draw(self, image, color=None):
+        cv2.ellipse(image, self.center, self.axes, self.angle, self.startAngle, self.endAngle,
+                    color if color is not None else self.color, self.thickness)
+
+    def bounds(self):
+        rx, ry = self.axes[0] + self.thickness + 1, self.axes[1] + self.thickness + 1
+        return (self.center[0] - rx, self.center[1] - ry, self.center[0] + rx + 1, self.center[1] + ry + 1)
+
 class Circle(Figure):
     """
     class 'Circle': a circle; it inherits from Figure
@@ -110,5 +195,603 @@ class Circle(Figure):
         diffY = edge[1] - center[1]
 
         Figure.__init__(self, center, color, thickness)
+        self.pencil = edge
         self.radius = round(sqrt( diffX**2 + diffY**2 ))
 
+    def draw(self, image, color=None):
+        cv2.circle(image, self.origin, self.radius, color if color is not None else self.color, self.thickness)
+
+    def bounds(self):
+        r = self.radius + self.thickness + 1
+        return (self.origin[0] - r, self.origin[1] - r, self.origin[0] + r + 1, self.origin[1] + r + 1)
+
+
+# Drawing layers
+
+class Canvas:
+    """
+    class 'Canvas': a persistent drawing layer with the same size as the camera frame; every committed move
+                is painted into it exactly once, both into its color image and into its alpha mask (a
+                uint8 image holding 1 where something was drawn and 0 elsewhere), so that building each
+                new frame is a single vectorized copy of the canvas over the camera image, no matter how
+                long the drawing history is; the canvas also keeps the bounding box of what was drawn on it,
+                so that only that part is copied, and the rectangle changed since it was last laid into a
+                LayerStack
+    """
+
+    def __init__(self, shape):
+        h, w = shape[:2]
+        self.image = np.zeros((h, w, 3), dtype=np.uint8)
+        self.alpha = np.zeros((h, w), dtype=np.uint8)
+
+        # (x0, y0, x1, y1) rectangles (end excluded), or None: everything drawn since the last clear, and
+        # everything changed since the last call to take_dirty
+        self.bounds = None
+        self.dirty = None
+
+    def mark_dirty(self, rect):
+        """
+        registers that a rectangle of the canvas was drawn on (it's clipped to the canvas)
+        """
+
+        h, w = self.alpha.shape
+        x0, y0, x1, y1 = max(0, rect[0]), max(0, rect[1]), min(w, rect[2]), min(h, rect[3])
+        if x0 >= x1 or y0 >= y1:
+            return
+        self.bounds = union_rect(self.bounds, (x0, y0, x1, y1))
+        self.dirty = union_rect(self.dirty, (x0, y0, x1, y1))
+
+    def take_dirty(self):
+        dirty, self.dirty = self.dirty, None
+        return dirty
+
+    def draw(self, move):
+        # None moves are the gaps between strokes (pencil not detected), nothing to paint
+        if move is None:
+            return
+        move.draw(self.image)
+        move.draw(self.alpha, 1)
+        self.mark_dirty(move.bounds())
+
+    def clear(self):
+        self.image[:] = 0
+        self.alpha[:] = 0
+        h, w = self.alpha.shape
+        self.bounds = None
+        self.dirty = (0, 0, w, h)
+
+    def update(self):
+        # a canvas is drawn on directly, so it's always up to date (unlike a LayerStack)
+        pass
+
+    def composite(self, frame):
+        # masked copy straight into the frame (OpenCV's masked copy is several times faster than
+        # numpy's copyto with a broadcast boolean mask), only where something was drawn
+        if self.bounds is None:
+            return frame
+        x0, y0, x1, y1 = self.bounds
+        cv2.copyTo(self.image[y0:y1, x0:x1], self.alpha[y0:y1, x0:x1], frame[y0:y1, x0:x1])
+        return frame
+
+
+class LayerStack(Canvas):
+    """
+    class 'LayerStack': a persistent composite of several canvases (e.g. the coloring grid and the drawing),
+                    laid over each frame with a single masked copy; whenever a layer changes, only the
+                    rectangle it changed is composited again
+                    - shape: shape of the frames
+                    - layers: the Canvas objects, from the bottom one to the top one
+    """
+
+    def __init__(self, shape, layers):
+        Canvas.__init__(self, shape)
+        self.layers = layers
+        h, w = shape[:2]
+        for layer in layers:
+            layer.take_dirty()
+        self.rebuild((0, 0, w, h))
+
+    def rebuild(self, rect):
+        x0, y0, x1, y1 = rect
+        image, alpha = self.image[y0:y1, x0:x1], self.alpha[y0:y1, x0:x1]
+        image[:] = 0
+        alpha[:] = 0
+        for layer in self.layers:
+            cv2.copyTo(layer.image[y0:y1, x0:x1], layer.alpha[y0:y1, x0:x1], image)
+            alpha |= layer.alpha[y0:y1, x0:x1]
+
+    def update(self):
+        """
+        composites again the rectangles changed on any of the layers since the last update
+        """
+
+        dirty = None
+        for layer in self.layers:
+            dirty = union_rect(dirty, layer.take_dirty())
+        if dirty is not None:
+            self.rebuild(dirty)
+            self.mark_dirty(dirty)
+        self.bounds = None
+        for layer in self.layers:
+            self.bounds = union_rect(self.bounds, layer.bounds)
+
+    def take_dirty(self):
+        # a stack can itself be a layer of another one, which then needs it up to date
+        self.update()
+        return Canvas.take_dirty(self)
+
+    def composite(self, frame):
+        self.update()
+        return Canvas.composite(self, frame)
+
+
+def union_rect(a, b):
+    """
+    function union_rect: returns the smallest (x0, y0, x1, y1) rectangle containing two others (either of which
+                    can be None, meaning no rectangle)
+    """
+
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+
+# Drawing history
+
+class StrokeStore:
+    """
+    class 'StrokeStore': the history of draw moves, kept in growable NumPy arrays instead of one Python object per
+                    move; each record holds a point, a thickness, a color, the id of the stroke it belongs to and
+                    a kind code:
+                    - KIND_START: first point of a stroke that doesn't start with a dot
+                    - KIND_DOT: a dot (which also starts a stroke)
+                    - KIND_LINE: a point that continues the current stroke with a line from the previous one
+                    - KIND_FIGURE: a geometric figure, kept as its Figure object in 'figures' (by stroke id)
+                    Dot and Line moves are appended as such, so new_draw_move keeps working; a None move (the
+                    pencil wasn't detected) is a stroke break, and so is any change of color or thickness; this
+                    way whole strokes can be drawn as polylines with one call each
+                    - capacity: initial number of records the arrays can hold (they double when full)
+                    - tolerance: if bigger than 0, strokes are simplified as they grow with the Douglas-Peucker
+                                algorithm (cv2.approxPolyDP), dropping points that lie less than this many pixels
+                                away from the simplified polyline
+                    - chunk: how many new points of the current stroke are gathered before simplifying them
+    """
+
+    KIND_START = 0
+    KIND_DOT = 1
+    KIND_LINE = 2
+    KIND_FIGURE = 3
+
+    def __init__(self, capacity=1024, tolerance=0, chunk=64):
+        self.points = np.zeros((capacity, 2), dtype=np.int32)
+        self.thickness = np.zeros(capacity, dtype=np.int16)
+        self.colors = np.zeros((capacity, 3), dtype=np.uint8)
+        self.stroke_ids = np.zeros(capacity, dtype=np.int32)
+        self.kinds = np.zeros(capacity, dtype=np.uint8)
+        self.figures = {}
+
+        self.size = 0        # number of records
+        self.strokes = 0     # number of strokes
+        self.broken = True   # whether the next point has to start a new stroke
+
+        # stroke simplification
+        self.tolerance = tolerance
+        self.chunk = chunk
+        self.anchor = 0      # first record of the current stroke that may still be simplified
+        self.raw_points = 0  # number of points appended before simplification
+
+    def __len__(self):
+        return self.size
+
+    def grow(self):
+        capacity = 2 * len(self.kinds)
+        for name in ('points', 'thickness', 'colors', 'stroke_ids', 'kinds'):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+
+    def add_record(self, point, thickness, color, kind, new_stroke):
+        if new_stroke:
+            self.simplify()
+            self.anchor = self.size
+            self.strokes += 1
+        if self.size == len(self.kinds):
+            self.grow()
+        i = self.size
+        self.points[i] = point
+        self.thickness[i] = thickness
+        self.colors[i] = color
+        self.stroke_ids[i] = self.strokes - 1
+        self.kinds[i] = kind
+        self.size += 1
+        self.raw_points += 1
+
+        if self.size - self.anchor >= self.chunk:
+            self.simplify()
+
+    def simplify(self):
+        """
+        simplifies the records of the current stroke gathered since the last simplification; the first and last
+        points are always kept, so the stroke can go on from its last point and the next chunk starts there
+        """
+
+        if self.tolerance <= 0 or self.size - self.anchor < 3 or self.kinds[self.anchor] == self.KIND_FIGURE:
+            return
+        kept = cv2.approxPolyDP(self.points[self.anchor:self.size].reshape(-1, 1, 2), self.tolerance, False)
+        end = self.anchor + len(kept)
+        self.points[self.anchor:end] = kept.reshape(-1, 2)
+        # every record after the first one is a line point of the same stroke, with the same style
+        self.kinds[self.anchor+1:end] = self.KIND_LINE
+        self.size = end
+        self.anchor = end - 1
+
+    def compression_ratio(self):
+        """
+        returns how many points were appended for each point stored (1.0 means no simplification)
+        """
+
+        return self.raw_points / self.size if self.size else 1.0
+
+    def continues_stroke(self, old_coords, thickness, color):
+        """
+        tells if a line starting at 'old_coords' with the given style can be added to the current stroke
+        """
+
+        if self.broken or self.size == 0:
+            return False
+        i = self.size - 1
+        return self.kinds[i] != self.KIND_FIGURE and tuple(self.points[i]) == tuple(old_coords) and \
+            self.thickness[i] == thickness and tuple(self.colors[i]) == tuple(color)
+
+    def append(self, move):
+        """
+        adds a move (a Dot, a Line, a Figure or None) to the end of the history
+        """
+
+        if move is None:
+            self.simplify()
+            self.broken = True
+        elif type(move) is Dot:
+            self.add_record(move.coords, move.thickness, move.color, self.KIND_DOT, True)
+            self.broken = False
+        elif type(move) is Line:
+            if not self.continues_stroke(move.old_coords, move.thickness, move.color):
+                self.add_record(move.old_coords, move.thickness, move.color, self.KIND_START, True)
+            self.add_record(move.coords, move.thickness, move.color, self.KIND_LINE, False)
+            self.broken = False
+        else:
+            self.add_record((0, 0), move.thickness, move.color, self.KIND_FIGURE, True)
+            self.figures[self.strokes - 1] = move
+            self.broken = True
+
+    def clear(self):
+        self.size = 0
+        self.strokes = 0
+        self.broken = True
+        self.figures = {}
+        self.anchor = 0
+        self.raw_points = 0
+
+    def pop_stroke(self):
+        """
+        removes the last stroke from the history and returns its records (to be given back to push_stroke), or
+        None if the history is empty
+        """
+
+        self.simplify()
+        if self.size == 0:
+            return None
+        stroke_id = self.stroke_ids[self.size - 1]
+        # stroke ids never decrease along the history, so the stroke starts at the first record with its id
+        start = int(np.searchsorted(self.stroke_ids[:self.size], stroke_id))
+        records = {name: getattr(self, name)[start:self.size].copy()
+                   for name in ('points', 'thickness', 'colors', 'stroke_ids', 'kinds')}
+        records['figure'] = self.figures.pop(int(stroke_id), None)
+
+        self.size = start
+        self.anchor = start
+        self.broken = True
+        return records
+
+    def push_stroke(self, records):
+        """
+        adds back to the end of the history a stroke removed by pop_stroke
+        """
+
+        n = len(records['kinds'])
+        while self.size + n > len(self.kinds):
+            self.grow()
+        for name in ('points', 'thickness', 'colors', 'stroke_ids', 'kinds'):
+            getattr(self, name)[self.size:self.size + n] = records[name]
+        stroke_id = int(records['stroke_ids'][0])
+        if records['figure'] is not None:
+            self.figures[stroke_id] = records['figure']
+
+        self.size += n
+        self.strokes = max(self.strokes, stroke_id + 1)
+        self.anchor = self.size
+        self.broken = True
+
+    def drop_strokes_before(self, stroke_id):
+        """
+        forgets every stroke older than the one with the given id (once they're baked into the canvas, they no
+        longer need to be kept)
+        """
+
+        start = int(np.searchsorted(self.stroke_ids[:self.size], stroke_id))
+        if start == 0:
+            return
+        for name in ('points', 'thickness', 'colors', 'stroke_ids', 'kinds'):
+            array = getattr(self, name)
+            array[:self.size - start] = array[start:self.size]
+        for old_id in [i for i in self.figures if i < stroke_id]:
+            del self.figures[old_id]
+        self.size -= start
+        self.anchor = max(0, self.anchor - start)
+
+    def used_bytes(self, from_stroke=None):
+        """
+        returns the memory taken by the records in the history (or only by the strokes from the one with the given
+        id on), in bytes; unlike nbytes, the spare capacity of the arrays isn't counted
+        """
+
+        start = int(np.searchsorted(self.stroke_ids[:self.size], from_stroke)) if from_stroke is not None else 0
+        return (self.size - start) * (self.points.itemsize*2 + self.thickness.itemsize + self.colors.itemsize*3 +
+                            self.stroke_ids.itemsize + self.kinds.itemsize)
+
+    def stroke_range(self, stroke_id):
+        """
+        returns the (start, end) record indexes of the stroke with the given id
+        """
+
+        ids = self.stroke_ids[:self.size]
+        return int(np.searchsorted(ids, stroke_id)), int(np.searchsorted(ids, stroke_id, side='right'))
+
+    def stroke_bounds(self):
+        """
+        returns the (start, end) record indexes of every stroke, in order
+        """
+
+        starts = np.flatnonzero(np.diff(self.stroke_ids[:self.size])) + 1
+        starts = np.concatenate(([0], starts)) if self.size else starts
+        ends = np.concatenate((starts[1:], [self.size])) if self.size else starts
+        return zip(starts.tolist(), ends.tolist())
+
+    def render(self, image, color=None):
+        """
+        draws the whole history on an image, one polyline per stroke (plus the dots); if a color is given,
+        everything is drawn with it (which is how alpha masks are drawn)
+        """
+
+        for start, end in self.stroke_bounds():
+            kind = self.kinds[start]
+            stroke_color = color if color is not None else tuple(self.colors[start].tolist())
+            thickness = int(self.thickness[start])
+
+            if kind == self.KIND_FIGURE:
+                self.figures[int(self.stroke_ids[start])].draw(image, color)
+                continue
+            if kind == self.KIND_DOT:
+                cv2.circle(image, tuple(self.points[start].tolist()), thickness, stroke_color, -1)
+            if end - start > 1:
+                cv2.polylines(image, [self.points[start:end]], False, stroke_color, thickness)
+        return image
+
+    def __iter__(self):
+        """
+        yields the history back as Dot, Line and Figure objects
+        """
+
+        for start, end in self.stroke_bounds():
+            kind = self.kinds[start]
+            if kind == self.KIND_FIGURE:
+                yield self.figures[int(self.stroke_ids[start])]
+                continue
+            thickness = int(self.thickness[start])
+            color = tuple(self.colors[start].tolist())
+            points = [tuple(p) for p in self.points[start:end].tolist()]
+            if kind == self.KIND_DOT:
+                yield Dot(points[0], thickness, color)
+            for i in range(1, len(points)):
+                yield Line(points[i-1], points[i], thickness, color)
+
+    def nbytes(self):
+        """
+        returns the memory footprint of the history arrays, in bytes (allocated capacity included)
+        """
+
+        return self.points.nbytes + self.thickness.nbytes + self.colors.nbytes + \
+            self.stroke_ids.nbytes + self.kinds.nbytes
+
+
+class UndoHistory:
+    """
+    class 'UndoHistory': multi-level undo and redo, one stroke at a time, of the moves committed to a Canvas and
+                    a StrokeStore; before a stroke first draws on a tile of the canvas, the tile's contents are
+                    saved (zlib-compressed), so undoing a stroke just puts its tiles back, without replaying any of
+                    the history; when the saved tiles and the stroke history take more memory than the cap, the
+                    oldest strokes are baked into the canvas for good (they can no longer be undone)
+                    - canvas: the Canvas the moves are drawn on
+                    - store: the StrokeStore the moves are kept in
+                    - tile: size (in pixels) of the square tiles the canvas is split into
+                    - memory_cap: maximum memory (in bytes) for the saved tiles and the stroke history
+    """
+
+    def __init__(self, canvas, store, tile=64, memory_cap=64*1024*1024):
+        self.canvas = canvas
+        self.store = store
+        self.tile = tile
+        self.memory_cap = memory_cap
+
+        # each stroke that can be undone/redone is a dictionary with its stroke id, the saved tiles from before
+        # it was drawn ('before'), and, once undone, the tiles from after it was drawn ('after') and its records
+        # in the StrokeStore ('records')
+        self.undo_stack = []
+        self.redo_stack = []
+        self.tiles_bytes = 0 # memory taken by all the saved tiles
+
+        # SessionLog (see session_log.py) that every committed move, undo, redo and clear is written to, if any
+        self.log = None
+
+    def tile_slices(self, key):
+        tx, ty = key
+        return slice(ty*self.tile, (ty+1)*self.tile), slice(tx*self.tile, (tx+1)*self.tile)
+
+    def save_tile(self, key):
+        rows, cols = self.tile_slices(key)
+        data = zlib.compress(self.canvas.image[rows, cols].tobytes() + self.canvas.alpha[rows, cols].tobytes(), 1)
+        self.tiles_bytes += len(data)
+        return data
+
+    def restore_tile(self, key, data):
+        rows, cols = self.tile_slices(key)
+        image = self.canvas.image[rows, cols]
+        raw = np.frombuffer(zlib.decompress(data), dtype=np.uint8)
+        image[:] = raw[:image.size].reshape(image.shape)
+        self.canvas.alpha[rows, cols] = raw[image.size:].reshape(image.shape[:2])
+        self.canvas.mark_dirty((cols.start, rows.start, cols.stop, rows.stop))
+
+    def forget(self, entry):
+        for tiles in (entry['before'], entry.get('after') or {}):
+            self.tiles_bytes -= sum(len(data) for data in tiles.values())
+
+    def draw(self, move):
+        """
+        commits a move (a Dot, a Line, a Figure or None): it's added to the store and drawn on the canvas, saving
+        the tiles it's about to change first
+        """
+
+        if self.log:
+            self.log.move(move)
+        strokes = self.store.strokes
+        self.store.append(move)
+        if move is None:
+            return
+
+        # a new stroke can be undone on its own, and makes whatever was undone before impossible to redo
+        if self.store.strokes != strokes or not self.undo_stack:
+            for entry in self.redo_stack:
+                self.forget(entry)
+            self.redo_stack = []
+            self.undo_stack.append({'stroke_id': self.store.strokes - 1, 'before': {}})
+        saved = self.undo_stack[-1]['before']
+
+        h, w = self.canvas.alpha.shape
+        x0, y0, x1, y1 = move.bounds()
+        for ty in range(max(0, y0) // self.tile, (min(h, y1) - 1) // self.tile + 1):
+            for tx in range(max(0, x0) // self.tile, (min(w, x1) - 1) // self.tile + 1):
+                if (tx, ty) not in saved:
+                    saved[(tx, ty)] = self.save_tile((tx, ty))
+
+        self.canvas.draw(move)
+        self.enforce_cap()
+
+    def undo(self):
+        """
+        undoes the last stroke; returns False if there was nothing to undo
+        """
+
+        if not self.undo_stack:
+            return False
+        if self.log:
+            self.log.undo()
+        entry = self.undo_stack.pop()
+        entry['after'] = {key: self.save_tile(key) for key in entry['before']}
+        for key, data in entry['before'].items():
+            self.restore_tile(key, data)
+        entry['records'] = self.store.pop_stroke()
+        self.redo_stack.append(entry)
+        return True
+
+    def redo(self):
+        """
+        redoes the last undone stroke; returns False if there was nothing to redo
+        """
+
+        if not self.redo_stack:
+            return False
+        if self.log:
+            self.log.redo()
+        entry = self.redo_stack.pop()
+        for key, data in entry.pop('after').items():
+            self.tiles_bytes -= len(data)
+            self.restore_tile(key, data)
+        self.store.push_stroke(entry.pop('records'))
+        self.undo_stack.append(entry)
+        return True
+
+    def memory(self):
+        """
+        returns the memory taken by the saved tiles and the stroke history, in bytes
+        """
+
+        return self.tiles_bytes + self.store.used_bytes()
+
+    def enforce_cap(self):
+        """
+        bakes the oldest strokes into the canvas (forgetting their saved tiles and records) until the memory
+        taken is under the cap; the stroke being drawn is always kept
+        """
+
+        if self.memory() <= self.memory_cap:
+            return
+        # things that can't be undone anymore can't be redone either
+        for entry in self.redo_stack:
+            self.forget(entry)
+        self.redo_stack = []
+
+        # bake down to three quarters of the cap at once, so that this doesn't happen again on the next move
+        target = self.memory_cap * 3 // 4
+        baked = 0
+        tiles_bytes = self.tiles_bytes
+        while len(self.undo_stack) - baked > 1:
+            oldest = self.undo_stack[baked]
+            tiles_bytes -= sum(len(data) for data in oldest['before'].values())
+            baked += 1
+            if tiles_bytes + self.store.used_bytes(self.undo_stack[baked]['stroke_id']) <= target:
+                break
+
+        for entry in self.undo_stack[:baked]:
+            self.forget(entry)
+        del self.undo_stack[:baked]
+        self.store.drop_strokes_before(self.undo_stack[0]['stroke_id'])
+
+    def clear(self):
+        if self.log:
+            self.log.clear()
+        self.canvas.clear()
+        self.store.clear()
+        self.undo_stack = []
+        self.redo_stack = []
+        self.tiles_bytes = 0
+
+
+# Pens
+
+class PenState:
+    """
+    class 'PenState': everything one pen draws with, so that several pens can draw at the same time without
+                    breaking each other's strokes: its own canvas (one layer of the drawing), stroke and undo
+                    histories and position filter, along with its color, thickness and last position
+                    - name: name of the pen
+                    - shape: shape of the frames
+                    - color: BGR color it draws with
+                    - thickness: thickness it draws with
+                    - tolerance: stroke simplification tolerance (see StrokeStore)
+                    - memory_cap: memory (in bytes) for its undo history (see UndoHistory)
+                    - pencil_filter: filter for its position (see filters.py), or None
+    """
+
+    def __init__(self, name, shape, color, thickness=5, tolerance=0, memory_cap=64*1024*1024, pencil_filter=None):
+        self.name = name
+        self.canvas = Canvas(shape)
+        self.draw_moves = StrokeStore(tolerance=tolerance)
+        self.history = UndoHistory(self.canvas, self.draw_moves, memory_cap=memory_cap)
+        self.filter = pencil_filter
+
+        self.color = color
+        self.thickness = thickness
+        self.old_coords = (None, None)
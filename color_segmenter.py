@@ -1,9 +1,14 @@
 import cv2
 from functools import partial
+import argparse
 import json
 from os import path
+import sys
 
-from aux_functions import update_range_dict, apply_mask
+from aux_functions import update_range_dict
+from headless import open_source, KeyTimeline, Display, HeadlessDisplay
+from camera import load_config, frame_shape
+from segmentation import CHANNELS, CHANNEL_MAX, MAX_PENS, full_limits, new_pen, pen_mask, read_pens, save_pens
 
 
 def main():
@@ -12,67 +17,105 @@ def main():
                 segmentation operation, as well as the key detection aspect of the program
     """
 
-    # get the color range values to start with
-    # if we already have a 'limits.json' file in the directory, we get the previously saved values from there
+    # processing command line arguments
+    parser = argparse.ArgumentParser(description='PSR Color Segmenter')
+    parser.add_argument('-pn', '--pen', type=str, required=False, help='provide the name of the pen to set up (the first pen in limits.json by default); a new pen is added if there\'s none by that name')
+    parser.add_argument('-cs', '--color_space', choices=list(CHANNELS), required=False, help='color space the ranges of the pen are set in (bgr for new pens by default); hsv is more robust to lighting changes')
+    parser.add_argument('-cc', '--capture_config', type=str, default='capture.json', help='provide the path to the camera capture configuration written by camera.py')
+    parser.add_argument('-src', '--source', type=str, required=False, help='provide a video file or a directory with an image sequence to use instead of the camera')
+    parser.add_argument('-hl', '--headless', action='store_true', help='run without any windows, reading the key presses from the --keys file')
+    parser.add_argument('-k', '--keys', type=str, required=False, help='provide the key timeline file for headless runs (lines with a frame number and a key)')
+    parser.add_argument('-o', '--output', type=str, required=False, help='provide a directory where every frame shown is written in headless runs')
+    args = vars(parser.parse_args())
+
+    # in headless mode, windows are replaced by files and key presses are read from the timeline
+    if args['headless']:
+        try:
+            display = HeadlessDisplay(KeyTimeline(args['keys']), args['output'])
+        except (FileNotFoundError, ValueError) as error:
+            sys.exit('Couldn\'t read the key timeline: ' + str(error))
+    else:
+        display = Display()
+
+    # get the pens set up so far
+    # if we already have a 'limits.json' file in the directory, we get the previously saved pens from there
     fileAlreadyExists = path.exists('limits.json')
     if fileAlreadyExists:
-        with open('limits.json', 'r') as openfile:
-            json_object = json.load(openfile)
-            ranges = json_object['limits']
-    # if not, we start with default values
+        try:
+            pens = read_pens('limits.json')
+        except (KeyError, ValueError) as error:
+            sys.exit('Couldn\'t read limits.json: ' + str(error))
+    # if not, there are none yet
     else:
-        ranges = { 'B':{'max': 255, 'min': 0}, 'G':{'max': 255, 'min': 0}, 'R':{'max': 255, 'min': 0} }
+        pens = []
+
+    # get the pen to set up and the color range values to start with: those of the pen, if it was already set up
+    # (in the same color space), or default values otherwise
+    name = args['pen'] or (pens[0]['name'] if pens else None)
+    index = next((i for i, pen in enumerate(pens) if pen['name'] == name), len(pens))
+    if index == len(pens):
+        if index == MAX_PENS:
+            sys.exit('There can be at most ' + str(MAX_PENS) + ' pens.')
+        pens.append(new_pen(index, args['color_space'] or 'bgr', name))
+    pen = pens[index]
+    if args['color_space'] and args['color_space'] != pen['space']:
+        pen['space'] = args['color_space']
+        pen['limits'] = full_limits(pen['space'])
+    ranges = pen['limits']
 
     # set up video capture
-    capture = cv2.VideoCapture(0)
-    _, frame = capture.read()
-
-    # figure out window size from the size of the frames captured by the camera
+    try:
+        capture = open_source(args['source'], load_config(args['capture_config']))
+    except (ValueError, json.JSONDecodeError) as error:
+        sys.exit('Couldn\'t read the capture configuration: ' + str(error))
+
+    # figure out window size from the size of the frames captured by the camera (reading a frame only if the
+    # source doesn't tell it)
+    shape = frame_shape(capture)
+    if shape is None:
+        ret, frame = capture.read()
+        if not ret:
+            sys.exit('Couldn\'t read any frame from the video source.')
+        shape = frame.shape
     scale = 0.55
-    window_width = int(frame.shape[1] * scale)
-    window_height = int(frame.shape[0])
+    window_width = int(shape[1] * scale)
+    window_height = int(shape[0])
 
     # finish up the video capture setup
     window_name = 'Color segmentation'
-    cv2.namedWindow(window_name, cv2.WINDOW_NORMAL)
-    cv2.resizeWindow(window_name, window_width, window_height)
-
-    # max value for all the trackbars
-    slider_max = 255
-
-    # trackbars for R, G and B dimensions
-
-    cv2.createTrackbar('R min', window_name , ranges['R']['min'], slider_max, partial(update_range_dict, ranges=ranges, color='R', bound='min'))
-    cv2.createTrackbar('R max', window_name , ranges['R']['max'], slider_max, partial(update_range_dict, ranges=ranges, color='R', bound='max'))
-    
-    cv2.createTrackbar('G min', window_name , ranges['G']['min'], slider_max, partial(update_range_dict, ranges=ranges, color='G', bound='min'))
-    cv2.createTrackbar('G max', window_name , ranges['G']['max'], slider_max, partial(update_range_dict, ranges=ranges, color='G', bound='max'))
-    
-    cv2.createTrackbar('B min', window_name , ranges['B']['min'], slider_max, partial(update_range_dict, ranges=ranges, color='B', bound='min'))
-    cv2.createTrackbar('B max', window_name , ranges['B']['max'], slider_max, partial(update_range_dict, ranges=ranges, color='B', bound='max'))
+    display.namedWindow(window_name, cv2.WINDOW_NORMAL)
+    display.resizeWindow(window_name, (window_width, window_height))
+
+    # trackbars for the R, G and B (or H, S and V) dimensions, each up to the max value of its channel (a hue
+    # range with its min above its max wraps around, which is how reds are segmented)
+    channels = list(zip(CHANNELS[pen['space']], CHANNEL_MAX[pen['space']]))
+    if pen['space'] == 'bgr':
+        channels.reverse()
+    for color, slider_max in channels:
+        display.createTrackbar(color + ' min', window_name , ranges[color]['min'], slider_max, partial(update_range_dict, ranges=ranges, color=color, bound='min'))
+        display.createTrackbar(color + ' max', window_name , ranges[color]['max'], slider_max, partial(update_range_dict, ranges=ranges, color=color, bound='max'))
 
     # color segmentation continuous operation
     while True:
 
         # Capture frame-by-frame and display
-        _, frame = capture.read()
+        ret, frame = capture.read()
+        if not ret: # the video source ran out of frames
+            break
 
         # apply color segmentation mask to the recently captured frame 
-        mask = apply_mask(frame,ranges)
-        cv2.imshow(window_name, mask)
+        mask = pen_mask(frame, pen)
+        display.imshow(window_name, mask)
 
         # wait for a command
-        pressedKey = cv2.waitKey(1) & 0xFF
+        pressedKey = display.waitKey(1)
 
         # Quit
         if pressedKey == ord('q'):
             break
-        # Write to file
+        # Write to file (along with the other pens)
         elif pressedKey == ord('w'):
-            data = {'limits' : ranges}
-            json_object = json.dumps(data, indent=4)
-            with open("limits.json", "w") as outfile:
-                outfile.write(json_object)
+            save_pens('limits.json', pens)
             break
 
 
@@ -0,0 +1,623 @@
+import cv2
+import numpy as np
+
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from aux_functions import apply_mask, find_biggest_blob, draw_detection
+from segmentation import PenSegmenter
+
+# This file contains the pencil detectors used by the ar_paint.py script: the full-frame connected-components
+# detector, used by default, the ones that can be used in its place, and the one that detects several pens at once.
+
+
+class ViewPool:
+    """
+    class 'ViewPool': the reused detection output images of a detector; each image is taken from a free list (or
+                    allocated, if there's none of the right size) and only goes back to it once whoever got it is
+                    done with it, so that, when running in the pipeline, the processing thread never writes into
+                    an image the main thread is still displaying (the processing thread can run several frames
+                    ahead of it, since the pipeline drops the frames the main thread has no time for)
+    """
+
+    def __init__(self):
+        self.free = queue.SimpleQueue()
+
+    def take(self, shape):
+        """
+        returns a free 3-channel image of the given size, and whether it's a new one (filled with zeros)
+        """
+
+        try:
+            view = self.free.get_nowait()
+            if view.shape[:2] == shape[:2]:
+                return view, False
+        except queue.Empty:
+            pass
+        return np.zeros((shape[0], shape[1], 3), dtype=np.uint8), True
+
+    def give_back(self, view):
+        self.free.put(view)
+
+
+class BlobDetector:
+    """
+    class 'BlobDetector': detects the pencil as the biggest connected component of the color segmentation mask;
+                        cv2.connectedComponentsWithStats gives the area, bounding box and centroid of every blob
+                        in a single pass, and every per-frame image (mask, labels and detection output) is
+                        written into buffers that are allocated once and then reused
+                        - ranges: the dictionary holding the valid RBG ranges (see apply_mask)
+                        - min_area: blobs smaller than this (in pixels) are taken for noise, never for the pencil
+                        - morphology: size (in pixels) of the kernel of the morphological opening (which removes
+                                    specks) and closing (which fills small holes) applied to the mask; 0 for none
+    """
+
+    def __init__(self, ranges, min_area=0, morphology=0):
+        self.ranges = ranges
+        self.min_area = min_area
+        self.kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (morphology, morphology)) if morphology > 1 else None
+
+        self.mask = None
+        self.labels = None
+        # reused images for the detection output (see release_view)
+        self.views = ViewPool()
+
+        # label of the last pencil blob in self.labels (0 if there was none)
+        self.label = 0
+
+    def allocate(self, shape):
+        h, w = shape[:2]
+        if self.mask is None or self.mask.shape != (h, w):
+            self.mask = np.empty((h, w), dtype=np.uint8)
+            self.labels = np.empty((h, w), dtype=np.int32)
+
+    def next_view(self, shape):
+        """
+        returns a free detection output image (see release_view)
+        """
+
+        return self.views.take(shape)[0]
+
+    def release_view(self, view):
+        """
+        gives back a detection output image once it's been displayed, so that it can be reused; the images that
+        aren't given back are simply left to the garbage collector
+        """
+
+        self.views.give_back(view)
+
+    def find(self, frame, view=None):
+        """
+        finds the pencil on a camera frame
+            INPUT:
+                - frame: camera frame
+                - view: 3-channel image the mask is also written into (the start of the detection output), if any
+            OUTPUT:
+                - (cX, cY): the coordinates of the centroid of the pencil blob, or (None, None) if there's none
+                - area: its area, in pixels (0 if there's no blob)
+                - bbox: its (x, y, width, height) bounding box, or None if there's no blob
+        """
+
+        self.allocate(frame.shape)
+        apply_mask(frame, self.ranges, self.mask)
+        self.clean_mask()
+        if view is not None:
+            cv2.merge((self.mask, self.mask, self.mask), view)
+        return self.find_in_mask()
+
+    def clean_mask(self, roi=None):
+        if self.kernel is not None:
+            mask = self.mask if roi is None else self.mask[roi[1]:roi[3], roi[0]:roi[2]]
+            cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel, mask)
+            cv2.morphologyEx(mask, cv2.MORPH_CLOSE, self.kernel, mask)
+
+    def find_in_mask(self, roi=None):
+        """
+        finds the pencil on the mask, once it's been segmented (and cleaned up); it has the same output as find
+            INPUT:
+                - roi: (x0, y0, x1, y1) rectangle outside of which the mask is taken to be empty (and isn't read),
+                    or None for the whole mask
+        """
+
+        # labelling only has to go over the part of the mask that holds any blob, which is usually a small
+        # fraction of it (finding that part is several times cheaper than labelling the whole mask)
+        self.label = 0
+        x0, y0, x1, y1 = roi if roi is not None else (0, 0, self.mask.shape[1], self.mask.shape[0])
+        rx, ry, rw, rh = cv2.boundingRect(self.mask[y0:y1, x0:x1])
+        if rw == 0:
+            return (None, None), 0, None
+        rx, ry = rx + x0, ry + y0
+        count, _, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+            self.mask[ry:ry+rh, rx:rx+rw], 8, cv2.CV_32S, cv2.CCL_GRANA, self.labels[ry:ry+rh, rx:rx+rw])
+        # label 0 is the background
+        label = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+        area = int(stats[label, cv2.CC_STAT_AREA])
+        if area < self.min_area:
+            return (None, None), 0, None
+
+        self.label = label
+        x, y, w, h = (int(v) for v in stats[label, :4])
+        return (int(centroids[label][0]) + rx, int(centroids[label][1]) + ry), area, (x + rx, y + ry, w, h)
+
+    def detect(self, frame):
+        """
+        detects the pencil on a camera frame; it has the same output as detect_pencil in aux_functions.py, with
+        the blobs that are too small shown in white like any other object
+        """
+
+        # the mask as it is, with all objects in white
+        view = self.next_view(frame.shape)
+        centroid, _, bbox = self.find(frame, view)
+        self.draw_pencil(view, centroid, bbox)
+        return centroid, view
+
+    def draw_pencil(self, view, centroid, bbox, origin=(0, 0)):
+        """
+        marks the pencil blob found by find_in_mask on a detection output image the mask was written into
+            INPUT:
+                - view: the detection output image, or the part of it that has its top-left corner at 'origin' in
+                    the frame (nothing is drawn outside of it)
+                - centroid, bbox: the centroid and bounding box of the pencil blob, as returned by find_in_mask
+        """
+
+        if bbox is None:
+            return
+
+        # make the pencil blob green, which only changes the blue and red channels inside its bounding box
+        x, y, w, h = bbox
+        ox, oy = origin
+        others = self.other_objects(x, y, w, h)
+        view[y-oy:y-oy+h, x-ox:x-ox+w, 0] = others
+        view[y-oy:y-oy+h, x-ox:x-ox+w, 2] = others
+
+        # draw small red cross to indicate the centroid point
+        cX, cY = centroid[0] - ox, centroid[1] - oy
+        cv2.line(view, (cX-8, cY-8), (cX+8, cY+8), (0, 0, 255), 5)
+        cv2.line(view, (cX+8, cY-8), (cX-8, cY+8), (0, 0, 255), 5)
+
+    def other_objects(self, x, y, w, h):
+        """
+        returns the part of the mask inside the given rectangle, without the pencil blob
+        """
+
+        # a single pixel box holds nothing but the pencil (and OpenCV can't tell a 1x1 image from a scalar)
+        if w == 1 and h == 1:
+            return np.zeros((1, 1), dtype=np.uint8)
+        others = cv2.compare(self.labels[y:y+h, x:x+w], self.label, cv2.CMP_NE)
+        return cv2.bitwise_and(others, self.mask[y:y+h, x:x+w], others)
+
+    def close(self):
+        pass
+
+
+class BandBlobDetector(BlobDetector):
+    """
+    class 'BandBlobDetector': a BlobDetector that splits each frame into horizontal bands, which are segmented and
+                            labelled in parallel by a pool of worker threads (OpenCV releases the GIL, so they
+                            run on separate cores); the workers read the frame and write the mask, the labels and
+                            the detection output straight into the shared buffers, so nothing is copied between
+                            them, and the blobs that cross the edge between two bands are merged back together
+                            - ranges, min_area, morphology: see BlobDetector
+                            - workers: number of worker threads (and of bands); None for one per CPU core
+    """
+
+    def __init__(self, ranges, min_area=0, morphology=0, workers=None):
+        BlobDetector.__init__(self, ranges, min_area, morphology)
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(self.workers)
+
+        # the morphology (an erosion and a dilation for the opening, and again for the closing) sees this many rows
+        # beyond each edge of a band, so each band is segmented with that many extra rows above and below it
+        self.halo = 0 if self.kernel is None else 4 * (self.kernel.shape[0] // 2)
+        self.bands = []   # (first row, end row) of each band
+        self.scratch = [] # mask of each band, with the extra rows (only used with morphology)
+
+        # the blobs that make up the pencil, as a dictionary from band index to their labels in that band
+        self.members = {}
+
+    def allocate(self, shape):
+        h, w = shape[:2]
+        if self.mask is not None and self.mask.shape == (h, w):
+            return
+        BlobDetector.allocate(self, shape)
+        edges = np.linspace(0, h, min(self.workers, h) + 1).astype(int)
+        self.bands = list(zip(edges[:-1], edges[1:]))
+        if self.halo:
+            self.scratch = [np.empty((min(h, b1 + self.halo) - max(0, b0 - self.halo), w), dtype=np.uint8)
+                            for b0, b1 in self.bands]
+
+    def segment_band(self, index, frame, view):
+        """
+        segments and labels one band (this runs on a worker thread)
+            OUTPUT:
+                - [return value]: the stats and centroids of the blobs of the band (in frame coordinates), without
+                                the background, or None if the band has no blobs
+        """
+
+        b0, b1 = self.bands[index]
+        mask = self.mask[b0:b1]
+        if self.halo:
+            h0, h1 = max(0, b0 - self.halo), min(frame.shape[0], b1 + self.halo)
+            scratch = self.scratch[index]
+            apply_mask(frame[h0:h1], self.ranges, scratch)
+            cv2.morphologyEx(scratch, cv2.MORPH_OPEN, self.kernel, scratch)
+            cv2.morphologyEx(scratch, cv2.MORPH_CLOSE, self.kernel, scratch)
+            mask[:] = scratch[b0-h0:b1-h0]
+        else:
+            apply_mask(frame[b0:b1], self.ranges, mask)
+        if view is not None:
+            cv2.merge((mask, mask, mask), view[b0:b1])
+
+        rx, ry, rw, rh = cv2.boundingRect(mask)
+        if rw == 0:
+            return None
+        _, _, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(
+            mask[ry:ry+rh, rx:rx+rw], 8, cv2.CV_32S, cv2.CCL_GRANA, self.labels[b0+ry:b0+ry+rh, rx:rx+rw])
+        stats, centroids = stats[1:], centroids[1:]
+        stats[:, cv2.CC_STAT_LEFT] += rx
+        stats[:, cv2.CC_STAT_TOP] += b0 + ry
+        return stats, centroids + (rx, b0 + ry)
+
+    def edge_pairs(self, row):
+        """
+        returns the (label above, label below) pairs of the blobs that touch across the edge between a row (the
+        last one of a band) and the next one (the first one of the next band)
+        """
+
+        w = self.mask.shape[1]
+        above, below = self.mask[row] > 0, self.mask[row + 1] > 0
+        pairs = []
+        for d in (-1, 0, 1): # 8-connectivity: a pixel touches the 3 pixels below it
+            a0, b0, n = max(0, -d), max(0, d), w - abs(d)
+            cols = np.flatnonzero(above[a0:a0+n] & below[b0:b0+n])
+            pairs.append(np.stack((self.labels[row, cols + a0], self.labels[row + 1, cols + b0]), axis=1))
+        return np.unique(np.concatenate(pairs), axis=0)
+
+    def find(self, frame, view=None):
+        self.allocate(frame.shape)
+        results = list(self.pool.map(partial(self.segment_band, frame=frame, view=view), range(len(self.bands))))
+
+        # the blobs of all bands get global ids, those of each band after those of the bands above it
+        self.label = 0
+        self.members = {}
+        found = [(i, r) for i, r in enumerate(results) if r is not None]
+        if not found:
+            return (None, None), 0, None
+        first_id, bands, labels, stats, centroids = {}, [], [], [], []
+        count = 0
+        for i, (band_stats, band_centroids) in found:
+            first_id[i] = count
+            count += len(band_stats)
+            bands.append(np.full(len(band_stats), i))
+            labels.append(np.arange(1, len(band_stats) + 1))
+            stats.append(band_stats)
+            centroids.append(band_centroids)
+        bands, labels = np.concatenate(bands), np.concatenate(labels)
+        stats, centroids = np.concatenate(stats), np.concatenate(centroids)
+
+        # merge the blobs that touch across band edges (union-find, with every blob pointing to the one it was
+        # merged into, and then straight to the root of its group)
+        parent = np.arange(count)
+        def root(i):
+            while parent[i] != i:
+                i = parent[i]
+            return i
+        for i in range(len(self.bands) - 1):
+            if i in first_id and i + 1 in first_id:
+                for above, below in self.edge_pairs(self.bands[i][1] - 1):
+                    a, b = root(first_id[i] + above - 1), root(first_id[i+1] + below - 1)
+                    if a != b:
+                        parent[max(a, b)] = min(a, b)
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+        # stats of the merged blobs: total area, centroid and bounding box of the whole group; the centroid comes
+        # from the exact (integer) sums of the coordinates of each blob's pixels, so that it's truncated just like
+        # BlobDetector's (weighting the centroids of the blobs in floating point can land just below an integer)
+        areas = stats[:, cv2.CC_STAT_AREA].astype(np.int64)
+        group_areas = np.bincount(parent, weights=areas, minlength=count)
+        pencil = int(np.argmax(group_areas))
+        area = int(group_areas[pencil])
+        if area < self.min_area:
+            return (None, None), 0, None
+
+        members = parent == pencil
+        sums = np.rint(centroids[members] * areas[members, None]).astype(np.int64).sum(axis=0)
+        cX, cY = int(sums[0]) // area, int(sums[1]) // area
+        x0 = int(stats[members, cv2.CC_STAT_LEFT].min())
+        y0 = int(stats[members, cv2.CC_STAT_TOP].min())
+        x1 = int((stats[members, cv2.CC_STAT_LEFT] + stats[members, cv2.CC_STAT_WIDTH]).max())
+        y1 = int((stats[members, cv2.CC_STAT_TOP] + stats[members, cv2.CC_STAT_HEIGHT]).max())
+        for band, label in zip(bands[members], labels[members]):
+            self.members.setdefault(int(band), []).append(int(label))
+        return (cX, cY), area, (x0, y0, x1 - x0, y1 - y0)
+
+    def other_objects(self, x, y, w, h):
+        others = np.empty((h, w), dtype=np.uint8)
+        for i, (b0, b1) in enumerate(self.bands):
+            r0, r1 = max(y, b0), min(y + h, b1)
+            if r0 >= r1:
+                continue
+            pencil = np.isin(self.labels[r0:r1, x:x+w], self.members.get(i, []))
+            others[r0-y:r1-y] = np.where(pencil, 0, self.mask[r0:r1, x:x+w])
+        return others
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class MultiPenDetector:
+    """
+    class 'MultiPenDetector': detects several pens at once, each as the biggest blob of its own color; the frame is
+                            labelled for all the pens in a single pass (see PenSegmenter in segmentation.py), and
+                            the mask of each pen is then cleaned up and searched like in BlobDetector
+                            - pens: list of pens (see segmentation.py)
+                            - min_area, morphology: see BlobDetector
+    """
+
+    def __init__(self, pens, min_area=0, morphology=0):
+        self.segmenter = PenSegmenter(pens)
+        self.blobs = [BlobDetector(pen['limits'], min_area, morphology) for pen in pens]
+        # the morphology sees this many pixels beyond the pixels it works on (see BandBlobDetector)
+        self.halo = 0 if self.blobs[0].kernel is None else 4 * (self.blobs[0].kernel.shape[0] // 2)
+
+        # tables (one per channel) that give the labels of each pixel the color of the first of its pens (black if
+        # it has none), for the detection output; three single channel lookups and a merge are about twice as fast
+        # as a 3-channel lookup
+        self.palette = np.zeros((3, 256), dtype=np.uint8)
+        for value in range(1, 256):
+            first = (value & -value).bit_length() - 1
+            if first < len(pens):
+                self.palette[:, value] = pens[first]['color']
+        self.planes = None
+
+        # reused images for the detection output (see BlobDetector)
+        self.views = ViewPool()
+
+    def detect(self, frame):
+        """
+        detects the pens on a camera frame
+            OUTPUT:
+                - [return value 1]: list with the coordinates of the centroid of each pen, or (None, None) for the
+                                pens that weren't found
+                - [return value 2]: image with the pixels of each pen in its color, and a white cross on each
+                                centroid
+        """
+
+        labels = self.segmenter.segment(frame)
+        view, new = self.views.take(frame.shape)
+        if not new:
+            view[:] = 0
+
+        # the pixels of every pen lie within the bounding box of all the labelled pixels, which is usually a small
+        # part of the frame, so the masks of the pens are only worked on there (and around it, as far as the
+        # morphology sees)
+        h, w = labels.shape
+        rx, ry, rw, rh = cv2.boundingRect(labels)
+        if rw == 0:
+            return [(None, None)] * len(self.blobs), view
+        roi = (max(0, rx - self.halo), max(0, ry - self.halo), min(w, rx + rw + self.halo), min(h, ry + rh + self.halo))
+        x0, y0, x1, y1 = roi
+        if self.planes is None or self.planes[0].shape != (h, w):
+            self.planes = [np.empty((h, w), dtype=np.uint8) for _ in range(3)]
+        for c in range(3):
+            cv2.LUT(labels[y0:y1, x0:x1], self.palette[c], self.planes[c][y0:y1, x0:x1])
+        cv2.merge([plane[y0:y1, x0:x1] for plane in self.planes], view[y0:y1, x0:x1])
+
+        centroids = []
+        for k, blob in enumerate(self.blobs):
+            blob.allocate(frame.shape)
+            self.segmenter.pen_mask(k, blob.mask, roi)
+            blob.clean_mask(roi)
+            centroid, _, _ = blob.find_in_mask(roi)
+            centroids.append(centroid)
+            if centroid[0] is not None:
+                cX, cY = centroid
+                cv2.line(view, (cX-8, cY-8), (cX+8, cY+8), (255, 255, 255), 5)
+                cv2.line(view, (cX+8, cY-8), (cX-8, cY+8), (255, 255, 255), 5)
+        return centroids, view
+
+    def release_view(self, view):
+        # see BlobDetector
+        self.views.give_back(view)
+
+    def close(self):
+        pass
+
+
+class PencilTracker(BlobDetector):
+    """
+    class 'PencilTracker': a BlobDetector that searches for the pencil only in a window (region of interest) around
+                        its last centroid, since it barely moves between frames: only the window is segmented,
+                        cleaned up and labelled (into the same buffers as a full-frame search); the window is sized
+                        according to the size and speed of the blob, grows whenever the blob touches its edges
+                        and, when the blob is lost, the tracker falls back to a full-frame search
+                        - ranges, min_area, morphology: see BlobDetector
+                        - min_radius: minimum half-size of the search window, in pixels
+                        - margin: how many times the size of the blob (plus its last motion) the half-size of
+                                the window should be
+    """
+
+    def __init__(self, ranges, min_area=0, morphology=0, min_radius=64, margin=2.0):
+        BlobDetector.__init__(self, ranges, min_area, morphology)
+        self.min_radius = min_radius
+        self.margin = margin
+
+        # the morphology sees this many pixels beyond the pixels it works on (see BandBlobDetector), so the mask is
+        # segmented and cleaned up that far around the window, for the window itself to come out as in a full search
+        self.halo = 0 if self.kernel is None else 4 * (self.kernel.shape[0] // 2)
+
+        self.center = None  # last centroid, or None if the pencil is lost
+        self.radius = min_radius
+        # the search window last drawn on each detection output image, as (x0, y0, x1, y1), by the id of the image
+        # (None for those last drawn whole, by a full-frame search), so that only that window has to be cleared
+        # when the image is reused
+        self.view_rois = {}
+
+        # counters: frames the pencil was found in the search window on, and searches of each kind (a frame can
+        # take several window searches, as the window grows, and then a full-frame search if it's lost)
+        self.frames = 0
+        self.roi_hits = 0
+        self.roi_searches = 0
+        self.full_searches = 0
+
+    def detect(self, frame):
+        """
+        detects the pencil on a camera frame; it has the same output as BlobDetector.detect, except that, when
+        tracking, the output image only shows the search window (outlined in yellow)
+        """
+
+        h, w = frame.shape[:2]
+        self.allocate(frame.shape)
+        self.frames += 1
+
+        while self.center is not None:
+            cX, cY = self.center
+            x0, y0 = max(0, cX - self.radius), max(0, cY - self.radius)
+            x1, y1 = min(w, cX + self.radius), min(h, cY + self.radius)
+
+            # the window covers the whole frame, so we might as well do a full search
+            if (x0, y0, x1, y1) == (0, 0, w, h):
+                break
+
+            self.roi_searches += 1
+            sx0, sy0 = max(0, x0 - self.halo), max(0, y0 - self.halo)
+            sx1, sy1 = min(w, x1 + self.halo), min(h, y1 + self.halo)
+            apply_mask(frame[sy0:sy1, sx0:sx1], self.ranges, self.mask[sy0:sy1, sx0:sx1])
+            self.clean_mask((sx0, sy0, sx1, sy1))
+            centroid, _, bbox = self.find_in_mask((x0, y0, x1, y1))
+
+            # lost the pencil
+            if bbox is None:
+                self.center = None
+                break
+
+            # if the blob touches an edge of the window (that isn't an edge of the frame), part of it may be
+            # outside, so we grow the window and search again
+            bx, by, bw, bh = bbox
+            if (bx == x0 and x0 > 0) or (by == y0 and y0 > 0) or (bx + bw == x1 and x1 < w) or (by + bh == y1 and y1 < h):
+                self.radius *= 2
+                continue
+
+            # found it: adapt the window to the size of the blob and how much it just moved
+            motion = max(abs(centroid[0] - cX), abs(centroid[1] - cY))
+            self.radius = max(self.min_radius, int(self.margin * (max(bw, bh) / 2 + motion)))
+            self.center = centroid
+            self.roi_hits += 1
+            return centroid, self.draw_window(frame.shape, (x0, y0, x1, y1), centroid, bbox)
+
+        # full-frame search
+        self.full_searches += 1
+        view = self.next_view(frame.shape)
+        centroid, _, bbox = self.find(frame, view)
+        self.draw_pencil(view, centroid, bbox)
+        self.view_rois[id(view)] = None
+        if bbox is not None:
+            self.center = centroid
+            self.radius = max(self.min_radius, int(self.margin * max(bbox[2], bbox[3]) / 2))
+        return centroid, view
+
+    def draw_window(self, shape, roi, centroid, bbox):
+        """
+        draws the detection output of the search window on a full-size black image (of those that are reused, only
+        the window last drawn on it is cleared)
+        """
+
+        view, new = self.views.take(shape)
+        last_roi = self.view_rois.pop(id(view), None)
+        if not new and last_roi is None:
+            view[:] = 0
+        elif not new:
+            px0, py0, px1, py1 = last_roi
+            view[max(0, py0-1):py1+1, max(0, px0-1):px1+1] = 0 # the window outline lies just outside it
+
+        x0, y0, x1, y1 = roi
+        window = view[y0:y1, x0:x1]
+        cv2.merge((self.mask[y0:y1, x0:x1],) * 3, window)
+        self.draw_pencil(window, centroid, bbox, (x0, y0))
+        cv2.rectangle(view, (x0-1, y0-1), (x1, y1), (0, 255, 255), 1)
+        self.view_rois[id(view)] = roi
+        return view
+
+    def stats(self):
+        """
+        returns a dictionary with the frames searched, those the pencil was found in the search window on (and
+        the fraction they are of the total, the ROI hit rate), and the window and full-frame searches done
+        """
+
+        return {
+            'frames': self.frames,
+            'roi_hits': self.roi_hits,
+            'roi_hit_rate': self.roi_hits / self.frames if self.frames else 0.0,
+            'roi_searches': self.roi_searches,
+            'full_searches': self.full_searches,
+        }
+
+
+class MultiScaleDetector:
+    """
+    class 'MultiScaleDetector': detects the pencil on a downscaled copy of the frame, which is much cheaper at
+                            high resolutions, and then refines its centroid on a small full-resolution patch
+                            around the blob, so that the strokes keep full-resolution accuracy
+                            - ranges: the dictionary holding the valid RBG ranges (see apply_mask)
+                            - factor: how many times smaller (in each dimension) the frame is made for the
+                                    search
+                            - pyramid: if True, the frame is downscaled with an image pyramid (successive
+                                    Gaussian halvings, so the factor is rounded to a power of 2), which is
+                                    smoother but reads the whole frame; otherwise pixels are simply sampled
+                                    (nearest neighbour), which only reads the pixels it keeps
+    """
+
+    def __init__(self, ranges, factor=4, pyramid=False):
+        self.ranges = ranges
+        self.pyramid = pyramid
+        self.levels = max(1, int(round(np.log2(factor)))) if pyramid else 0
+        self.factor = 2**self.levels if pyramid else factor
+
+    def downscale(self, frame):
+        if self.pyramid:
+            for _ in range(self.levels):
+                frame = cv2.pyrDown(frame)
+            return frame
+        h, w = frame.shape[:2]
+        return cv2.resize(frame, (max(1, int(w / self.factor)), max(1, int(h / self.factor))), interpolation=cv2.INTER_NEAREST)
+
+    def detect(self, frame):
+        """
+        detects the pencil on a camera frame; it has the same output as detect_pencil in aux_functions.py, except
+        that the output image is the downscaled one (HighGUI windows scale it to their size anyway)
+        """
+
+        h, w = frame.shape[:2]
+        small = self.downscale(frame)
+        scale_x, scale_y = w / small.shape[1], h / small.shape[0]
+
+        # coarse search on the downscaled frame
+        small_mask = apply_mask(small, self.ranges)
+        cnt, centroid = find_biggest_blob(small_mask)
+        view = draw_detection(small_mask, cnt, centroid)
+        if centroid[0] is None:
+            return centroid, view
+
+        # full-resolution patch around the blob, with a margin of one downscaled pixel (plus one, for rounding)
+        bx, by, bw, bh = cv2.boundingRect(cnt)
+        x0, y0 = max(0, int((bx - 2) * scale_x)), max(0, int((by - 2) * scale_y))
+        x1, y1 = min(w, int((bx + bw + 2) * scale_x)), min(h, int((by + bh + 2) * scale_y))
+
+        # refine the centroid with the moments of the biggest blob in the patch
+        patch_mask = apply_mask(frame[y0:y1, x0:x1], self.ranges)
+        patch_cnt, _ = find_biggest_blob(patch_mask)
+        M = cv2.moments(patch_cnt) if patch_cnt is not None else {'m00': 0}
+        if M['m00'] == 0:
+            # the blob is too thin to be found at full resolution, so we keep the coarse centroid
+            precise_centroid = (centroid[0] * scale_x, centroid[1] * scale_y)
+        else:
+            precise_centroid = (M['m10'] / M['m00'] + x0, M['m01'] / M['m00'] + y0)
+
+        cX, cY = int(round(precise_centroid[0])), int(round(precise_centroid[1]))
+        return (cX, cY), view
@@ -0,0 +1,215 @@
+import cv2
+import numpy as np
+from math import pi, sqrt
+
+# This file contains the pencil filters that can be used by the ar_paint.py script to smooth the jitter of the
+# detected pencil position, predict where the pencil is going (to hide the latency of the program) and reject
+# outliers (such as a stray blob being detected for a single frame).
+
+
+class PencilFilter:
+    """
+    class 'PencilFilter': base class of the pencil filters; each filter gets the detected pencil coordinates of every
+                    frame along with their timestamp and returns the filtered coordinates; the outlier rejection
+                    and the handling of lost pencils are common to all of them
+                    - predict: how far ahead (in seconds) the returned position is predicted
+                    - max_rejections: after this many consecutive outliers, the filter accepts that the pencil
+                                    really moved there and starts over from the new position
+    """
+
+    def __init__(self, predict=0.0, max_rejections=3):
+        self.predict = predict
+        self.max_rejections = max_rejections
+
+        self.last_time = None
+        self.rejections = 0  # consecutive outliers
+
+        # counters
+        self.updates = 0
+        self.outliers = 0
+
+    def reset(self):
+        self.last_time = None
+        self.rejections = 0
+
+    def update(self, coords, timestamp):
+        """
+        filters a new detection
+            INPUT:
+                - coords: detected pencil coordinates, (None, None) if the pencil wasn't detected
+                - timestamp: time of the detection, in seconds
+            OUTPUT:
+                - [return value]: filtered (and predicted) coordinates, as ints, or (None, None)
+        """
+
+        # a lost pencil ends the stroke, so the next detection starts the filter over
+        if coords[0] is None:
+            self.reset()
+            return (None, None)
+
+        self.updates += 1
+        z = np.array(coords, dtype=np.float64)
+        if self.last_time is None:
+            self.start(z)
+        else:
+            dt = max(timestamp - self.last_time, 1e-3)
+            if self.is_outlier(z, dt) and self.rejections < self.max_rejections:
+                # keep following the prediction, ignoring the measurement
+                self.rejections += 1
+                self.outliers += 1
+                self.coast(dt)
+            else:
+                if self.rejections >= self.max_rejections:
+                    self.start(z)
+                else:
+                    self.correct(z, dt)
+                self.rejections = 0
+        self.last_time = timestamp
+
+        position, velocity = self.state()
+        x, y = position + velocity * self.predict
+        return (int(round(x)), int(round(y)))
+
+    # methods implemented by each filter
+    def start(self, z):
+        raise NotImplementedError
+
+    def is_outlier(self, z, dt):
+        raise NotImplementedError
+
+    def coast(self, dt):
+        raise NotImplementedError
+
+    def correct(self, z, dt):
+        raise NotImplementedError
+
+    def state(self):
+        raise NotImplementedError
+
+
+class KalmanPencilFilter(PencilFilter):
+    """
+    class 'KalmanPencilFilter': constant-velocity Kalman filter (state: position and velocity); outliers are
+                            detections whose Mahalanobis distance to the predicted position is beyond the gate
+                            - process_noise: acceleration noise (pixels/s^2), i.e. how quickly the velocity
+                                        may change; higher follows the hand more closely, lower smooths more
+                            - measurement_noise: standard deviation of the detection jitter, in pixels
+                            - gate: squared Mahalanobis distance above which a detection is an outlier (13.8
+                                    is the 99.9% quantile for 2 degrees of freedom)
+    """
+
+    def __init__(self, predict=0.0, process_noise=3000.0, measurement_noise=2.0, gate=13.8, max_rejections=3):
+        PencilFilter.__init__(self, predict, max_rejections)
+        self.process_noise = process_noise
+        self.gate = gate
+
+        self.kalman = cv2.KalmanFilter(4, 2)
+        self.kalman.measurementMatrix = np.array([[1, 0, 0, 0], [0, 1, 0, 0]], dtype=np.float32)
+        self.kalman.measurementNoiseCov = np.eye(2, dtype=np.float32) * measurement_noise**2
+
+    def set_dt(self, dt):
+        self.kalman.transitionMatrix = np.array([[1, 0, dt, 0], [0, 1, 0, dt], [0, 0, 1, 0], [0, 0, 0, 1]], dtype=np.float32)
+        # white acceleration noise model
+        q = self.process_noise**2
+        self.kalman.processNoiseCov = np.array([[dt**4/4, 0, dt**3/2, 0], [0, dt**4/4, 0, dt**3/2],
+                                                [dt**3/2, 0, dt**2, 0], [0, dt**3/2, 0, dt**2]], dtype=np.float32) * q
+
+    def start(self, z):
+        self.kalman.statePost = np.array([[z[0]], [z[1]], [0], [0]], dtype=np.float32)
+        self.kalman.errorCovPost = np.diag([4, 4, 1e6, 1e6]).astype(np.float32)
+
+    def is_outlier(self, z, dt):
+        self.set_dt(dt)
+        self.kalman.predict()
+        H = self.kalman.measurementMatrix
+        S = H @ self.kalman.errorCovPre @ H.T + self.kalman.measurementNoiseCov
+        y = z.reshape(2, 1) - H @ self.kalman.statePre
+        return float((y.T @ np.linalg.inv(S) @ y)[0, 0]) > self.gate
+
+    def coast(self, dt):
+        # predict() was already called by is_outlier; without a measurement, the prediction becomes the estimate
+        self.kalman.statePost = self.kalman.statePre.copy()
+        self.kalman.errorCovPost = self.kalman.errorCovPre.copy()
+
+    def correct(self, z, dt):
+        self.kalman.correct(z.reshape(2, 1).astype(np.float32))
+
+    def state(self):
+        s = self.kalman.statePost.ravel().astype(np.float64)
+        return s[:2], s[2:]
+
+
+class OneEuroPencilFilter(PencilFilter):
+    """
+    class 'OneEuroPencilFilter': the One Euro filter (Casiez et al., 2012), a low-pass filter whose cutoff frequency
+                            goes up with the speed of the pencil, so it smooths the jitter when the pencil is
+                            slow and barely lags when it's fast; outliers are detections that are too far from
+                            the expected position, compared to the usual distance (tracked as a running variance)
+                            - min_cutoff: cutoff frequency (Hz) when the pencil is still; lower smooths more
+                            - beta: how much the cutoff goes up with the speed; higher lags less
+                            - d_cutoff: cutoff frequency (Hz) of the speed estimate
+                            - gate: how many standard deviations away a detection has to be to be an outlier
+                            - min_gate: distance (pixels) below which a detection is never an outlier
+    """
+
+    def __init__(self, predict=0.0, min_cutoff=1.0, beta=0.05, d_cutoff=1.0, gate=6.0, min_gate=40.0, max_rejections=3):
+        PencilFilter.__init__(self, predict, max_rejections)
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.gate = gate
+        self.min_gate = min_gate
+
+    @staticmethod
+    def alpha(cutoff, dt):
+        tau = 1 / (2*pi*cutoff)
+        return 1 / (1 + tau/dt)
+
+    def start(self, z):
+        self.position = z
+        self.velocity = np.zeros(2)
+        self.residual_var = self.min_gate**2 / self.gate**2
+
+    def is_outlier(self, z, dt):
+        residual = z - (self.position + self.velocity*dt)
+        distance2 = float(residual @ residual)
+        return distance2 > max(self.min_gate**2, self.gate**2 * self.residual_var)
+
+    def coast(self, dt):
+        self.position = self.position + self.velocity*dt
+
+    def correct(self, z, dt):
+        residual = z - (self.position + self.velocity*dt)
+        self.residual_var = 0.9*self.residual_var + 0.1*float(residual @ residual)
+
+        # filtered speed, then position filtered with a cutoff that depends on it
+        a_d = self.alpha(self.d_cutoff, dt)
+        self.velocity = a_d*(z - self.position)/dt + (1 - a_d)*self.velocity
+        cutoff = self.min_cutoff + self.beta*sqrt(float(self.velocity @ self.velocity))
+        a = self.alpha(cutoff, dt)
+        self.position = a*z + (1 - a)*self.position
+
+    def state(self):
+        return self.position, self.velocity
+
+
+# filters by name, as chosen on the command line
+FILTERS = {
+    'kalman': KalmanPencilFilter,
+    'oneeuro': OneEuroPencilFilter,
+}
+
+
+def make_filter(name, predict=0.0):
+    """
+    function make_filter: creates a pencil filter by name
+        INPUT:
+            - name: one of the names in FILTERS, or 'none'
+            - predict: how far ahead (in seconds) the filter predicts the pencil position
+        OUTPUT:
+            - [return value]: the filter, or None for 'none'
+    """
+
+    if name == 'none':
+        return None
+    return FILTERS[name](predict)
@@ -0,0 +1,186 @@
+import cv2
+from os import path, listdir, makedirs
+
+from camera import DEFAULT_CONFIG, open_camera
+
+# This file contains the frame sources and displays that allow the ar_paint.py and color_segmenter.py scripts to
+# replay recorded sessions (video files or image sequences) without a camera and, if needed, without a display.
+
+
+# extensions of the files considered when reading an image sequence directory
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff', '.webp')
+
+# names that can be used in a key timeline file for keys that aren't printable characters
+KEY_NAMES = {'space': ord(' '), 'plus': ord('+'), 'minus': ord('-')}
+
+# value returned by cv2.waitKey(...) & 0xFF when no key is pressed
+NO_KEY = 0xFF
+
+
+class ImageSequenceCapture:
+    """
+    class 'ImageSequenceCapture': reads the images of a directory, sorted by file name, as if they were
+                            the frames of a video; it has the same read/release interface as
+                            cv2.VideoCapture so that it can be used in its place
+    """
+
+    def __init__(self, directory):
+        self.files = sorted(path.join(directory, f) for f in listdir(directory)
+                            if f.lower().endswith(IMAGE_EXTENSIONS))
+        self.index = 0
+
+    def isOpened(self):
+        return len(self.files) > 0
+
+    def get(self, prop):
+        # like cv2.VideoCapture, the frame size can be known without reading a frame (the next image is peeked at)
+        if prop in (cv2.CAP_PROP_FRAME_WIDTH, cv2.CAP_PROP_FRAME_HEIGHT) and self.index < len(self.files):
+            image = cv2.imread(self.files[self.index])
+            if image is not None:
+                return image.shape[1] if prop == cv2.CAP_PROP_FRAME_WIDTH else image.shape[0]
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return len(self.files)
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.index
+        return 0
+
+    def set(self, prop, value):
+        # only seeking is supported (e.g. to read a sequence in chunks, see batch_render.py)
+        if prop != cv2.CAP_PROP_POS_FRAMES:
+            return False
+        self.index = max(0, min(len(self.files), int(value)))
+        return True
+
+    def read(self, image=None):
+        if self.index >= len(self.files):
+            return False, None
+        frame = cv2.imread(self.files[self.index])
+        self.index += 1
+        # like cv2.VideoCapture, the frame is written into the given image when it has the right size
+        if frame is not None and image is not None and image.shape == frame.shape:
+            image[:] = frame
+            frame = image
+        return frame is not None, frame
+
+    def release(self):
+        self.index = len(self.files)
+
+
+def open_source(source=None, config=None):
+    """
+    function open_source: opens the source of the frames
+        INPUT:
+            - source: None for the camera, a path to a directory for an image sequence or a path to a
+                    video file
+            - config: capture configuration of the camera (see camera.py); None for the defaults
+        OUTPUT:
+            - [return value]: an object with the read/release interface of cv2.VideoCapture
+    """
+
+    if source is None:
+        return open_camera(config or DEFAULT_CONFIG)
+    if path.isdir(source):
+        return ImageSequenceCapture(source)
+    return cv2.VideoCapture(source)
+
+
+class KeyTimeline:
+    """
+    class 'KeyTimeline': scripted key presses for headless runs, read from a text file where each line
+                    holds a frame number and a key, for example:
+                        # start drawing in blue, then save and quit
+                        0 b
+                        120 w
+                        121 q
+                    keys are single characters or one of the names in KEY_NAMES (e.g. 'space'); empty
+                    lines and lines starting with '#' are ignored
+    """
+
+    def __init__(self, file_path=None):
+        self.keys = {}
+        if file_path is None:
+            return
+        with open(file_path, 'r') as openfile:
+            for line_number, line in enumerate(openfile, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    frame_index, key = line.split(None, 1)
+                    key = KEY_NAMES[key] if key in KEY_NAMES else ord(key)
+                    self.keys[int(frame_index)] = key
+                except (ValueError, TypeError):
+                    raise ValueError('Invalid key timeline entry on line ' + str(line_number) + ': ' + line)
+
+    def key_at(self, frame_index):
+        return self.keys.get(frame_index, NO_KEY)
+
+
+class Display:
+    """
+    class 'Display': the HighGUI windows used by the scripts; it simply forwards each call to OpenCV
+    """
+
+    def namedWindow(self, window, flags=cv2.WINDOW_NORMAL):
+        cv2.namedWindow(window, flags)
+
+    def resizeWindow(self, window, size):
+        cv2.resizeWindow(window, size)
+
+    def moveWindow(self, window, x, y):
+        cv2.moveWindow(window, x, y)
+
+    def setMouseCallback(self, window, callback):
+        cv2.setMouseCallback(window, callback)
+
+    def createTrackbar(self, name, window, value, count, callback):
+        cv2.createTrackbar(name, window, value, count, callback)
+
+    def imshow(self, window, image):
+        cv2.imshow(window, image)
+
+    def waitKey(self, delay=1):
+        return cv2.waitKey(delay) & 0xFF
+
+
+class HeadlessDisplay(Display):
+    """
+    class 'HeadlessDisplay': a display without windows, for machines with no screen; the window calls do
+                        nothing, key presses come from a KeyTimeline and, if an output directory is given,
+                        every image shown is written to '<output_dir>/<window name>/<frame number>.png'
+                        - timeline: the KeyTimeline with the key presses
+                        - output_dir: directory for the per-frame outputs, or None to not save them
+    """
+
+    def __init__(self, timeline, output_dir=None):
+        self.timeline = timeline
+        self.output_dir = output_dir
+        self.frame_index = 0
+
+    def namedWindow(self, window, flags=cv2.WINDOW_NORMAL):
+        pass
+
+    def resizeWindow(self, window, size):
+        pass
+
+    def moveWindow(self, window, x, y):
+        pass
+
+    def setMouseCallback(self, window, callback):
+        pass
+
+    def createTrackbar(self, name, window, value, count, callback):
+        pass
+
+    def imshow(self, window, image):
+        if self.output_dir is None:
+            return
+        window_dir = path.join(self.output_dir, window.lower().replace(' ', '_'))
+        makedirs(window_dir, exist_ok=True)
+        cv2.imwrite(path.join(window_dir, '%06d.png' % self.frame_index), image)
+
+    def waitKey(self, delay=1):
+        # each call to waitKey ends a frame
+        key = self.timeline.key_at(self.frame_index)
+        self.frame_index += 1
+        return key
@@ -0,0 +1,440 @@
+import cv2
+import numpy as np
+
+from collections import OrderedDict
+from math import floor, sqrt
+
+from classes import StrokeStore, Dot, Line, union_rect
+
+# This file contains the virtual canvas of the ar_paint.py script, which can be as big as the drawing on it: the
+# frames only show a viewport of it, which can be panned and zoomed. The strokes are kept in world coordinates
+# (those of the canvas at zoom 1) in a StrokeStore, with their pieces in a spatial index, and the viewport is
+# rendered in tiles, which are cached, so that panning over a huge drawing only draws the pieces of the strokes
+# that cross the part of it that comes into view.
+
+
+# each zoom level is this many times bigger than the previous one
+ZOOM_STEP = sqrt(2)
+MAX_ZOOM_LEVEL = 8
+
+# world coordinates are kept in fixed point, in this many parts of a world unit, so that they fit the integer
+# arrays of a StrokeStore
+SUBPIXEL = 16
+
+# pixels drawn around each tile, besides the thickness of its strokes (see InfiniteCanvas.render_tile)
+TILE_MARGIN = 64
+
+
+class Viewport:
+    """
+    class 'Viewport': the part of the virtual canvas shown on the frames, which is shared by all the canvases drawn
+                    through it (one per pen); the pan is the position, in screen pixels at the current zoom, of
+                    the top-left corner of the frames, so that a screen point (x, y) is the world point
+                    ((x + pan x) / zoom, (y + pan y) / zoom)
+                    - shape: shape of the frames
+    """
+
+    def __init__(self, shape):
+        self.height, self.width = shape[:2]
+        self.pan = (0, 0)
+        self.level = 0
+        self.zoom = 1.0
+
+    def to_world(self, point):
+        zoom = self.zoom
+        return ((point[0] + self.pan[0]) / zoom, (point[1] + self.pan[1]) / zoom)
+
+    def move(self, dx, dy):
+        self.pan = (self.pan[0] + dx, self.pan[1] + dy)
+
+    def zoom_by(self, steps):
+        """
+        zooms in (positive steps) or out (negative steps), keeping the center of the frames on the same world point
+        """
+
+        level = max(-MAX_ZOOM_LEVEL, min(MAX_ZOOM_LEVEL, self.level + steps))
+        cx, cy = self.to_world((self.width / 2, self.height / 2))
+        self.level = level
+        self.zoom = ZOOM_STEP ** level
+        self.pan = (round(cx * self.zoom - self.width / 2), round(cy * self.zoom - self.height / 2))
+
+    def reset(self):
+        self.pan = (0, 0)
+        self.level = 0
+        self.zoom = 1.0
+
+
+class StrokeIndex:
+    """
+    class 'StrokeIndex': a uniform grid over world coordinates, where each cell holds the ids of the strokes that
+                    cross it, so that finding the strokes that cross a region only looks at the cells it covers;
+                    each piece of a stroke (a segment, a dot or a figure) is added with its own rectangle, so a long
+                    stroke is only found in the cells it really goes through, not in its whole bounding box
+                    - cell: size of the cells, in world units
+    """
+
+    def __init__(self, cell=256):
+        self.cell = cell
+        self.cells = {}   # (cx, cy) -> set of ids
+        self.members = {} # id -> set of the cells it's in
+
+    def cell_keys(self, rect):
+        x0, y0, x1, y1 = rect
+        c = self.cell
+        return [(cx, cy) for cy in range(floor(y0 / c), floor(y1 / c) + 1) for cx in range(floor(x0 / c), floor(x1 / c) + 1)]
+
+    def insert(self, item, rect):
+        cells = self.members.setdefault(item, set())
+        for key in self.cell_keys(rect):
+            if key not in cells:
+                cells.add(key)
+                self.cells.setdefault(key, set()).add(item)
+
+    def insert_cells(self, item, cells):
+        """
+        adds an item back to the cells it was in (as returned by remove)
+        """
+
+        self.members.setdefault(item, set()).update(cells)
+        for key in cells:
+            self.cells.setdefault(key, set()).add(item)
+
+    def remove(self, item):
+        """
+        removes an item from every cell it's in; returns the set of those cells
+        """
+
+        cells = self.members.pop(item, set())
+        for key in cells:
+            ids = self.cells[key]
+            ids.discard(item)
+            if not ids:
+                del self.cells[key]
+        return cells
+
+    def query(self, rect):
+        """
+        returns the ids of the strokes in the cells covered by a (x0, y0, x1, y1) world rectangle, in increasing order
+        """
+
+        found = set()
+        for key in self.cell_keys(rect):
+            found.update(self.cells.get(key, ()))
+        return sorted(found)
+
+    def clear(self):
+        self.cells = {}
+        self.members = {}
+
+
+class InfiniteCanvas:
+    """
+    class 'InfiniteCanvas': the drawing of one pen on the virtual canvas; it takes the place of the UndoHistory of
+                        the pen (draw, undo, redo and clear, one stroke at a time), taking its moves in screen
+                        coordinates and keeping them as strokes in world coordinates, in a StrokeStore, and keeps
+                        the pen's frame sized Canvas showing what the viewport shows: new moves are drawn straight
+                        on it, and when the viewport moves (or a stroke is undone), it's put together again from
+                        tiles, which are rendered (only with the pieces of the strokes that cross them) the first
+                        time they're needed and then cached until a stroke over them changes; since the strokes
+                        are the drawing itself, there's nothing to bake them into, so when they take more memory
+                        than the cap, the oldest ones are erased
+                        - layer: the Canvas the viewport is shown on
+                        - viewport: the Viewport (shared by the canvases of all the pens)
+                        - tolerance: stroke simplification tolerance, in world units (see StrokeStore)
+                        - memory_cap: maximum memory (in bytes) for the strokes
+                        - tile: size of the tiles, in screen pixels (they're also the cells of the index, in world
+                                units)
+                        - cache_tiles: maximum number of rendered tiles kept (the least recently used ones are
+                                    dropped first)
+    """
+
+    def __init__(self, layer, viewport, tolerance=0, memory_cap=64*1024*1024, tile=256, cache_tiles=192):
+        self.layer = layer
+        self.viewport = viewport
+        self.memory_cap = memory_cap
+        self.tile = tile
+        self.cache_tiles = cache_tiles
+
+        # the strokes, with their points and thicknesses in world fixed point coordinates (see SUBPIXEL) and their
+        # figures made from world fixed point origins and pencil positions; their world bounds are kept by id,
+        # and the pieces they're made of are indexed on their own
+        self.store = StrokeStore(tolerance=tolerance * SUBPIXEL)
+        self.padding = tolerance + 1 # how far a piece may get from where it was indexed, once simplified
+        self.bounds = {}
+        self.index = StrokeIndex(tile)
+
+        self.undo_stack = [] # ids of the strokes, in order
+        self.redo_stack = [] # undone strokes (id, records, cells of the index and bounds), the last undone at the end
+        self.erased_strokes = 0 # strokes erased to keep under the memory cap
+
+        # rendered tiles, by (zoom level, tx, ty): (image, alpha) or None for the tiles with nothing on them
+        self.cache = OrderedDict()
+        self.rendered_tiles = 0
+
+        # SessionLog, which can't be used with the virtual canvas (it's only here so that it can stand in for an
+        # UndoHistory)
+        self.log = None
+
+    # Strokes
+
+    def to_world(self, point):
+        x, y = self.viewport.to_world(point)
+        return (round(x * SUBPIXEL), round(y * SUBPIXEL))
+
+    def world_move(self, move):
+        """
+        returns a move (a Dot, a Line or a Figure) given in screen coordinates in world fixed point coordinates
+        """
+
+        thickness = round(move.thickness / self.viewport.zoom * SUBPIXEL)
+        if type(move) is Dot:
+            return Dot(self.to_world(move.coords), thickness, move.color)
+        if type(move) is Line:
+            return Line(self.to_world(move.old_coords), self.to_world(move.coords), thickness, move.color)
+        return type(move)(self.to_world(move.origin), self.to_world(move.pencil), move.color, thickness)
+
+    def draw(self, move):
+        """
+        commits a move (a Dot, a Line, a Figure or None) given in screen coordinates
+        """
+
+        if move is None:
+            self.store.append(None)
+            return
+
+        world = self.world_move(move)
+        strokes = self.store.strokes
+        self.store.append(world)
+        stroke_id = self.store.strokes - 1
+        # a new stroke can be undone on its own, and makes whatever was undone before impossible to redo
+        if self.store.strokes != strokes:
+            self.undo_stack.append(stroke_id)
+            self.redo_stack = []
+
+        x0, y0, x1, y1 = world.bounds()
+        p = self.padding
+        rect = (x0 / SUBPIXEL - p, y0 / SUBPIXEL - p, x1 / SUBPIXEL + p, y1 / SUBPIXEL + p)
+        self.bounds[stroke_id] = union_rect(self.bounds.get(stroke_id), rect)
+        self.index.insert(stroke_id, rect)
+        self.invalidate(rect)
+
+        # the viewport already shows everything else, so the move only has to be drawn on it
+        self.layer.draw(move)
+        self.enforce_cap()
+
+    def remove_stroke(self, stroke_id):
+        # the cells its pieces went through are kept with it, so that a redo puts it back in just those
+        cells = self.index.remove(stroke_id)
+        bounds = self.bounds.pop(stroke_id)
+        self.invalidate(bounds)
+        return cells, bounds
+
+    def undo(self):
+        """
+        undoes the last stroke; returns False if there was nothing to undo
+        """
+
+        if not self.undo_stack:
+            return False
+        stroke_id = self.undo_stack.pop()
+        records = self.store.pop_stroke()
+        self.redo_stack.append((stroke_id, records) + self.remove_stroke(stroke_id))
+        self.refresh()
+        return True
+
+    def redo(self):
+        """
+        redoes the last undone stroke; returns False if there was nothing to redo
+        """
+
+        if not self.redo_stack:
+            return False
+        stroke_id, records, cells, bounds = self.redo_stack.pop()
+        self.store.push_stroke(records)
+        self.undo_stack.append(stroke_id)
+        self.index.insert_cells(stroke_id, cells)
+        self.bounds[stroke_id] = bounds
+        self.invalidate(bounds)
+        self.refresh()
+        return True
+
+    def enforce_cap(self):
+        """
+        erases the oldest strokes until the memory they take is under the cap; the stroke being drawn is always
+        kept
+        """
+
+        if self.store.used_bytes() <= self.memory_cap:
+            return
+        # things that can't be undone anymore can't be redone either
+        self.redo_stack = []
+
+        # erase down to three quarters of the cap at once, so that this doesn't happen again on the next move
+        target = self.memory_cap * 3 // 4
+        erased = 0
+        while len(self.undo_stack) - erased > 1:
+            erased += 1
+            if self.store.used_bytes(self.undo_stack[erased]) <= target:
+                break
+        if not erased:
+            return
+
+        for stroke_id in self.undo_stack[:erased]:
+            self.remove_stroke(stroke_id)
+        self.store.drop_strokes_before(self.undo_stack[erased])
+        del self.undo_stack[:erased]
+        self.erased_strokes += erased
+        self.refresh()
+
+    def clear(self):
+        self.store.clear()
+        self.bounds = {}
+        self.index.clear()
+        self.undo_stack = []
+        self.redo_stack = []
+        self.cache.clear()
+        self.layer.clear()
+
+    def strokes(self):
+        return len(self.undo_stack)
+
+    # Tiles
+
+    def tile_rect(self, key):
+        """
+        returns the world rectangle covered by a tile
+        """
+
+        level, tx, ty = key
+        zoom = ZOOM_STEP ** level
+        return (tx * self.tile / zoom, ty * self.tile / zoom, (tx + 1) * self.tile / zoom, (ty + 1) * self.tile / zoom)
+
+    def invalidate(self, rect):
+        """
+        drops the cached tiles that cross a world rectangle
+        """
+
+        for level in {key[0] for key in self.cache}:
+            zoom = ZOOM_STEP ** level
+            tx0, ty0 = floor(rect[0] * zoom / self.tile), floor(rect[1] * zoom / self.tile)
+            tx1, ty1 = floor(rect[2] * zoom / self.tile), floor(rect[3] * zoom / self.tile)
+            for ty in range(ty0, ty1 + 1):
+                for tx in range(tx0, tx1 + 1):
+                    self.cache.pop((level, tx, ty), None)
+
+    def render_tile(self, key):
+        """
+        draws the pieces of the strokes that cross a tile on a new tile image and alpha mask; returns None if there
+        are none
+        """
+
+        stroke_ids = self.index.query(self.tile_rect(key))
+        if not stroke_ids:
+            return None
+        self.rendered_tiles += 1
+        level, tx, ty = key
+        store = self.store
+        scale = ZOOM_STEP ** level / SUBPIXEL # from world fixed point coordinates to tile pixels
+
+        # the records of all those strokes, one after the other (strokes are looked up all at once, since a tile
+        # can be crossed by thousands of short ones)
+        stored_ids = store.stroke_ids[:store.size]
+        starts = np.searchsorted(stored_ids, stroke_ids)
+        lengths = np.searchsorted(stored_ids, stroke_ids, side='right') - starts
+        ends = np.cumsum(lengths)
+        records = np.arange(ends[-1]) + np.repeat(starts - ends + lengths, lengths)
+        points = store.points[records]
+        kinds, colors = store.kinds[starts].tolist(), store.colors[starts].tolist()
+        thicknesses = store.thickness[starts].tolist()
+
+        # OpenCV works out where a thick line crosses the edge of the image it's drawn on with some rounding,
+        # so the tile is drawn with a margin around it, for its edges to match those of its neighbours
+        margin = TILE_MARGIN + int(max(thicknesses) * scale)
+        size = self.tile + 2 * margin
+        image = np.zeros((size, size, 3), dtype=np.uint8)
+        alpha = np.zeros((size, size), dtype=np.uint8)
+        origin = np.array((tx * self.tile - margin, ty * self.tile - margin))
+        to_tile = lambda world: np.round(np.asarray(world) * scale - origin).astype(np.int32)
+        tile_points = to_tile(points)
+
+        # only the pieces that reach the tile image are drawn: the runs of consecutive segments (of the same
+        # stroke) whose bounding boxes cross it, each as a polyline, and the dots inside it
+        low, high = origin / scale, (origin + size) / scale
+        a, b = points[:-1], points[1:]
+        crossing = np.all((np.minimum(a, b) <= high) & (np.maximum(a, b) >= low), axis=1)
+        crossing[ends[:-1] - 1] = False
+        edges = np.flatnonzero(np.diff(np.concatenate(([0], crossing.astype(np.int8), [0]))))
+        runs = list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+        run_strokes = np.searchsorted(ends, edges[::2], side='right').tolist()
+        firsts = (ends - lengths).tolist()
+        in_image = np.all((points >= low) & (points <= high), axis=1).tolist()
+
+        # strokes are drawn in order, but the polylines of consecutive strokes with the same style are drawn
+        # together (the order things of the same color are drawn in makes no difference)
+        pieces, style = [], None
+        def draw_pieces():
+            if pieces:
+                cv2.polylines(image, pieces, False, style[0], style[1])
+                cv2.polylines(alpha, pieces, False, 1, style[1])
+                pieces.clear()
+
+        run = 0
+        for i, stroke_id in enumerate(stroke_ids):
+            thickness = max(1, int(round(thicknesses[i] * scale)))
+            if (colors[i], thickness) != style:
+                draw_pieces()
+                style = (colors[i], thickness)
+
+            if kinds[i] == store.KIND_FIGURE:
+                figure = store.figures[stroke_id]
+                figure = type(figure)(tuple(to_tile(figure.origin).tolist()), tuple(to_tile(figure.pencil).tolist()),
+                                      tuple(colors[i]), thickness)
+                figure.draw(image)
+                figure.draw(alpha, 1)
+                continue
+
+            first = firsts[i]
+            if kinds[i] == store.KIND_DOT and in_image[first]:
+                center = tuple(tile_points[first].tolist())
+                cv2.circle(image, center, thickness, style[0], -1)
+                cv2.circle(alpha, center, thickness, 1, -1)
+            while run < len(runs) and run_strokes[run] == i:
+                s, e = runs[run]
+                pieces.append(tile_points[s:e + 1])
+                run += 1
+        draw_pieces()
+
+        inside = slice(margin, margin + self.tile)
+        return image[inside, inside].copy(), alpha[inside, inside].copy()
+
+    def get_tile(self, key):
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        tile = self.cache[key] = self.render_tile(key)
+        while len(self.cache) > self.cache_tiles:
+            self.cache.popitem(last=False)
+        return tile
+
+    def refresh(self):
+        """
+        puts the layer together again from the tiles the viewport covers
+        """
+
+        view = self.viewport
+        px, py = view.pan
+        t = self.tile
+        self.layer.clear()
+        for ty in range(floor(py / t), floor((py + view.height - 1) / t) + 1):
+            for tx in range(floor(px / t), floor((px + view.width - 1) / t) + 1):
+                tile = self.get_tile((view.level, tx, ty))
+                if tile is None:
+                    continue
+                # part of the tile inside the viewport, in screen and in tile coordinates
+                x0, y0 = max(0, tx * t - px), max(0, ty * t - py)
+                x1, y1 = min(view.width, (tx + 1) * t - px), min(view.height, (ty + 1) * t - py)
+                u0, v0 = x0 + px - tx * t, y0 + py - ty * t
+                image, alpha = tile
+                self.layer.image[y0:y1, x0:x1] = image[v0:v0 + y1 - y0, u0:u0 + x1 - x0]
+                self.layer.alpha[y0:y1, x0:x1] = alpha[v0:v0 + y1 - y0, u0:u0 + x1 - x0]
+                self.layer.mark_dirty((x0, y0, x1, y1))
@@ -0,0 +1,147 @@
+import threading
+import time
+
+# This file contains the threaded capture/processing pipeline used by the ar_paint.py script when it is
+# run with the --pipeline flag.
+
+
+class LatestFrameQueue:
+    """
+    class 'LatestFrameQueue': a bounded queue with a single slot where the latest item always wins; putting
+                        an item while the previous one hasn't been taken yet replaces it (and counts it
+                        as dropped), so a slow consumer always gets the freshest frame instead of a
+                        backlog of stale ones
+    """
+
+    def __init__(self):
+        self.item = None
+        self.has_item = False
+        self.closed = False
+        self.dropped = 0
+        self.condition = threading.Condition()
+
+    def put(self, item):
+        """
+        puts an item in the slot; returns the item it replaced (the one dropped), or None if there was none
+        """
+        with self.condition:
+            dropped = self.item if self.has_item else None
+            if self.has_item:
+                self.dropped += 1
+            self.item = item
+            self.has_item = True
+            self.condition.notify()
+            return dropped
+
+    def get(self, timeout=None):
+        """
+        returns the latest item, waiting for one if the slot is empty; returns None if the queue was closed
+        or the timeout expired
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.has_item or self.closed, timeout):
+                return None
+            if not self.has_item:
+                return None
+            item = self.item
+            self.item = None
+            self.has_item = False
+            return item
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class Pipeline:
+    """
+    class 'Pipeline': runs the camera capture and the frame processing (color segmentation and pencil
+                detection) on two background threads, connected by latest-frame-wins queues, so that the
+                main thread (drawing and HighGUI display, which must stay on the main thread) only ever
+                waits for the slowest stage instead of the sum of all stages
+                - capture: the cv2.VideoCapture to read frames from
+                - process: function applied to each frame on the processing thread (its result is handed
+                    to the main thread along with the frame); if None, frames go through untouched
+                - release: function given the result of each processed frame that is dropped before being
+                    displayed, so that its buffers can be reused (the main thread gives back the others itself)
+    """
+
+    def __init__(self, capture, process=None, release=None):
+        self.capture = capture
+        self.process = process
+        self.release = release
+
+        self.captured_queue = LatestFrameQueue()
+        self.processed_queue = LatestFrameQueue()
+        self.stop_event = threading.Event()
+
+        self.threads = [threading.Thread(target=self.capture_loop, daemon=True),
+                        threading.Thread(target=self.process_loop, daemon=True)]
+
+        # counters
+        self.captured = 0
+        self.displayed = 0
+        self.total_latency = 0.0
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.captured_queue.close()
+        self.processed_queue.close()
+        for thread in self.threads:
+            thread.join(timeout=1)
+
+    def capture_loop(self):
+        while not self.stop_event.is_set():
+            ret, frame = self.capture.read()
+            # the camera (or video) ran out of frames
+            if not ret:
+                break
+            self.captured += 1
+            self.captured_queue.put((frame, time.perf_counter()))
+        self.captured_queue.close()
+
+    def process_loop(self):
+        while not self.stop_event.is_set():
+            item = self.captured_queue.get()
+            if item is None:
+                break
+            frame, captured_at = item
+            result = self.process(frame) if self.process else None
+            dropped = self.processed_queue.put((frame, result, captured_at))
+            if dropped is not None and self.release:
+                self.release(dropped[1])
+        self.processed_queue.close()
+
+    def get(self):
+        """
+        returns the latest (frame, result, captured_at) tuple, where captured_at is the time (as given by
+        time.perf_counter) at which the frame was captured, or None once capture has stopped
+        """
+        return self.processed_queue.get()
+
+    def mark_displayed(self, captured_at):
+        """
+        registers that the frame captured at 'captured_at' was displayed, to keep track of the
+        capture-to-display latency
+        """
+        self.displayed += 1
+        self.total_latency += time.perf_counter() - captured_at
+
+    def stats(self):
+        """
+        returns a dictionary with the pipeline counters: frames captured and displayed, frames dropped at
+        each stage and the mean capture-to-display latency (in milliseconds)
+        """
+        return {
+            'captured': self.captured,
+            'displayed': self.displayed,
+            'dropped_before_processing': self.captured_queue.dropped,
+            'dropped_before_display': self.processed_queue.dropped,
+            'mean_latency_ms': (self.total_latency / self.displayed) * 1000 if self.displayed else 0.0,
+        }
@@ -0,0 +1,174 @@
+import cv2
+import numpy as np
+
+import csv
+import json
+import threading
+import time
+from collections import deque
+
+# This file contains the per-stage latency instrumentation of the ar_paint.py script: rolling percentiles, an FPS
+# counter, the on-screen performance HUD and the export of the whole session's timings to a trace file.
+
+# height (in pixels) of each line of the HUD
+HUD_LINE_HEIGHT = 22
+
+
+class StageTimer:
+    """
+    class 'StageTimer': times each stage of the main loop, keeping the last 'window' timings of every stage to
+                    compute rolling percentiles, and (if tracing) the timings of every frame of the session
+                    - stages: names of the stages, in the order they're shown and exported
+                    - window: number of frames the rolling statistics are computed over
+                    - trace: whether the timings of every frame are kept, to be exported at the end
+    """
+
+    def __init__(self, stages, window=300, trace=False):
+        self.stages = list(stages)
+        self.samples = {stage: deque(maxlen=window) for stage in self.stages}
+        self.frame_times = deque(maxlen=window)
+        self.trace = [] if trace else None
+        # stages timed by wrap, whose rolling statistics are per call rather than per frame
+        self.per_call = set()
+
+        # timings of the current frame, which other threads add to while the main loop closes the frame (the lock
+        # also guards the rolling timings, which per-call stages add to from those threads)
+        self.row = {}
+        self.row_lock = threading.Lock()
+        self.frame_index = 0
+        self.start = time.perf_counter()
+        self.last_mark = self.start
+
+    def record(self, stage, seconds):
+        """
+        registers that a stage took the given time on the current frame; a stage that runs several times in a
+        frame adds up (this can be called from other threads, such as the processing thread of the pipeline)
+        """
+
+        with self.row_lock:
+            self.row[stage] = self.row.get(stage, 0.0) + seconds
+            if stage in self.per_call:
+                self.samples[stage].append(seconds)
+
+    def mark(self):
+        """
+        sets the starting point of the next lap
+        """
+
+        self.last_mark = time.perf_counter()
+
+    def lap(self, stage):
+        """
+        registers the time since the last lap (or mark, or the end of the last frame) as the given stage
+        """
+
+        now = time.perf_counter()
+        self.record(stage, now - self.last_mark)
+        self.last_mark = now
+
+    def wrap(self, stage, function):
+        """
+        returns a version of 'function' that times every call to it as the given stage; the rolling statistics of
+        the stage are then per call, so that they don't depend on how many calls a frame takes (as with the pipeline,
+        whose processing thread doesn't wait for the main loop), while the trace still gets the total of each frame
+        """
+
+        self.per_call.add(stage)
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            result = function(*args, **kwargs)
+            self.record(stage, time.perf_counter() - t0)
+            return result
+        return timed
+
+    def end_frame(self):
+        """
+        closes the timings of the current frame
+        """
+
+        now = time.perf_counter()
+        self.frame_times.append(now)
+        with self.row_lock:
+            row, self.row = self.row, {}
+            for stage, seconds in row.items():
+                if stage not in self.per_call:
+                    self.samples[stage].append(seconds)
+        if self.trace is not None:
+            self.trace.append(dict({'frame': self.frame_index, 'time': now - self.start},
+                                   **{stage: row.get(stage) for stage in self.stages}))
+        self.frame_index += 1
+        self.last_mark = time.perf_counter()
+
+    def fps(self):
+        if len(self.frame_times) < 2:
+            return 0.0
+        return (len(self.frame_times) - 1) / (self.frame_times[-1] - self.frame_times[0])
+
+    def percentiles(self, stage, qs=(50, 95, 99)):
+        """
+        returns the given percentiles of the rolling timings of a stage, in milliseconds (None if it has no timings)
+        """
+
+        with self.row_lock:
+            samples = np.fromiter(self.samples[stage], dtype=np.float64)
+        if not len(samples):
+            return None
+        return [float(p) * 1000 for p in np.percentile(samples, qs)]
+
+    def summary(self):
+        """
+        returns a dictionary with the current FPS and the p50/p95/p99 of every stage (in milliseconds)
+        """
+
+        summary = {'fps': self.fps(), 'frames': self.frame_index, 'stages': {}}
+        for stage in self.stages:
+            p = self.percentiles(stage)
+            if p is not None:
+                summary['stages'][stage] = {'p50_ms': p[0], 'p95_ms': p[1], 'p99_ms': p[2]}
+        return summary
+
+    def hud_lines(self):
+        lines = ['FPS: %.1f' % self.fps()]
+        for stage in self.stages:
+            p = self.percentiles(stage)
+            if p is not None:
+                lines.append('%-8s %6.1f %6.1f %6.1f ms' % (stage, p[0], p[1], p[2]))
+        return lines
+
+    def hud_bounds(self, lines):
+        """
+        returns the (x0, y0, x1, y1) rectangle (end excluded) the HUD with the given lines (see hud_lines) is drawn in
+        """
+
+        return (0, 0, 371, 11 + HUD_LINE_HEIGHT*len(lines))
+
+    def draw_hud(self, image, lines):
+        """
+        draws the performance HUD (FPS and the p50/p95/p99 of every stage, as given by hud_lines) on the top-left
+        corner of an image
+        """
+
+        cv2.rectangle(image, (0, 0), (370, 10 + HUD_LINE_HEIGHT*len(lines)), (0, 0, 0), -1)
+        for i, line in enumerate(lines):
+            cv2.putText(image, line, (8, HUD_LINE_HEIGHT*(i+1)), cv2.FONT_HERSHEY_PLAIN, 1.2, (255, 255, 255), 1)
+        return image
+
+    def export(self, file_path):
+        """
+        writes the timings of every frame to a trace file: a .json file also gets the summary, while any other
+        extension gets a CSV file with one row per frame (times in milliseconds)
+        """
+
+        rows = self.trace or []
+        to_ms = lambda v: v * 1000 if v is not None else None
+        if file_path.endswith('.json'):
+            frames = [dict(row, **{stage: to_ms(row[stage]) for stage in self.stages}) for row in rows]
+            with open(file_path, 'w') as outfile:
+                json.dump({'summary': self.summary(), 'frames': frames}, outfile, indent=4)
+        else:
+            with open(file_path, 'w', newline='') as outfile:
+                writer = csv.writer(outfile)
+                writer.writerow(['frame', 'time_s'] + [stage + '_ms' for stage in self.stages])
+                for row in rows:
+                    writer.writerow([row['frame'], '%.6f' % row['time']] +
+                                    ['' if row[stage] is None else '%.3f' % to_ms(row[stage]) for stage in self.stages])
@@ -0,0 +1,108 @@
+import cv2
+import numpy as np
+
+import queue
+import threading
+
+# This file contains the background image writer used by the ar_paint.py script, so that saving a drawing never
+# stalls the camera feed.
+
+
+# file extension and OpenCV encoding parameter of each format (raw files are written with NumPy instead)
+FORMATS = {
+    'png': ('.png', cv2.IMWRITE_PNG_COMPRESSION),
+    'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY),
+    'raw': ('.npz', None),
+}
+
+# default value of the encoding parameter of each format (PNG compression level, JPEG/WebP quality)
+DEFAULT_QUALITY = {'png': 3, 'jpg': 95, 'webp': 95, 'raw': None}
+
+
+class ImageSaver:
+    """
+    class 'ImageSaver': writes images to disk on a background thread; save requests go into a bounded queue and, if
+                    it's full, the request is refused right away instead of blocking the caller; the outcome of
+                    every request is reported through poll()
+                    - image_format: one of the keys of FORMATS ('raw' writes an uncompressed .npz file with the
+                                    image and, if given, the alpha mask)
+                    alpha masks are given as in Canvas (0s and 1s) and written as 0s and 255s
+                    - quality: PNG compression level (0-9) or JPEG/WebP quality (0-100); None for the default
+                    - max_pending: maximum number of saves waiting to be written
+    """
+
+    def __init__(self, image_format='png', quality=None, max_pending=4):
+        self.extension, self.parameter = FORMATS[image_format]
+        self.image_format = image_format
+        self.quality = quality if quality is not None else DEFAULT_QUALITY[image_format]
+
+        self.requests = queue.Queue(maxsize=max_pending)
+        self.results = queue.Queue()
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def save(self, base_name, image, alpha=None):
+        """
+        asks for an image to be saved as '<base_name>.<extension of the format>'; the image (and alpha mask, if any)
+        is copied, so the caller can go on drawing on it right away
+            OUTPUT:
+                - [return value]: the path the image will be saved to, or None if too many saves are pending
+        """
+
+        file_path = base_name + self.extension
+        try:
+            self.requests.put_nowait((file_path, image.copy(), alpha.copy() if alpha is not None else None))
+        except queue.Full:
+            self.results.put((file_path, False, 'too many saves pending'))
+            return None
+        return file_path
+
+    def write_loop(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                break
+            file_path, image, alpha = request
+            if alpha is not None:
+                alpha *= 255
+            try:
+                self.write(file_path, image, alpha)
+                self.results.put((file_path, True, None))
+            except Exception as error: # any failure is reported to the main thread, which keeps going
+                self.results.put((file_path, False, str(error)))
+
+    def write(self, file_path, image, alpha):
+        if self.image_format == 'raw':
+            if alpha is None:
+                np.savez(file_path, image=image)
+            else:
+                np.savez(file_path, image=image, alpha=alpha)
+            return
+
+        # PNG and WebP can keep the alpha mask as their transparency channel; JPEG can't
+        if alpha is not None and self.image_format != 'jpg':
+            image = cv2.merge((*cv2.split(image), alpha))
+        if not cv2.imwrite(file_path, image, [self.parameter, self.quality]):
+            raise IOError('OpenCV couldn\'t write the image')
+
+    def poll(self):
+        """
+        returns the outcomes of the saves finished since the last call, as (path, success, error message) tuples,
+        without waiting
+        """
+
+        results = []
+        while True:
+            try:
+                results.append(self.results.get_nowait())
+            except queue.Empty:
+                return results
+
+    def close(self):
+        """
+        waits for the pending saves to be written and stops the writer thread
+        """
+
+        self.requests.put(None)
+        self.thread.join()
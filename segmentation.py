@@ -0,0 +1,201 @@
+import cv2
+import numpy as np
+
+import json
+
+# This file contains the pens used by the ar_paint.py script and set up with color_segmenter.py, as they are kept
+# in limits.json, and the segmentation that labels the pixels of all of them in a single pass over each frame.
+#
+# limits.json holds a list of pens, each with a name, the color space its ranges are given in ('bgr' or 'hsv'),
+# the range of each channel and the color it draws with (BGR), e.g.:
+#   {"pens": [{"name": "pen 1", "space": "hsv", "color": [0, 0, 255],
+#              "limits": {"H": {"min": 170, "max": 10}, "S": {"min": 100, "max": 255}, "V": {"min": 80, "max": 255}}}]}
+# A hue range whose min is bigger than its max wraps around (170 to 179 and 0 to 10 above, which is red). Files
+# written before there could be several pens hold a single BGR range instead, as {"limits": {"B": ..., ...}}.
+
+
+# channels of each color space, in the order of the image channels, and their maximum values (OpenCV keeps the
+# hue of 8-bit images in degrees halved, so that it fits in a byte)
+CHANNELS = {'bgr': ('B', 'G', 'R'), 'hsv': ('H', 'S', 'V')}
+CHANNEL_MAX = {'bgr': (255, 255, 255), 'hsv': (179, 255, 255)}
+
+# each pen is a bit of the labels image, which has 8 bits per pixel
+MAX_PENS = 8
+
+# default drawing color of each pen (red, green, blue, yellow, magenta, cyan, orange, white)
+PEN_COLORS = [(0,0,255), (0,255,0), (255,0,0), (0,255,255), (255,0,255), (255,255,0), (0,128,255), (255,255,255)]
+
+
+def full_limits(space):
+    """
+    function full_limits: returns the ranges of a color space that let every pixel through
+    """
+
+    return {channel: {'min': 0, 'max': top} for channel, top in zip(CHANNELS[space], CHANNEL_MAX[space])}
+
+
+def new_pen(index, space='bgr', name=None):
+    """
+    function new_pen: returns a pen that lets every pixel through, with the default name and color of the index-th pen
+    """
+
+    return {'name': name or 'pen ' + str(index + 1), 'space': space, 'limits': full_limits(space),
+            'color': PEN_COLORS[index % len(PEN_COLORS)]}
+
+
+def load_pens(json_object):
+    """
+    function load_pens: reads the pens of the contents of a limits.json file (either schema, see above), filling
+                    in the names and colors they don't have
+        INPUT:
+            - json_object: the decoded contents of the file
+        OUTPUT:
+            - [return value]: list of pens, as dictionaries with a 'name', a 'space', the 'limits' of each channel
+                            and a 'color' (BGR tuple)
+    """
+
+    if 'pens' in json_object:
+        entries = json_object['pens']
+    elif 'limits' in json_object:
+        entries = [{'limits': json_object['limits']}]
+    else:
+        raise ValueError('the file has no pens')
+    if not entries:
+        raise ValueError('the file has no pens')
+    if len(entries) > MAX_PENS:
+        raise ValueError('there can be at most ' + str(MAX_PENS) + ' pens')
+
+    pens = []
+    for index, entry in enumerate(entries):
+        pen = new_pen(index, entry.get('space', 'bgr'), entry.get('name'))
+        if pen['space'] not in CHANNELS:
+            raise ValueError('unknown color space: ' + str(pen['space']))
+        for channel in CHANNELS[pen['space']]:
+            if channel not in entry['limits']:
+                raise ValueError('pen \'' + pen['name'] + '\' has no range for channel ' + channel)
+            pen['limits'][channel] = {bound: int(entry['limits'][channel][bound]) for bound in ('min', 'max')}
+        if 'color' in entry:
+            pen['color'] = tuple(int(v) for v in entry['color'])
+        pens.append(pen)
+    return pens
+
+
+def read_pens(file_path):
+    with open(file_path, 'r') as openfile:
+        return load_pens(json.load(openfile))
+
+
+def save_pens(file_path, pens):
+    data = {'pens': [dict(pen, color=list(pen['color'])) for pen in pens]}
+    with open(file_path, 'w') as outfile:
+        outfile.write(json.dumps(data, indent=4))
+
+
+def pen_mask(image, pen, mask=None):
+    """
+    function pen_mask: segments the pixels of a single pen on an image, like apply_mask in aux_functions.py but in
+                    the pen's color space
+        OUTPUT:
+            - [return value]: binary image, white where the pixels are within the pen's ranges
+    """
+
+    if pen['space'] == 'hsv':
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+    limits = pen['limits']
+    lows = tuple(limits[channel]['min'] for channel in CHANNELS[pen['space']])
+    highs = tuple(limits[channel]['max'] for channel in CHANNELS[pen['space']])
+
+    # a hue range that wraps around is the union of the hues from its min up and from 0 up to its max
+    if pen['space'] == 'hsv' and lows[0] > highs[0]:
+        upper = cv2.inRange(image, lows, (CHANNEL_MAX['hsv'][0],) + highs[1:])
+        lower = cv2.inRange(image, (0,) + lows[1:], highs)
+        return cv2.bitwise_or(upper, lower, mask)
+    return cv2.inRange(image, lows, highs, mask)
+
+
+class PenSegmenter:
+    """
+    class 'PenSegmenter': labels the pixels of all the pens in a single pass over each frame, whatever the number of
+                    pens; every channel has a lookup table that gives, for each of its 256 values, a byte with
+                    the bit of every pen whose range holds that value, so that looking up the three channels of a
+                    pixel and ANDing the results gives the bits of all the pens the pixel belongs to (the frame is
+                    converted to HSV only if a pen needs it); every per-frame image is written into buffers that
+                    are allocated once and then reused
+                    - pens: list of pens (see load_pens), at most MAX_PENS
+    """
+
+    def __init__(self, pens):
+        if len(pens) > MAX_PENS:
+            raise ValueError('there can be at most ' + str(MAX_PENS) + ' pens')
+        self.pens = pens
+
+        # the tables of each color space in use (3 x 256, one row per channel); the bits of the pens of the other
+        # space are never set in them, so the labels of both spaces can simply be ORed together
+        values = np.arange(256)
+        self.tables = {}
+        for k, pen in enumerate(pens):
+            tables = self.tables.setdefault(pen['space'], np.zeros((3, 256), dtype=np.uint8))
+            for c, channel in enumerate(CHANNELS[pen['space']]):
+                low, high = pen['limits'][channel]['min'], pen['limits'][channel]['max']
+                if channel == 'H' and low > high:
+                    inside = (values >= low) | (values <= high)
+                else:
+                    inside = (values >= low) & (values <= high)
+                tables[c, inside] |= 1 << k
+
+        # tables that turn the labels into the mask of each pen
+        self.pen_tables = [np.where(values & (1 << k), 255, 0).astype(np.uint8) for k in range(len(pens))]
+
+        self.labels = None
+        self.scratch = None
+        self.hsv = None
+        self.planes = None
+
+    def allocate(self, shape):
+        h, w = shape[:2]
+        if self.labels is None or self.labels.shape != (h, w):
+            self.labels = np.empty((h, w), dtype=np.uint8)
+            self.scratch = np.empty((h, w), dtype=np.uint8)
+            self.hsv = np.empty((h, w, 3), dtype=np.uint8)
+            self.planes = [np.empty((h, w), dtype=np.uint8) for _ in range(3)]
+
+    def segment(self, frame):
+        """
+        labels the pixels of a camera frame
+            OUTPUT:
+                - [return value]: single channel image where bit k of each pixel is set if it belongs to pen k
+        """
+
+        self.allocate(frame.shape)
+        for index, (space, tables) in enumerate(self.tables.items()):
+            image = frame if space == 'bgr' else cv2.cvtColor(frame, cv2.COLOR_BGR2HSV, self.hsv)
+
+            # looking the channels up one by one is about twice as fast as looking up all three at once, and
+            # splitting the frame into them costs less than that
+            cv2.split(image, self.planes)
+            for c in range(3):
+                cv2.LUT(self.planes[c], tables[c], self.planes[c])
+            labels = self.labels if index == 0 else self.scratch
+            cv2.bitwise_and(self.planes[0], self.planes[1], labels)
+            cv2.bitwise_and(labels, self.planes[2], labels)
+            if index > 0:
+                cv2.bitwise_or(self.labels, self.scratch, self.labels)
+        return self.labels
+
+    def pen_mask(self, index, mask=None, roi=None):
+        """
+        returns the mask of a pen (white where its bit is set) from the labels of the last segmented frame
+            INPUT:
+                - index: index of the pen
+                - mask: image to write the mask into, if any
+                - roi: (x0, y0, x1, y1) rectangle the mask is written within (the rest of it is left as it was),
+                    or None for the whole frame
+        """
+
+        if roi is None:
+            return cv2.LUT(self.labels, self.pen_tables[index], mask)
+        x0, y0, x1, y1 = roi
+        if mask is None:
+            mask = np.zeros(self.labels.shape, dtype=np.uint8)
+        cv2.LUT(self.labels[y0:y1, x0:x1], self.pen_tables[index], mask[y0:y1, x0:x1])
+        return mask
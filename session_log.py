@@ -0,0 +1,262 @@
+import numpy as np
+
+import time
+from os import path
+
+from classes import Canvas, StrokeStore, UndoHistory, Dot, Line, Square, Ellipse, Circle
+
+# This file contains the append-only binary log of a drawing session, written by the ar_paint.py script while
+# drawing, and the replay of such a log (memory-mapped, so that even very long sessions are cheap to load).
+
+
+# the log starts with a header holding these 8 bytes, the format version and the size of the frames
+MAGIC = b'ARPAINT\0'
+VERSION = 1
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('version', '<u4'), ('width', '<u4'), ('height', '<u4'), ('pad', '<u4')])
+
+# after the header, the log is a sequence of fixed-size records, one per event
+RECORD_DTYPE = np.dtype([
+    ('kind', 'u1'),       # one of the EVENT_* codes
+    ('shape', 'u1'),      # figure shape (one of the SHAPE_* codes) or mode code
+    ('thickness', 'u1'),
+    ('flag', 'u1'),       # mode on (1) or off (0)
+    ('frame', '<u4'),     # frame number of the event
+    ('time', '<f4'),      # seconds since the start of the log
+    ('x0', '<i4'), ('y0', '<i4'), ('x1', '<i4'), ('y1', '<i4'),
+    ('color', 'u1', 3),   # BGR
+    ('pad', 'u1'),
+])
+
+EVENT_DOT = 1       # x0, y0: coordinates
+EVENT_LINE = 2      # x0, y0 -> x1, y1
+EVENT_BREAK = 3     # the pencil wasn't detected (a None move)
+EVENT_FIGURE = 4    # figure committed; x0, y0: origin, x1, y1: pencil position
+EVENT_COLOR = 5     # pencil color changed
+EVENT_THICKNESS = 6 # pencil thickness changed
+EVENT_MODE = 7      # mode toggled (shape: one of the MODE_* codes, flag: on/off)
+EVENT_CLEAR = 8
+EVENT_UNDO = 9
+EVENT_REDO = 10
+
+SHAPE_SQUARE = 1
+SHAPE_ELLIPSE = 2
+SHAPE_CIRCLE = 3
+SHAPES = {Square: SHAPE_SQUARE, Ellipse: SHAPE_ELLIPSE, Circle: SHAPE_CIRCLE}
+
+MODE_SQUARE = 1
+MODE_ELLIPSE = 2
+MODE_CIRCLE = 3
+MODE_COLORING = 4
+MODES = {'square': MODE_SQUARE, 'ellipse': MODE_ELLIPSE, 'circle': MODE_CIRCLE, 'coloring': MODE_COLORING}
+
+
+class SessionLog:
+    """
+    class 'SessionLog': writes the events of a drawing session to an append-only binary log; if the log already
+                    exists (e.g. after a crash), new events are appended to it, unless it's too short to even hold
+                    a header (see has_session), in which case it's written over
+                    - file_path: path of the log
+                    - shape: shape of the frames being drawn on
+    """
+
+    def __init__(self, file_path, shape):
+        h, w = shape[:2]
+        exists = has_session(file_path)
+        if exists:
+            header = read_header(file_path)
+            if (header['width'], header['height']) != (w, h):
+                raise ValueError('The session log is for %dx%d frames, not %dx%d.' % (header['width'], header['height'], w, h))
+            # drop a record that was only partly written when the program stopped
+            size = path.getsize(file_path)
+            records = (size - HEADER_DTYPE.itemsize) // RECORD_DTYPE.itemsize
+            with open(file_path, 'r+b') as openfile:
+                openfile.truncate(HEADER_DTYPE.itemsize + records * RECORD_DTYPE.itemsize)
+
+        self.file = open(file_path, 'ab' if exists else 'wb')
+        if not exists:
+            header = np.zeros(1, dtype=HEADER_DTYPE)
+            header[0] = (MAGIC, VERSION, w, h, 0)
+            self.file.write(header.tobytes())
+            self.file.flush()
+
+        self.record = np.zeros(1, dtype=RECORD_DTYPE)
+        self.start = time.perf_counter()
+        self.frame = 0
+        self.events = 0
+
+        # when appending to an existing log, frames and times go on from where it stopped, so that they never
+        # go back (the replay relies on it)
+        if exists and records:
+            last = np.memmap(file_path, dtype=RECORD_DTYPE, mode='r', shape=(1,),
+                             offset=HEADER_DTYPE.itemsize + (records - 1) * RECORD_DTYPE.itemsize)[0]
+            self.frame = int(last['frame']) + 1
+            self.start -= float(last['time'])
+
+    def write(self, kind, points=(), color=(0,0,0), thickness=0, shape=0, flag=0):
+        record = self.record[0]
+        record['kind'] = kind
+        record['shape'] = shape
+        record['thickness'] = min(thickness, 255)
+        record['flag'] = flag
+        record['frame'] = self.frame
+        record['time'] = time.perf_counter() - self.start
+        coords = [c for point in points for c in point] + [0]*(4 - 2*len(points))
+        record['x0'], record['y0'], record['x1'], record['y1'] = coords
+        record['color'] = color
+        self.file.write(self.record.tobytes())
+        self.events += 1
+
+    def move(self, move):
+        """
+        logs a committed move (a Dot, a Line, a Figure or None)
+        """
+
+        if move is None:
+            self.write(EVENT_BREAK)
+        elif type(move) is Dot:
+            self.write(EVENT_DOT, [move.coords], move.color, move.thickness)
+        elif type(move) is Line:
+            self.write(EVENT_LINE, [move.old_coords, move.coords], move.color, move.thickness)
+        else:
+            self.write(EVENT_FIGURE, [move.origin, move.pencil], move.color, move.thickness, SHAPES[type(move)])
+
+    def color(self, color):
+        self.write(EVENT_COLOR, color=color)
+
+    def thickness(self, thickness):
+        self.write(EVENT_THICKNESS, thickness=thickness)
+
+    def mode(self, mode, on):
+        self.write(EVENT_MODE, shape=MODES[mode], flag=int(on))
+
+    def clear(self):
+        self.write(EVENT_CLEAR)
+
+    def undo(self):
+        self.write(EVENT_UNDO)
+
+    def redo(self):
+        self.write(EVENT_REDO)
+
+    def end_frame(self):
+        """
+        hands the events of the frame over to the operating system, so that they survive a crash of the program
+        """
+
+        self.file.flush()
+        self.frame += 1
+
+    def close(self):
+        self.file.close()
+
+
+def has_session(file_path):
+    """
+    function has_session: tells whether there's a session log to resume at a path, which is the case if there's a file
+                    long enough to hold a header (a shorter one is what's left when the program stops before writing
+                    the whole header, and holds no events)
+    """
+
+    return path.exists(file_path) and path.getsize(file_path) >= HEADER_DTYPE.itemsize
+
+
+def read_header(file_path):
+    # an empty (or cut short) file doesn't even have a header to read
+    if path.getsize(file_path) < HEADER_DTYPE.itemsize:
+        raise ValueError('The session log is too short to be one (it may be empty or cut short): ' + file_path)
+    header = np.fromfile(file_path, dtype=HEADER_DTYPE, count=1)[0]
+    if header['magic'] != MAGIC.rstrip(b'\0') or header['version'] != VERSION:
+        raise ValueError('Not a session log (or an unsupported version of one): ' + file_path)
+    return header
+
+
+class SessionReplay:
+    """
+    class 'SessionReplay': reads a session log through a memory map, so that only the records that are actually
+                        replayed are ever read from the disk
+                        - file_path: path of the log
+    """
+
+    def __init__(self, file_path):
+        header = read_header(file_path)
+        self.shape = (int(header['height']), int(header['width']), 3)
+        count = (path.getsize(file_path) - HEADER_DTYPE.itemsize) // RECORD_DTYPE.itemsize
+        self.records = np.memmap(file_path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_DTYPE.itemsize, shape=(count,)) \
+            if count else np.zeros(0, dtype=RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def end_index(self, frame=None, seconds=None):
+        """
+        returns the number of records up to (and including) the given frame or time; all of them if neither is given
+        """
+
+        if frame is not None:
+            return int(np.searchsorted(self.records['frame'], frame, side='right'))
+        if seconds is not None:
+            return int(np.searchsorted(self.records['time'], seconds, side='right'))
+        return len(self.records)
+
+    def rebuild(self, frame=None, seconds=None, history=None):
+        """
+        replays the log up to the given frame or time (the whole log if neither is given)
+            INPUT:
+                - frame, seconds: point of the session to rebuild
+                - history: UndoHistory to replay the log into; if None, a new one (with a new Canvas and StrokeStore)
+                        is created
+            OUTPUT:
+                - history: the UndoHistory, whose canvas holds the drawing at that point of the session
+                - state: dictionary with the pencil color and thickness, and the modes that were on, at that point
+        """
+
+        if history is None:
+            history = UndoHistory(Canvas(self.shape), StrokeStore())
+        state = {'color': (0,0,255), 'thickness': 5, 'modes': set()}
+
+        end = self.end_index(frame, seconds)
+        records = self.records[:end]
+
+        # nothing before the last clear matters to the drawing, so only the pencil and mode changes before it are
+        # looked at
+        clears = np.flatnonzero(records['kind'] == EVENT_CLEAR)
+        start = int(clears[-1]) if len(clears) else 0
+        settings = np.flatnonzero(np.isin(records['kind'][:start], (EVENT_COLOR, EVENT_THICKNESS, EVENT_MODE)))
+        for i in settings:
+            self.apply(records[i], history, state)
+        for i in range(start, end):
+            self.apply(records[i], history, state)
+        return history, state
+
+    def apply(self, record, history, state):
+        kind = record['kind']
+        color = tuple(int(c) for c in record['color'])
+        thickness = int(record['thickness'])
+        p0 = (int(record['x0']), int(record['y0']))
+        p1 = (int(record['x1']), int(record['y1']))
+
+        if kind == EVENT_DOT:
+            history.draw(Dot(p0, thickness, color))
+        elif kind == EVENT_LINE:
+            history.draw(Line(p0, p1, thickness, color))
+        elif kind == EVENT_BREAK:
+            history.draw(None)
+        elif kind == EVENT_FIGURE:
+            figure_class = {SHAPE_SQUARE: Square, SHAPE_ELLIPSE: Ellipse, SHAPE_CIRCLE: Circle}[int(record['shape'])]
+            history.draw(figure_class(p0, p1, color, thickness))
+        elif kind == EVENT_COLOR:
+            state['color'] = color
+        elif kind == EVENT_THICKNESS:
+            state['thickness'] = thickness
+        elif kind == EVENT_MODE:
+            mode = {code: name for name, code in MODES.items()}[int(record['shape'])]
+            if record['flag']:
+                state['modes'].add(mode)
+            else:
+                state['modes'].discard(mode)
+        elif kind == EVENT_CLEAR:
+            history.clear()
+        elif kind == EVENT_UNDO:
+            history.undo()
+        elif kind == EVENT_REDO:
+            history.redo()
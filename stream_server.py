@@ -0,0 +1,296 @@
+import cv2
+import numpy as np
+
+import asyncio
+import json
+import queue
+import threading
+import time
+
+from pipeline import LatestFrameQueue
+
+# This file contains the local broadcast server used by the ar_paint.py script when it is run with the --stream
+# argument, which publishes the composited frames as an MJPEG stream over HTTP, so that they can be watched on
+# other displays (e.g. in a browser) or recorded by another program while the program runs.
+
+
+# JPEG quality of the streamed frames
+STREAM_QUALITY = 80
+
+# boundary between the frames of the multipart stream
+BOUNDARY = b'frame'
+
+
+class ClientStats:
+    """
+    class 'ClientStats': what a client of the StreamServer has been sent: the frames it got, those it skipped
+                    because the newer ones were already there by the time it could take another one, and its lag
+                    (how long after being published each frame it got was fully handed over to its connection)
+                    - address: address of the client
+                    - last_number: number of the latest frame when it connected
+    """
+
+    def __init__(self, address, last_number=0):
+        self.address = address
+        self.connected_at = time.perf_counter()
+        self.last_number = last_number
+        self.sending = None # time the frame being sent was published at, while it's being sent
+        self.sent = 0
+        self.skipped = 0
+        self.last_lag = 0.0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+
+    def sending_frame(self, number, published_at):
+        self.skipped += max(0, number - self.last_number - 1)
+        self.last_number = number
+        self.sending = published_at
+
+    def sent_frame(self):
+        lag = time.perf_counter() - self.sending
+        self.sending = None
+        self.sent += 1
+        self.last_lag = lag
+        self.total_lag += lag
+        self.max_lag = max(self.max_lag, lag)
+
+    def stats(self, latest_number):
+        """
+        returns a dictionary with the frames sent and skipped, how many frames behind the latest one the client
+        is, and its lags in milliseconds: of the last frame sent, mean and maximum, and how long the frame being
+        sent (if any) has been waiting for the client to take it (a client that stopped reading is stuck there)
+        """
+
+        sending = self.sending
+        return {
+            'address': self.address,
+            'connected_s': time.perf_counter() - self.connected_at,
+            'sent': self.sent,
+            'skipped': self.skipped,
+            'frames_behind': max(0, latest_number - self.last_number),
+            'lag_ms_last': self.last_lag * 1000,
+            'lag_ms_mean': (self.total_lag / self.sent) * 1000 if self.sent else 0.0,
+            'lag_ms_max': self.max_lag * 1000,
+            'lag_ms_sending': (time.perf_counter() - sending) * 1000 if sending is not None else 0.0,
+        }
+
+
+class StreamServer:
+    """
+    class 'StreamServer': serves the frames published by the main loop as an MJPEG stream over HTTP, on an asyncio
+                    event loop running on a background thread; publishing a frame only copies it into a
+                    latest-frame-wins queue (and not even that while no one is watching), from which an encoder
+                    thread compresses each frame once into a single buffer that is shared by all the clients;
+                    each client is sent the latest frame whenever its connection has taken the previous one, so
+                    slow clients skip frames instead of holding up the main loop or the other clients
+                    the server answers at:
+                    - '/' or '/stream': the MJPEG stream (a multipart/x-mixed-replace response)
+                    - '/frame.jpg': the latest frame
+                    - '/stats': the server statistics, with the lag of each client (see stats), as JSON
+                    - port: port the server listens on
+                    - host: address the server listens on (only the local machine, by default)
+                    - quality: JPEG quality of the frames
+    """
+
+    def __init__(self, port, host='127.0.0.1', quality=STREAM_QUALITY):
+        self.host = host
+        self.port = port
+        self.quality = quality
+
+        # frames go from the main loop to the encoder thread through a single slot queue, in buffers that the
+        # encoder hands back once they're encoded, so that they're only allocated once
+        self.frames = LatestFrameQueue()
+        self.free_buffers = queue.SimpleQueue()
+
+        # latest encoded frame, as the (number, part of the stream, JPEG image, time it was published) tuple
+        # shared by all the clients, and the ClientStats of the clients being streamed to, by the event that tells
+        # each of them there's a new one; the clients only come and go on the server thread, but other threads
+        # read them (see stats), so they're changed and copied under a lock
+        self.latest = None
+        self.clients = {}
+        self.past_clients = []
+        self.clients_lock = threading.Lock()
+
+        self.published = 0
+        self.encoded = 0
+
+        self.loop = None
+        self.stop_event = None
+        self.started = threading.Event()
+        self.error = None
+        self.serve_thread = threading.Thread(target=self.serve_loop, daemon=True)
+        self.encode_thread = threading.Thread(target=self.encode_loop, daemon=True)
+
+    def start(self):
+        """
+        starts the server; raises the error that kept it from starting, if any (e.g. OSError if it can't listen
+        on its port)
+        """
+
+        self.serve_thread.start()
+        self.encode_thread.start()
+        self.started.wait()
+        if self.error:
+            self.close()
+            raise self.error
+        return self
+
+    def close(self):
+        # the encoder hands its last frames over to the server's event loop, so it has to be done before the loop
+        # is stopped (and closed)
+        self.frames.close()
+        if self.encode_thread.is_alive():
+            self.encode_thread.join(timeout=1)
+        if self.loop and self.stop_event and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+        if self.serve_thread.is_alive():
+            self.serve_thread.join(timeout=1)
+
+    # Main loop side
+
+    def publish(self, frame):
+        """
+        hands a frame over to be streamed (it's copied, so the caller can go on drawing on it right away); returns
+        whether it was, which it isn't while no one is watching
+        """
+
+        if not self.clients:
+            return False
+        try:
+            buffer = self.free_buffers.get_nowait()
+            if buffer.shape != frame.shape:
+                buffer = np.empty_like(frame)
+        except queue.Empty:
+            buffer = np.empty_like(frame)
+        np.copyto(buffer, frame)
+        self.published += 1
+        self.frames.put((buffer, time.perf_counter()))
+        return True
+
+    def stats(self):
+        """
+        returns a dictionary with the frames published, those dropped before being encoded (because a newer one
+        came first) and encoded, and the statistics of every client, connected or not (see ClientStats), with
+        their lags in milliseconds
+        """
+
+        latest = self.latest
+        latest_number = latest[0] if latest else 0
+        with self.clients_lock:
+            clients = list(self.clients.values())
+            past_clients = list(self.past_clients)
+        return {
+            'published': self.published,
+            'dropped_before_encoding': self.frames.dropped,
+            'encoded': self.encoded,
+            'clients': [dict(client.stats(latest_number), connected=True) for client in clients] + past_clients,
+        }
+
+    # Encoder thread
+
+    def encode_loop(self):
+        while True:
+            item = self.frames.get()
+            if item is None:
+                break
+            buffer, published_at = item
+            ret, jpeg = cv2.imencode('.jpg', buffer, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            self.free_buffers.put(buffer)
+            if not ret:
+                continue
+            self.encoded += 1
+            jpeg = jpeg.tobytes()
+            part = b'--' + BOUNDARY + b'\r\nContent-Type: image/jpeg\r\nContent-Length: ' + \
+                str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n'
+            try:
+                self.loop.call_soon_threadsafe(self.broadcast, (self.encoded, part, jpeg, published_at))
+            except RuntimeError:
+                # the server stopped on its own, so there's no one left to stream to
+                break
+
+    # Server thread
+
+    def broadcast(self, frame):
+        self.latest = frame
+        for event in self.clients:
+            event.set()
+
+    def serve_loop(self):
+        # whatever keeps the server from starting is handed over to start(), which is always let go on
+        try:
+            asyncio.run(self.serve())
+        except Exception as error:
+            if not self.started.is_set():
+                self.error = error
+        finally:
+            self.started.set()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.started.set()
+        async with server:
+            await self.stop_event.wait()
+            # the clients still connected are dropped (the server only finishes closing once they're gone)
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+
+    async def handle_client(self, reader, writer):
+        try:
+            request = await reader.readuntil(b'\r\n\r\n')
+            method, target = request.split(b'\r\n', 1)[0].split(b' ')[:2]
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            writer.close()
+            return
+
+        try:
+            if method != b'GET':
+                await self.respond(writer, b'405 Method Not Allowed', b'text/plain', b'Only GET is supported\n')
+            elif target in (b'/', b'/stream'):
+                await self.stream(writer)
+            elif target == b'/frame.jpg' and self.latest is not None:
+                await self.respond(writer, b'200 OK', b'image/jpeg', self.latest[2])
+            elif target == b'/stats':
+                await self.respond(writer, b'200 OK', b'application/json', json.dumps(self.stats(), indent=4).encode())
+            else:
+                await self.respond(writer, b'404 Not Found', b'text/plain', b'Not found\n')
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, content_type, body):
+        writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Type: ' + content_type + b'\r\nContent-Length: ' + \
+            str(len(body)).encode() + b'\r\nConnection: close\r\n\r\n' + body)
+        await writer.drain()
+
+    async def stream(self, writer):
+        """
+        sends the latest frame to a client every time there's a new one and its connection took the previous
+        one, until it disconnects or the server stops
+        """
+
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=' + BOUNDARY + \
+            b'\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n')
+        event = asyncio.Event()
+        client = ClientStats('%s:%d' % writer.get_extra_info('peername')[:2], self.latest[0] if self.latest else 0)
+        with self.clients_lock:
+            self.clients[event] = client
+        try:
+            while True:
+                await event.wait()
+                event.clear()
+                number, part, _, published_at = self.latest
+
+                # the same buffer goes to every client; if it takes a while to go out, newer frames replace it in
+                # the meantime, and the client just gets the latest one next
+                client.sending_frame(number, published_at)
+                writer.write(part)
+                await writer.drain()
+                client.sent_frame()
+        finally:
+            with self.clients_lock:
+                del self.clients[event]
+                self.past_clients.append(dict(client.stats(client.last_number), connected=False))